@@ -9,8 +9,8 @@ def start_worker():
     """Arranca el worker en un fil separat."""
     # Afegir directori arrel al path (el worker ho necessita)
     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-    from src.worker import run_worker
-    run_worker()
+    from src.worker import main
+    main()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+"""
+Servidor local que imita els endpoints de Cita Prèvia del SEPE.
+
+Permet fer benchmarks i proves del worker sense tocar el servei real.
+Serveix la mateixa cadena que recorre ``sepe_api`` (pàgina principal,
+existeCP, combos, DNI, antifrau, missatges, showPantallaMapa i
+cargaOficinasMapa) amb latència, errors i ``ErrorCaptcha`` configurables.
+
+Ús:
+
+    python scripts/fake_sepe.py --port 8099 --latency lognormal:-2.5,0.6 \\
+        --error-rate 0.01 --captcha-rate 0.01 --slot-rate 0.02
+
+    SEPE_BASE_URL=http://127.0.0.1:8099/citapreviasepe SEPE_HISTORY_DIR=$(mktemp -d) \\
+        python src/worker.py
+
+``SEPE_HISTORY_DIR`` aparta de ``data/`` els CPs morts i l'historial de
+CPs i de cites que el worker aprèn de les respostes falses.
+
+Fixtures (``--fixtures fitxer.json``), per CP i canal (1 presencial, 3 telefònica):
+
+    {
+        "08001": {"1": [{"oficina": "Barcelona Sant Antoni - SEPE",
+                          "primerHuecoDisponible": "12/03/2026"}]},
+        "invalid": ["08999"]
+    }
+
+Els CPs sense fixture reben una oficina genèrica amb hueco segons
+``--slot-rate``.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+PREFIX = "/citapreviasepe"
+
+
+# ─────────────────────────────────────────────────────────────────────
+# Distribucions de latència
+# ─────────────────────────────────────────────────────────────────────
+
+def parse_latency(spec):
+    """Converteix ``fixed:0.1``, ``uniform:0.05,0.3``, ``normal:0.2,0.05`` o
+    ``lognormal:mu,sigma`` en una funció que retorna segons."""
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',')] if params else []
+    if kind == 'fixed':
+        return lambda: values[0] if values else 0.0
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(values[0], values[1])
+    raise ValueError(f"Distribució de latència desconeguda: {spec}")
+
+
+# ─────────────────────────────────────────────────────────────────────
+# Aplicació
+# ─────────────────────────────────────────────────────────────────────
+
+LANDING_HTML = "<html><head><title>Cita previa SEPE</title></head><body>" + "x" * 400 + "</body></html>"
+STEP_HTML = "<div class='paso'>" + "x" * 200 + "</div>"
+
+
+def create_app(latency="fixed:0", error_rate=0.0, captcha_rate=0.0, timeout_rate=0.0,
+               timeout_seconds=30.0, slot_rate=0.0, session_ttl=900.0, fixtures=None,
+               seed=None):
+    """Crea l'aplicació aiohttp del SEPE fals amb la configuració donada."""
+    if seed is not None:
+        random.seed(seed)
+    fixtures = dict(fixtures or {})
+    invalid = set(fixtures.pop('invalid', []))
+    sample_latency = parse_latency(latency)
+    sessions = {}
+    stats = {'requests': 0, 'errors': 0, 'captchas': 0, 'timeouts': 0, 'slots': 0}
+
+    async def simulate(request):
+        """Aplica latència i errors injectats. Retorna una resposta d'error o None."""
+        stats['requests'] += 1
+        if timeout_rate and random.random() < timeout_rate:
+            stats['timeouts'] += 1
+            await asyncio.sleep(timeout_seconds)
+        await asyncio.sleep(sample_latency())
+        if error_rate and random.random() < error_rate:
+            stats['errors'] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        return None
+
+    def session_valid(request):
+        sid = request.cookies.get('JSESSIONID')
+        created = sessions.get(sid)
+        return created is not None and (time.time() - created) < session_ttl
+
+    async def landing(request):
+        error = await simulate(request)
+        if error is not None:
+            return error
+        sid = uuid.uuid4().hex.upper()
+        sessions[sid] = time.time()
+        response = web.Response(text=LANDING_HTML, content_type='text/html')
+        response.set_cookie('JSESSIONID', sid, path=PREFIX)
+        return response
+
+    async def existe_cp(request):
+        error = await simulate(request)
+        if error is not None:
+            return error
+        if not session_valid(request):
+            # El SEPE real torna la portada quan la sessió ha caducat
+            return web.Response(text=LANDING_HTML, content_type='text/html')
+        form = await request.post()
+        return web.Response(text="false" if form.get('codigoPostal') in invalid else "true")
+
+    async def generic_step(request):
+        error = await simulate(request)
+        if error is not None:
+            return error
+        return web.Response(text=STEP_HTML, content_type='text/html')
+
+    async def offices(request):
+        error = await simulate(request)
+        if error is not None:
+            return error
+        if not session_valid(request):
+            return web.Response(text=LANDING_HTML, content_type='text/html')
+        if captcha_rate and random.random() < captcha_rate:
+            stats['captchas'] += 1
+            return web.json_response({"Error": "ErrorCaptcha"})
+        form = await request.post()
+        zip_code = form.get('codigoPostal', '')
+        channel = form.get('idTipoAtencion', '1')
+        if zip_code in fixtures:
+            listing = fixtures[zip_code].get(channel, [])
+        else:
+            has_slot = slot_rate and random.random() < slot_rate
+            listing = [{
+                "oficina": f"Oficina {zip_code} - SEPE",
+                "primerHuecoDisponible": "15/06/2026 09:30" if has_slot else "",
+            }]
+        if any(o.get('primerHuecoDisponible') for o in listing):
+            stats['slots'] += 1
+        return web.json_response({"listaOficina": listing})
+
+    async def fake_stats(request):
+        return web.json_response(dict(stats, sessions=len(sessions)))
+
+    app = web.Application()
+    app['stats'] = stats
+    app.router.add_get(f"{PREFIX}/", landing)
+    app.router.add_post(f"{PREFIX}/cita/existeCP", existe_cp)
+    app.router.add_post(f"{PREFIX}/cita/cargaOficinasMapa", offices)
+    app.router.add_post(f"{PREFIX}/cita/{{step}}", generic_step)
+    app.router.add_get("/_stats", fake_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SEPE fals per a proves i benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', default='fixed:0',
+                        help="fixed:S | uniform:A,B | normal:MU,SD | lognormal:MU,SIGMA (segons)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Probabilitat d'un 503")
+    parser.add_argument('--captcha-rate', type=float, default=0.0,
+                        help="Probabilitat d'ErrorCaptcha a cargaOficinasMapa")
+    parser.add_argument('--timeout-rate', type=float, default=0.0,
+                        help="Probabilitat que una petició es pengi --timeout-seconds")
+    parser.add_argument('--timeout-seconds', type=float, default=30.0)
+    parser.add_argument('--slot-rate', type=float, default=0.0,
+                        help="Probabilitat de hueco per als CPs sense fixture")
+    parser.add_argument('--session-ttl', type=float, default=900.0,
+                        help="Segons de vida d'un JSESSIONID")
+    parser.add_argument('--fixtures', help="Fitxer JSON d'oficines per CP i canal")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures, 'r', encoding='utf-8') as f:
+            fixtures = json.load(f)
+
+    app = create_app(latency=args.latency, error_rate=args.error_rate,
+                     captcha_rate=args.captcha_rate, timeout_rate=args.timeout_rate,
+                     timeout_seconds=args.timeout_seconds, slot_rate=args.slot_rate,
+                     session_ttl=args.session_ttl, fixtures=fixtures, seed=args.seed)
+    print(f"SEPE fals escoltant a http://{args.host}:{args.port}{PREFIX}")
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Generador de càrrega per al client SEPE (``check_zip``).
+
+Llança comprovacions contra ``SEPE_BASE_URL`` (normalment el SEPE fals de
+``scripts/fake_sepe.py``) amb el motor de fils o l'asíncron i mostra
+rendiment, latència per comprovació i les mètriques per pas.
+
+    python scripts/fake_sepe.py --latency lognormal:-2.5,0.6 &
+    SEPE_BASE_URL=http://127.0.0.1:8099/citapreviasepe \\
+        python scripts/load_test.py --engine async --checks 2000 --concurrency 200
+
+El que el client aprèn de les respostes (CPs morts, historial de CPs i de
+cites) va a un directori temporal, no a ``data/``: els resultats del SEPE
+fals no han d'influir en les cerques reals.  Amb ``SEPE_HISTORY_DIR`` es
+pot triar el directori (p. ex. per repetir una prova amb les caches plenes).
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+# Abans d'importar src: els mòduls en llegeixen la ruta en carregar-se
+os.environ.setdefault('SEPE_HISTORY_DIR', tempfile.mkdtemp(prefix='sepe_load_test_'))
+
+from src import sepe_api
+from src.metrics import Histogram
+
+
+def _zips(n_zips):
+    return [f"08{i:03d}" for i in range(1, n_zips + 1)]
+
+
+def _dni(i):
+    return f"{10000000 + i}X"
+
+
+def run_threads(jobs, concurrency, appt_types):
+    durations = Histogram(buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 60000))
+
+    def one(job):
+        i, zip_code = job
+        start = time.perf_counter()
+        result = sepe_api.check_zip(zip_code, _dni(i), appt_types)
+        return (time.perf_counter() - start) * 1000, result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, jobs))
+    for elapsed, _ in outcomes:
+        durations.observe(elapsed)
+    return durations, [r for _, r in outcomes]
+
+
+async def run_async(jobs, concurrency, appt_types):
+    from src.sepe_async import AsyncSepeClient
+
+    durations = Histogram(buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 60000))
+
+    async with AsyncSepeClient(max_concurrency=concurrency) as client:
+        async def one(job):
+            i, zip_code = job
+            start = time.perf_counter()
+            result = await client.check_zip(zip_code, _dni(i), appt_types)
+            durations.observe((time.perf_counter() - start) * 1000)
+            return result
+
+        results = await asyncio.gather(*[one(job) for job in jobs])
+    return durations, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de càrrega per a check_zip")
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--checks', type=int, default=200, help="Nombre total de comprovacions")
+    parser.add_argument('--zips', type=int, default=50, help="CPs diferents entre els quals repartir")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--types', default='person', help="person, phone o person,phone")
+    args = parser.parse_args()
+
+    appt_types = args.types.split(',')
+    zips = _zips(args.zips)
+    jobs = [(i, random.choice(zips)) for i in range(args.checks)]
+
+    print(f"Objectiu: {sepe_api.BASE}")
+    print(f"Historial i caches a: {os.environ['SEPE_HISTORY_DIR']}")
+    print(f"{args.checks} comprovacions, motor={args.engine}, concurrència={args.concurrency}")
+
+    start = time.perf_counter()
+    if args.engine == 'async':
+        durations, results = asyncio.run(run_async(jobs, args.concurrency, appt_types))
+    else:
+        durations, results = run_threads(jobs, args.concurrency, appt_types)
+    wall = time.perf_counter() - start
+
+    found = sum(1 for r in results if any(r.get(t) for t in appt_types))
+    unknown = sum(1 for r in results if r.get('unknown'))
+    stats = sepe_api.get_session_stats()
+    snap = durations.snapshot()
+
+    print(f"\nTemps total: {wall:.1f}s — {args.checks / wall * 60:.0f} comprovacions/min")
+    print(f"Duració per comprovació: p50={snap['p50']:.0f}ms p95={snap['p95']:.0f}ms "
+          f"p99={snap['p99']:.0f}ms max={snap['max']:.0f}ms")
+    print(f"Resultats: {found} amb cita, {unknown} desconeguts")
+    print(f"Peticions SEPE: {stats['round_trips']} ({stats['avg_round_trips']}/comprovació), "
+          f"agrupades={stats['coalesced']}, cache_hits={stats['cache_hits']}")
+    print(f"Ritme final del limitador: {sepe_api.rate_limiter.rate:.2f}/s")
+    print(f"Per pas: {sepe_api.sepe_metrics.summary_line()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Migra l'estat de les cerques entre backends (``json``, ``sqlite``, ``journal``).
+
+    python scripts/migrate_state.py --to sqlite                   # data/state.json → data/state.db
+    python scripts/migrate_state.py --from sqlite --to json       # data/state.db → data/state.json
+    python scripts/migrate_state.py --to journal                  # data/state.json → instantània + diari
+
+Els backends SQLite i de diari ja importen ``state.json`` sols el primer
+cop que s'obren; aquest script serveix per refer-ho (substitueix el
+contingut del destí) o per tornar al fitxer JSON.  Atura el worker i
+l'app web abans.
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from src.state import JsonBackend
+from src.state_sqlite import SqliteBackend
+from src.state_journal import JournalBackend
+
+BACKENDS = {'json': JsonBackend, 'sqlite': SqliteBackend, 'journal': JournalBackend}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--from', dest='source', choices=list(BACKENDS), default='json')
+    parser.add_argument('--to', choices=list(BACKENDS), required=True)
+    args = parser.parse_args()
+    if args.source == args.to:
+        parser.error("l'origen i el destí són el mateix backend")
+
+    with BACKENDS[args.source]().transaction(write=False) as tx:
+        state = tx.read()[1]
+    with BACKENDS[args.to]().transaction() as tx:
+        tx.write(state)
+    print(f"{len(state)} cerques migrades de {args.source} a {args.to}")
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,7 @@ from dotenv import load_dotenv
 
 from src.state import load_state
 from src.locations import LocationManager
-from src import search_service, email_service
+from src import search_service, email_service, runtime_stats, slot_history
 
 # ---------------------------------------------------------------------------
 # Logging
@@ -230,6 +230,34 @@ def delete_search_api(dni):
 def server_info():
     return jsonify(search_service.get_server_info())
 
+@app.route('/api/metrics')
+def metrics():
+    """Mètriques del client SEPE publicades pel worker (per pas de la cadena)."""
+    stats = runtime_stats.read_stats()
+    return jsonify({
+        'updated_at': stats.get('updated_at'),
+        'endpoints': stats.get('sepe_metrics', {}),
+        'client': stats.get('sepe_client', {}),
+        'checks': stats.get('check_duration', {}),
+        'rate_limiter': stats.get('rate_limiter'),
+        'circuit_breaker': stats.get('circuit_breaker'),
+    })
+
+@app.route('/api/availability')
+def availability_patterns():
+    """Cites alliberades pel SEPE per hora i dia de la setmana (``slot_history``)."""
+    try:
+        days = float(request.args['days']) if request.args.get('days') else None
+    except ValueError:
+        return jsonify({'error': 'days ha de ser un número'}), 400
+    return jsonify(slot_history.release_patterns(
+        days=days,
+        zip_code=request.args.get('zip') or None,
+        office=request.args.get('office') or None,
+        channel=request.args.get('channel') or None,
+        tramite=request.args.get('tramite') or None,
+    ))
+
 @app.route('/api/logs')
 def get_logs():
     lines = int(request.args.get('lines', 150))
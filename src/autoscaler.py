@@ -0,0 +1,209 @@
+"""
+Autoescalat de la concurrència del worker.
+
+Cada ``AUTOSCALE_INTERVAL`` segons ajusta quantes comprovacions pot tenir
+en vol el worker (``workers``: fils ocupats o tasques asyncio) i quants
+CPs en vol pot tenir cada cerca (``depth``), a partir del que ha vist
+durant l'interval:
+
+* la cua: ús mitjà dels forats, CPs que esperen forat i cerques frenades
+  pel límit de profunditat;
+* la durada mitjana de les comprovacions respecte de la millor observada;
+* la proporció de comprovacions amb resultat incert o fora de pressupost;
+* la càrrega de CPU de la màquina (``os.getloadavg`` per nucli);
+* el temps que les comprovacions passen esperant el limitador de ritme.
+
+Com el limitador, puja de manera additiva (quan hi ha feina esperant i
+els forats van plens) i baixa de manera multiplicativa (errors, latència
+disparada, CPU saturada o circuit obert).  En períodes tranquils baixa
+de mica en mica fins al mínim.  Sempre dins dels límits configurats.
+"""
+
+import logging
+import os
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Segons entre dues decisions
+AUTOSCALE_INTERVAL = float(os.getenv('AUTOSCALE_INTERVAL', 10))
+# Proporció de comprovacions incertes (SEPE caigut, pressupost esgotat) que fa baixar
+AUTOSCALE_MAX_ERROR_RATE = float(os.getenv('AUTOSCALE_MAX_ERROR_RATE', 0.2))
+# Càrrega per nucli a partir de la qual no es pot pujar més
+AUTOSCALE_MAX_CPU = float(os.getenv('AUTOSCALE_MAX_CPU', 0.9))
+# Durada mitjana respecte de la millor observada que es considera congestió
+AUTOSCALE_LATENCY_FACTOR = float(os.getenv('AUTOSCALE_LATENCY_FACTOR', 2.0))
+
+# Comprovacions mínimes en un interval per fiar-se de la latència i els errors
+_MIN_SAMPLE = 5
+
+
+def _cpu_load():
+    """Càrrega de la màquina per nucli (últim minut), o ``None`` si no se sap."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class ConcurrencyAutoscaler:
+    """Ajust AIMD de ``queue.slots`` i ``queue.depth`` dins de límits.
+
+    Parameters
+    ----------
+    queue : WorkQueue  – Cua de treball que es redimensiona.
+    min_workers, max_workers : int  – Límits de comprovacions en vol.
+    min_depth, max_depth : int  – Límits de CPs en vol per cerca.
+    metrics, limiter, breaker  – ``SepeMetrics``, limitador i circuit breaker
+        d'on es llegeixen els senyals.
+    enabled : bool  – Amb ``False`` només informa dels valors fixos.
+    """
+
+    def __init__(self, queue, min_workers, max_workers, min_depth, max_depth,
+                 metrics, limiter, breaker, enabled=True, interval=AUTOSCALE_INTERVAL):
+        self.queue = queue
+        self.min_workers = max(1, min(min_workers, max_workers))
+        self.max_workers = max(1, max_workers)
+        self.min_depth = max(1, min(min_depth, max_depth))
+        self.max_depth = max(1, max_depth)
+        self.metrics = metrics
+        self.limiter = limiter
+        self.breaker = breaker
+        self.enabled = enabled
+        self.interval = interval
+
+        self.workers = self.max_workers
+        self.depth = self.max_depth
+        self._best_latency = None
+        self._adjustments = deque(maxlen=20)
+        self._last_signals = {}
+        self._reset(time.monotonic())
+        if enabled:
+            self._apply()
+
+    def _reset(self, now):
+        checks = self.metrics.checks_snapshot()
+        self._window_start = now
+        self._util_sum = 0.0
+        self._util_samples = 0
+        self._checks_seen = checks['count']
+        self._latency_seen = checks['avg'] * checks['count']
+        self._errors_seen = self._error_count(checks)
+        self._waited_seen = self.limiter.snapshot()['waited_s']
+
+    @staticmethod
+    def _error_count(checks):
+        outcomes = checks.get('outcomes', {})
+        return outcomes.get('unknown', 0) + outcomes.get('deadline', 0)
+
+    def _apply(self):
+        self.queue.resize(slots=self.workers, depth=self.depth)
+
+    def step(self, now=None):
+        """Mostra l'ús de la cua i, si ha passat l'interval, decideix."""
+        if not self.enabled:
+            return
+        now = time.monotonic() if now is None else now
+        self._util_sum += self.queue.in_flight() / self.workers
+        self._util_samples += 1
+        if now - self._window_start >= self.interval:
+            self._decide(self._signals(now))
+            self._reset(now)
+
+    def _signals(self, now):
+        elapsed = max(now - self._window_start, 1e-6)
+        checks = self.metrics.checks_snapshot()
+        n = checks['count'] - self._checks_seen
+        latency = ((checks['avg'] * checks['count'] - self._latency_seen) / n) if n else None
+        errors = (self._error_count(checks) - self._errors_seen) / n if n else 0.0
+        waited = self.limiter.snapshot()['waited_s'] - self._waited_seen
+        backlog, blocked = self.queue.backlog()
+        signals = {
+            'utilization': round(self._util_sum / self._util_samples, 2) if self._util_samples else 0.0,
+            'backlog': backlog,
+            'depth_blocked': blocked,
+            'checks': n,
+            'latency_ms': round(latency, 1) if latency is not None else None,
+            'error_rate': round(errors, 3),
+            'cpu': _cpu_load(),
+            # Part del temps de les comprovacions en vol passada esperant el limitador
+            'limiter_wait': round(waited / (elapsed * self.workers), 2),
+            'circuit_open': self.breaker.retry_after() > 0,
+        }
+        if latency is not None and n >= _MIN_SAMPLE:
+            # La millor latència "oblida" a poc a poc per adaptar-se a canvis del SEPE
+            best = self._best_latency
+            self._best_latency = latency if best is None else min(best * 1.05, latency)
+        self._last_signals = signals
+        return signals
+
+    def _decide(self, s):
+        workers, depth = self.workers, self.depth
+        enough = s['checks'] >= _MIN_SAMPLE
+        congested = (enough and self._best_latency
+                     and s['latency_ms'] > AUTOSCALE_LATENCY_FACTOR * self._best_latency)
+
+        if s['circuit_open']:
+            reason = "circuit obert"
+            workers, depth = int(workers * 0.5), depth - 1
+        elif enough and s['error_rate'] > AUTOSCALE_MAX_ERROR_RATE:
+            reason = f"errors {s['error_rate']:.0%}"
+            workers, depth = int(workers * 0.75), depth - 1
+        elif s['cpu'] is not None and s['cpu'] > AUTOSCALE_MAX_CPU:
+            reason = f"CPU {s['cpu']:.2f}"
+            workers = int(workers * 0.75)
+        elif congested:
+            reason = f"latència {s['latency_ms']:.0f}ms"
+            workers = int(workers * 0.75)
+        elif s['limiter_wait'] > 0.5:
+            # Els forats se'ls menja el limitador de ritme: més concurrència no hi guanya
+            reason = "limitador de ritme"
+            workers -= 1
+        elif s['backlog'] and s['utilization'] >= 0.8:
+            reason = "cua plena"
+            workers += max(1, workers // 4)
+            if s['depth_blocked']:
+                depth += 1
+        elif s['depth_blocked'] and s['utilization'] < 0.8:
+            reason = "cerques frenades per la profunditat"
+            depth += 1
+        elif not s['backlog'] and s['utilization'] < 0.5:
+            reason = "poca feina"
+            workers -= max(1, workers // 8)
+        else:
+            return
+
+        workers = min(max(workers, self.min_workers), self.max_workers)
+        depth = min(max(depth, self.min_depth), self.max_depth)
+        if (workers, depth) == (self.workers, self.depth):
+            return
+        changes = []
+        if workers != self.workers:
+            changes.append(f"concurrència {self.workers} → {workers}")
+        if depth != self.depth:
+            changes.append(f"profunditat {self.depth} → {depth}")
+        logger.info(f"Autoescalat: {', '.join(changes)} ({reason})")
+        self._adjustments.append({
+            'ts': time.time(),
+            'workers': [self.workers, workers],
+            'depth': [self.depth, depth],
+            'reason': reason,
+        })
+        self.workers, self.depth = workers, depth
+        self._apply()
+
+    def snapshot(self):
+        """Estat actual (per a ``/api/server-info``)."""
+        return {
+            'enabled': self.enabled,
+            'workers': self.workers,
+            'min_workers': self.min_workers,
+            'max_workers': self.max_workers,
+            'depth': self.depth,
+            'min_depth': self.min_depth,
+            'max_depth': self.max_depth,
+            'signals': self._last_signals,
+            'last_adjustment': self._adjustments[-1] if self._adjustments else None,
+            'adjustments': list(self._adjustments),
+        }
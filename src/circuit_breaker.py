@@ -0,0 +1,164 @@
+"""
+Circuit breaker per a l'endpoint de Cita Prèvia del SEPE.
+
+Quan el SEPE cau, cada comprovació esperaria fins a vuit timeouts
+seguits.  El breaker compta errors de transport consecutius i, passat
+el llindar, s'obre: les peticions fallen a l'instant sense tocar la
+xarxa.  Passat el temps d'espera deixa passar una sola petició de prova
+(mig obert); si va bé es torna a tancar, si falla es reobre amb un
+temps d'espera més llarg (backoff exponencial fins a ``max_open_timeout``).
+Una prova que no dona senyals en ``probe_timeout`` segons es dona per
+perduda i se'n permet una altra: el breaker no es pot quedar mig obert
+per sempre.
+"""
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Breaker de tres estats (tancat → obert → mig obert).
+
+    Parameters
+    ----------
+    failure_threshold : int  – Errors de transport consecutius per obrir-lo.
+    open_timeout : float  – Segons oberts abans de la primera prova.
+    max_open_timeout : float  – Límit del backoff entre proves fallides.
+    probe_timeout : float  – Segons màxims d'una prova sense resultat
+                             (per defecte, ``open_timeout``).
+    """
+
+    def __init__(self, failure_threshold=5, open_timeout=30.0, max_open_timeout=600.0,
+                 probe_timeout=None):
+        self.failure_threshold = failure_threshold
+        self.base_open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.probe_timeout = open_timeout if probe_timeout is None else probe_timeout
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._open_timeout = open_timeout
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self._counters = {"opened": 0, "rejected": 0, "probes_expired": 0}
+
+    def allow(self) -> bool:
+        """Indica si es pot fer una petició ara mateix."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self._opened_at < self._open_timeout:
+                    self._counters["rejected"] += 1
+                    return False
+                self.state = HALF_OPEN
+                logger.info("Circuit SEPE mig obert: provant si el servei ha tornat")
+            # Mig obert: només una prova a la vegada
+            if self._probe_busy():
+                self._counters["rejected"] += 1
+                return False
+            self._probe_in_flight = True
+            self._probe_started = time.time()
+            return True
+
+    def _probe_busy(self) -> bool:
+        """Hi ha una prova en curs (amb el lock agafat); caduca la que s'ha perdut."""
+        if not self._probe_in_flight:
+            return False
+        if time.time() - self._probe_started < self.probe_timeout:
+            return True
+        self._probe_in_flight = False
+        self._counters["probes_expired"] += 1
+        logger.warning("Circuit SEPE: la prova en curs no ha donat resultat en %.0f s, "
+                       "se'n permet una altra", self.probe_timeout)
+        return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            if self.state != CLOSED:
+                logger.info("Circuit SEPE tancat: el servei respon de nou")
+                self.state = CLOSED
+                self._open_timeout = self.base_open_timeout
+
+    def record_failure(self, reason: str = "") -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN:
+                # La prova ha fallat: reobrim amb més espera
+                self._probe_in_flight = False
+                self._open_timeout = min(self._open_timeout * 2, self.max_open_timeout)
+                self._open(reason)
+            elif self.state == CLOSED and self._failures >= self.failure_threshold:
+                self._open(reason)
+
+    def release_probe(self) -> None:
+        """Allibera la prova en curs sense resultat (p. ex. petició cancel·lada)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _open(self, reason: str) -> None:
+        self.state = OPEN
+        self._opened_at = time.time()
+        self._counters["opened"] += 1
+        logger.warning("Circuit SEPE obert després de %d errors (%s); nova prova d'aquí %.0f s",
+                       self._failures, reason, self._open_timeout)
+
+    def accepting(self) -> bool:
+        """Indica si val la pena enviar peticions noves.
+
+        Fals mentre és obert i, mig obert, mentre la prova és en curs:
+        qualsevol altra petició seria rebutjada a l'instant.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                return time.time() - self._opened_at >= self._open_timeout
+            return not self._probe_busy()
+
+    @property
+    def probe_in_flight(self) -> bool:
+        with self._lock:
+            return self.state == HALF_OPEN and self._probe_busy()
+
+    def retry_after(self) -> float:
+        """Segons que falten perquè el breaker permeti una prova (0 si tancat)."""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self._open_timeout - time.time())
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self._failures,
+                "open_timeout": self._open_timeout,
+                "opened_at": self._opened_at or None,
+                "opened": self._counters["opened"],
+                "rejected": self._counters["rejected"],
+                "probes_expired": self._counters["probes_expired"],
+            }
+
+
+def breaker_from_env() -> CircuitBreaker:
+    """Crea el breaker amb ``SEPE_BREAKER_THRESHOLD`` / ``SEPE_BREAKER_TIMEOUT``."""
+    try:
+        threshold = int(os.getenv("SEPE_BREAKER_THRESHOLD", 5))
+        timeout = float(os.getenv("SEPE_BREAKER_TIMEOUT", 30))
+        max_timeout = float(os.getenv("SEPE_BREAKER_MAX_TIMEOUT", 600))
+    except ValueError:
+        threshold, timeout, max_timeout = 5, 30.0, 600.0
+    return CircuitBreaker(threshold, timeout, max_timeout)
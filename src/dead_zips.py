@@ -0,0 +1,153 @@
+"""
+Cache negativa persistent de codis postals "morts".
+
+Dos motius, amb abast diferent:
+
+* ``invalid``: el SEPE diu que el CP no existeix (``existeCP`` = ``false``).
+  Val per a totes les cerques.
+* ``no_offices``: ``cargaOficinasMapa`` no ha retornat cap oficina per a
+  un subtràmit i canal concrets.  Només val per a aquesta combinació
+  (un CP sense oficina telefònica per a l'IMV pot tenir-ne de presencials
+  per a la prestació): l'entrada és ``"<cp>|<subtràmit>|<canal>"``.
+
+``LocationManager.get_zips`` descarta abans del mostreig els CPs
+inexistents i els que no tenen oficines per a cap canal de la cerca que
+es crea, de manera que el pressupost de 50 CPs per cerca es dedica a CPs
+que realment poden donar cita.
+
+Les entrades caduquen (el SEPE pot obrir oficines o corregir dades).
+
+El fitxer es comparteix entre el worker (que escriu) i el procés web
+(que llegeix); cada procés el recarrega quan canvia el seu ``mtime``.
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ``SEPE_HISTORY_DIR`` l'aparta de ``data/`` (proves contra el SEPE fals)
+DEAD_ZIPS_FILE = os.path.join(os.getenv('SEPE_HISTORY_DIR', os.path.join(os.path.dirname(__file__), '..', 'data')),
+                              'dead_zips.json')
+
+# Dies que es recorda un CP mort, segons el motiu
+INVALID_TTL_DAYS = float(os.getenv('DEAD_ZIP_INVALID_DAYS', 30))
+NO_OFFICES_TTL_DAYS = float(os.getenv('DEAD_ZIP_NO_OFFICES_DAYS', 7))
+
+REASON_INVALID = 'invalid'
+REASON_NO_OFFICES = 'no_offices'
+
+_lock = threading.Lock()
+_entries = {}
+_loaded_mtime = None
+
+
+def _ttl_seconds(reason):
+    days = INVALID_TTL_DAYS if reason == REASON_INVALID else NO_OFFICES_TTL_DAYS
+    return days * 86400
+
+
+def _refresh():
+    """Recarrega el fitxer si ha canviat des de l'última lectura (amb el lock agafat)."""
+    global _entries, _loaded_mtime
+    try:
+        mtime = os.stat(DEAD_ZIPS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        _entries, _loaded_mtime = {}, None
+        return
+    if mtime == _loaded_mtime:
+        return
+    try:
+        with open(DEAD_ZIPS_FILE, 'r', encoding='utf-8') as f:
+            _entries = json.load(f)
+        _loaded_mtime = mtime
+    except Exception as e:
+        logger.warning(f"Error llegint la cache de CPs morts: {e}")
+
+
+def _is_expired(entry, now):
+    return now - entry.get('ts', 0) > _ttl_seconds(entry.get('reason'))
+
+
+def _key(zip_code, reason, subtramite=None, channel=None):
+    if reason == REASON_INVALID:
+        return zip_code
+    return f"{zip_code}|{subtramite}|{channel}"
+
+
+def _alive(key, reason, now):
+    entry = _entries.get(key)
+    return (entry is None or entry.get('reason') != reason or _is_expired(entry, now))
+
+
+def is_dead(zip_code, subtramite=None, channel=None):
+    """``True`` si el CP no existeix o, amb *subtramite* i *channel*, no hi té oficines."""
+    with _lock:
+        _refresh()
+        now = time.time()
+        if not _alive(zip_code, REASON_INVALID, now):
+            return True
+        if subtramite is None or channel is None:
+            return False
+        return not _alive(_key(zip_code, REASON_NO_OFFICES, subtramite, channel),
+                          REASON_NO_OFFICES, now)
+
+
+def filter_alive(zips, subtramite=None, channels=()):
+    """Retorna *zips* sense els CPs morts per a una cerca (mantenint l'ordre).
+
+    Sempre es descarten els inexistents; amb *subtramite* i *channels*,
+    també els que no tenen oficines per a cap d'aquests canals (un CP amb
+    oficines per a un sol canal es manté).
+    """
+    with _lock:
+        _refresh()
+        now = time.time()
+
+        def alive(zip_code):
+            if not _alive(zip_code, REASON_INVALID, now):
+                return False
+            if subtramite is None or not channels:
+                return True
+            return any(_alive(_key(zip_code, REASON_NO_OFFICES, subtramite, c),
+                              REASON_NO_OFFICES, now) for c in channels)
+
+        return [z for z in zips if alive(z)]
+
+
+def mark_dead(zip_code, reason, subtramite=None, channel=None):
+    """Anota un CP com a mort i ho persisteix.
+
+    Amb ``'invalid'``, per a tot el CP; amb ``'no_offices'``, només per a
+    *subtramite* i *channel* (l'id de canal del SEPE).
+    """
+    global _loaded_mtime
+    key = _key(zip_code, reason, subtramite, channel)
+    with _lock:
+        _refresh()
+        now = time.time()
+        previous = _entries.get(key)
+        if previous and previous.get('reason') == reason and not _is_expired(previous, now):
+            return
+        _entries[key] = {'reason': reason, 'ts': now}
+        # Aprofitem l'escriptura per purgar les entrades caducades
+        for z in [z for z, e in _entries.items() if _is_expired(e, now)]:
+            del _entries[z]
+        try:
+            os.makedirs(os.path.dirname(DEAD_ZIPS_FILE), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(DEAD_ZIPS_FILE), text=True)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(_entries, f, ensure_ascii=False)
+            os.replace(tmp_path, DEAD_ZIPS_FILE)
+            _loaded_mtime = os.stat(DEAD_ZIPS_FILE).st_mtime_ns
+        except Exception as e:
+            logger.error(f"Error guardant la cache de CPs morts: {e}")
+            if 'tmp_path' in locals() and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    logger.info(f"CP {key} marcat com a mort ({reason})")
@@ -0,0 +1,191 @@
+"""
+Leases de cerques per al mode de worker repartit (``WORKER_SHARDED=1``).
+
+Diversos processos worker (al mateix host o a hosts que comparteixen el
+directori ``data/``) es reparteixen les cerques actives amb leases amb
+caducitat desades a ``data/leases.json``.  Cada worker:
+
+* renova periòdicament els seus leases i un "heartbeat" propi;
+* agafa cerques lliures (o amb el lease caducat) fins a la seva part
+  justa, ``ceil(cerques / workers vius)``;
+* quan n'arriba un de nou, deixa d'enviar CPs de les que li sobren
+  ("drenatge") i les allibera quan ja no en tenen cap en vol; en
+  aturar-se les allibera totes.
+
+Si un worker mor, els seus leases caduquen al cap de ``LEASE_TTL`` segons
+i els altres se'n fan càrrec.  Tots els canvis al fitxer es fan amb un
+``flock`` exclusiu sobre ``data/leases.lock``.
+"""
+
+import json
+import logging
+import math
+import os
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: sense bloqueig entre processos (un sol worker)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LEASES_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'leases.json')
+LOCK_FILE = LEASES_FILE.replace('.json', '.lock')
+
+# Vida d'un lease sense renovar (segons); es renova cada terç
+LEASE_TTL = int(os.getenv('WORKER_LEASE_TTL', 60))
+
+
+@contextmanager
+def _locked():
+    os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+    with open(LOCK_FILE, 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read():
+    try:
+        with open(LEASES_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data.setdefault('workers', {})
+    data.setdefault('leases', {})
+    return data
+
+
+def _write(data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(LEASES_FILE), text=True)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, LEASES_FILE)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class LeaseManager:
+    """Leases d'aquest procés worker sobre les cerques que processa."""
+
+    def __init__(self, worker_id=None, ttl=LEASE_TTL):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.owned: set[str] = set()
+        # Pròpies que sobren: s'acaben les comprovacions en vol i s'alliberen
+        self.draining: set[str] = set()
+        self._synced_at = 0.0
+
+    def active(self):
+        """Cerques pròpies a les quals encara s'envien CPs nous."""
+        return self.owned - self.draining
+
+    def needs_sync(self):
+        return time.time() - self._synced_at >= self.ttl / 3
+
+    def sync(self, search_ids, busy=()):
+        """Heartbeat, renovació i repartiment; retorna les cerques pròpies.
+
+        *search_ids* són les cerques actives de l'estat; *busy* les pròpies
+        amb CPs en vol, que si sobren passen a ``draining`` en lloc
+        d'alliberar-se de cop.
+        """
+        now = time.time()
+        search_ids = set(search_ids)
+        try:
+            with _locked():
+                data = _read()
+                workers = {w: ts for w, ts in data['workers'].items() if now - ts < self.ttl}
+                workers[self.worker_id] = now
+                leases = {dni: lease for dni, lease in data['leases'].items()
+                          if dni in search_ids and lease.get('expires', 0) > now}
+
+                mine = sorted(dni for dni, lease in leases.items()
+                              if lease['owner'] == self.worker_id)
+                share = math.ceil(len(search_ids) / len(workers)) if search_ids else 0
+
+                # Un worker nou redueix la part justa: deixem anar les que sobren,
+                # primer les que no tenen res en vol
+                draining = set()
+                ordered = [d for d in mine if d not in busy] + [d for d in mine if d in busy]
+                for dni in ordered[:max(len(mine) - share, 0)]:
+                    if dni in busy:
+                        draining.add(dni)
+                    else:
+                        del leases[dni]
+                        mine.remove(dni)
+
+                free = sorted(dni for dni in search_ids if dni not in leases)
+                mine += free[:max(share - len(mine), 0)]
+                for dni in mine:
+                    leases[dni] = {'owner': self.worker_id, 'expires': now + self.ttl}
+
+                data['workers'] = workers
+                data['leases'] = leases
+                _write(data)
+        except Exception as e:
+            # Sense poder renovar, ens quedem només amb els leases encara vigents
+            logger.error(f"Error sincronitzant leases: {e}")
+            return self.owned
+
+        taken = set(mine) - self.owned
+        dropped = self.owned - set(mine)
+        if taken or dropped:
+            logger.info(f"Leases: {len(mine)} cerques pròpies "
+                        f"(+{len(taken)} -{len(dropped)}, {len(workers)} workers)")
+        self.owned = set(mine)
+        self.draining = draining
+        self._synced_at = now
+        return self.owned
+
+    def release(self, dnis):
+        """Allibera els leases indicats (p. ex. cerques acabades)."""
+        dnis = set(dnis) & self.owned
+        if not dnis:
+            return
+        try:
+            with _locked():
+                data = _read()
+                for dni in dnis:
+                    if data['leases'].get(dni, {}).get('owner') == self.worker_id:
+                        del data['leases'][dni]
+                _write(data)
+        except Exception as e:
+            logger.error(f"Error alliberant leases: {e}")
+        self.owned -= dnis
+        self.draining -= dnis
+
+    def release_all(self):
+        """Allibera tots els leases i el heartbeat (aturada neta del worker)."""
+        try:
+            with _locked():
+                data = _read()
+                data['leases'] = {dni: lease for dni, lease in data['leases'].items()
+                                  if lease.get('owner') != self.worker_id}
+                data['workers'].pop(self.worker_id, None)
+                _write(data)
+        except Exception as e:
+            logger.error(f"Error alliberant leases: {e}")
+        self.owned = set()
+        self.draining = set()
+
+    def snapshot(self):
+        """Vista global: leases per worker viu (llegida del fitxer compartit)."""
+        data = _read()
+        now = time.time()
+        per_worker = {w: 0 for w, ts in data['workers'].items() if now - ts < self.ttl}
+        for lease in data['leases'].values():
+            if lease.get('expires', 0) > now and lease.get('owner') in per_worker:
+                per_worker[lease['owner']] += 1
+        return {'worker_id': self.worker_id, 'owned': len(self.owned), 'workers': per_worker}
@@ -5,6 +5,8 @@ import csv
 import io
 import logging
 
+from src import dead_zips
+
 logger = logging.getLogger(__name__)
 
 # URLs dels datasets
@@ -270,12 +272,14 @@ class LocationManager:
         return sorted(list(set(municipios)))
 
     @classmethod
-    def get_zips(cls, scope, value, extra_context=None):
+    def get_zips(cls, scope, value, extra_context=None, subtramite=None, channels=()):
         """
         Retorna llista de CPs.
         scope: 'community', 'provincia', 'municipi', 'zip', 'comarca'
         value: El nom (o llista de noms).
         extra_context: Diccionari amb info extra
+        subtramite, channels: Subtràmit i canals SEPE de la cerca; es
+            descarten els CPs que no hi tenen oficines (``dead_zips``)
         """
         if not cls._data: cls.load_data()
         zips = []
@@ -349,6 +353,12 @@ class LocationManager:
         
         # Eliminar duplicats i ordenar
         unique_zips = sorted(list(set(zips)))
+
+        # Descartar CPs morts (inexistents o sense oficines) abans del mostreig
+        alive_zips = dead_zips.filter_alive(unique_zips, subtramite, channels)
+        if alive_zips and len(alive_zips) < len(unique_zips):
+            logger.info(f"Descartats {len(unique_zips) - len(alive_zips)} codis postals sense oficines SEPE.")
+            unique_zips = alive_zips
         
         # Limitar a 50 codis postals ben distribuïts per optimitzar la cerca
         MAX_ZIPS = 50
@@ -0,0 +1,141 @@
+"""
+Mètriques per pas de la cadena AJAX del SEPE.
+
+Per a cada endpoint (``existeCP``, ``cargaOficinasMapa``…) es guarda un
+histograma de latència, comptadors de codis HTTP, bytes rebuts i errors
+classificats, a més de la durada de cada comprovació sencera (per
+ajustar ``SEPE_CHECK_DEADLINE``).  El worker en publica una instantània per a ``/api/metrics``
+i n'escriu un resum periòdic a ``data/worker.log``.
+"""
+
+import bisect
+import threading
+
+# Límits superiors dels buckets de latència (mil·lisegons)
+LATENCY_BUCKETS_MS = (25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 12800, 20000)
+# Buckets de durada d'una comprovació sencera (tota la cadena)
+CHECK_BUCKETS_MS = (250, 500, 1000, 2000, 4000, 8000, 15000, 30000, 45000, 60000, 120000)
+
+
+class Histogram:
+    """Histograma de buckets fixos amb estimació de percentils."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # l'últim és +inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Percentil *q* (0‑1) interpolant linealment dins del bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * ((rank - seen) / n), self.max)
+            seen += n
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50": round(self.percentile(0.50), 1),
+            "p95": round(self.percentile(0.95), 1),
+            "p99": round(self.percentile(0.99), 1),
+            "max": round(self.max, 1),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+inf"], self.counts)),
+        }
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.bytes = 0
+
+
+class SepeMetrics:
+    """Registre de mètriques per endpoint, segur entre fils."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: dict[str, _EndpointStats] = {}
+        self._checks = Histogram(CHECK_BUCKETS_MS)
+        self._check_outcomes: dict[str, int] = {}
+
+    def _get(self, step: str) -> _EndpointStats:
+        stats = self._endpoints.get(step)
+        if stats is None:
+            stats = self._endpoints[step] = _EndpointStats()
+        return stats
+
+    def record_request(self, step: str, elapsed_ms: float, status: int | None = None,
+                       size: int = 0) -> None:
+        """Anota una petició acabada (amb resposta o per timeout/error)."""
+        with self._lock:
+            stats = self._get(step)
+            stats.latency.observe(elapsed_ms)
+            if status is not None:
+                key = str(status)
+                stats.statuses[key] = stats.statuses.get(key, 0) + 1
+            stats.bytes += size
+
+    def record_error(self, step: str, kind: str) -> None:
+        """Anota un error classificat (``timeout``, ``http_5xx``, ``captcha``…)."""
+        with self._lock:
+            stats = self._get(step)
+            stats.errors[kind] = stats.errors.get(kind, 0) + 1
+
+    def record_check(self, elapsed_ms: float, outcome: str) -> None:
+        """Anota una comprovació que ha tocat el SEPE (``ok``, ``unknown``, ``deadline``)."""
+        with self._lock:
+            self._checks.observe(elapsed_ms)
+            self._check_outcomes[outcome] = self._check_outcomes.get(outcome, 0) + 1
+
+    def checks_snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._checks.snapshot(), outcomes=dict(self._check_outcomes))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                step: {
+                    "latency_ms": s.latency.snapshot(),
+                    "statuses": dict(s.statuses),
+                    "errors": dict(s.errors),
+                    "bytes": s.bytes,
+                }
+                for step, s in self._endpoints.items()
+            }
+
+    def summary_line(self) -> str:
+        """Resum d'una línia: durada de comprovació i ``pas n=… p50=…ms…`` per endpoint."""
+        with self._lock:
+            parts = []
+            if self._checks.count:
+                parts.append(
+                    f"check n={self._checks.count} p50={self._checks.percentile(0.5):.0f}ms "
+                    f"p99={self._checks.percentile(0.99):.0f}ms "
+                    f"deadline={self._check_outcomes.get('deadline', 0)}"
+                )
+            for step, s in sorted(self._endpoints.items(),
+                                  key=lambda kv: -kv[1].latency.total):
+                errors = sum(s.errors.values())
+                parts.append(
+                    f"{step} n={s.latency.count} p50={s.latency.percentile(0.5):.0f}ms "
+                    f"p95={s.latency.percentile(0.95):.0f}ms err={errors}"
+                )
+            return " | ".join(parts) if parts else "(sense peticions)"
@@ -0,0 +1,170 @@
+"""
+Limitador de ritme adaptatiu (token bucket + AIMD) per a les peticions al SEPE.
+
+Totes les peticions de ``sepe_api`` i ``sepe_async`` passen per una sola
+instància compartida.  El ritme puja de manera additiva mentre les
+respostes són netes i es retalla de manera multiplicativa quan el SEPE
+mostra senyals de saturació (``ErrorCaptcha``, 5xx, timeouts, respostes
+que no són JSON).  Així el bot treballa al màxim ritme que el SEPE
+tolera en cada moment en lloc d'una constant ajustada a mà.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+class AdaptiveRateLimiter:
+    """Token bucket amb ajust AIMD del ritme (peticions/segon).
+
+    Parameters
+    ----------
+    rate : float  – Ritme inicial.
+    min_rate, max_rate : float  – Límits del ritme.
+    burst : float  – Capacitat del bucket (peticions que es poden fer de cop).
+    increase_step : float  – Increment additiu del ritme.
+    increase_every : int  – Respostes netes consecutives per aplicar un increment.
+    decrease_factor : float  – Factor multiplicatiu en cada retall (0 < f < 1).
+    cooldown : float  – Segons mínims entre dos retalls (una ràfega d'errors
+                        provocada pel mateix episodi només retalla un cop).
+    """
+
+    def __init__(self, rate=2.0, min_rate=0.2, max_rate=20.0, burst=5.0,
+                 increase_step=0.1, increase_every=20, decrease_factor=0.5,
+                 cooldown=5.0):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.burst = burst
+        self.increase_step = increase_step
+        self.increase_every = increase_every
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._clean_streak = 0
+        self._last_cut = 0.0
+        self._adjustments = deque(maxlen=20)
+        self._counters = {"acquired": 0, "waited_s": 0.0, "increases": 0, "decreases": 0}
+
+    # ── Consum de tokens ──────────────────────────────────────────────
+
+    def reserve(self, max_wait: float | None = None) -> float | None:
+        """Reserva un token i retorna els segons que cal esperar per usar-lo.
+
+        Si l'espera hauria de ser de *max_wait* segons o més, no reserva
+        res i retorna ``None``.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1.0 else (1.0 - self._tokens) / self.rate
+            if max_wait is not None and wait >= max_wait:
+                return None
+            self._tokens -= 1.0
+            self._counters["acquired"] += 1
+            self._counters["waited_s"] += wait
+            return wait
+
+    def acquire(self, max_wait: float | None = None) -> bool:
+        """Bloqueja el fil fins que hi hagi un token disponible.
+
+        Retorna ``False`` (sense esperar ni gastar cap token) si caldria
+        esperar *max_wait* segons o més.
+        """
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def acquire_async(self, max_wait: float | None = None) -> bool:
+        """Equivalent asíncron d'``acquire``."""
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    # ── Senyals del SEPE ──────────────────────────────────────────────
+
+    def on_success(self) -> None:
+        """Resposta neta: increment additiu cada ``increase_every`` seguides."""
+        with self._lock:
+            self._clean_streak += 1
+            if self._clean_streak < self.increase_every or self.rate >= self.max_rate:
+                return
+            self._clean_streak = 0
+            self._set_rate(self.rate + self.increase_step, "respostes netes")
+            self._counters["increases"] += 1
+
+    def on_throttle(self, reason: str) -> None:
+        """Senyal de saturació (captcha, 5xx, timeout…): retall multiplicatiu."""
+        with self._lock:
+            self._clean_streak = 0
+            now = time.monotonic()
+            if now - self._last_cut < self.cooldown:
+                return
+            self._last_cut = now
+            self._set_rate(self.rate * self.decrease_factor, reason)
+            self._counters["decreases"] += 1
+            # Buidem el bucket perquè el retall tingui efecte immediat
+            self._tokens = min(self._tokens, 0.0)
+
+    def _set_rate(self, new_rate: float, reason: str) -> None:
+        old = self.rate
+        self.rate = min(max(new_rate, self.min_rate), self.max_rate)
+        if self.rate != old:
+            logger.info("Ritme SEPE %.2f → %.2f peticions/s (%s)", old, self.rate, reason)
+            self._adjustments.append({
+                "ts": time.time(),
+                "from": round(old, 3),
+                "to": round(self.rate, 3),
+                "reason": reason,
+            })
+
+    # ── Observabilitat ────────────────────────────────────────────────
+
+    def snapshot(self) -> dict:
+        """Estat actual del limitador (per a ``/api/server-info``)."""
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "min_rate": self.min_rate,
+                "max_rate": self.max_rate,
+                "acquired": self._counters["acquired"],
+                "waited_s": round(self._counters["waited_s"], 1),
+                "increases": self._counters["increases"],
+                "decreases": self._counters["decreases"],
+                "last_adjustment": self._adjustments[-1] if self._adjustments else None,
+                "adjustments": list(self._adjustments),
+            }
+
+
+def limiter_from_env() -> AdaptiveRateLimiter:
+    """Crea el limitador amb la configuració de les variables d'entorn ``SEPE_RATE_*``."""
+    return AdaptiveRateLimiter(
+        rate=_env_float("SEPE_RATE_INITIAL", 5.0),
+        min_rate=_env_float("SEPE_RATE_MIN", 0.2),
+        max_rate=_env_float("SEPE_RATE_MAX", 30.0),
+        burst=_env_float("SEPE_RATE_BURST", 5.0),
+        increase_step=_env_float("SEPE_RATE_STEP", 0.1),
+        decrease_factor=_env_float("SEPE_RATE_DECREASE", 0.5),
+    )
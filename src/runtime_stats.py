@@ -0,0 +1,53 @@
+"""
+Instantània de mètriques del worker compartida amb el procés web.
+
+El worker i gunicorn són processos diferents (vegeu ``supervisord.conf``),
+així que el worker publica periòdicament les seves mètriques en memòria
+(limitador de ritme, comptadors del client SEPE…) a un fitxer JSON que
+l'app Flask llegeix per a ``/api/server-info``.
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+STATS_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'runtime_stats.json')
+
+_lock = threading.Lock()
+
+
+def publish(sections):
+    """Substitueix les seccions indicades (``{nom: dict}``) de la instantània."""
+    with _lock:
+        current = read_stats()
+        current.update(sections)
+        current['updated_at'] = time.time()
+        try:
+            os.makedirs(os.path.dirname(STATS_FILE), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(STATS_FILE), text=True)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(current, f, ensure_ascii=False)
+            os.replace(tmp_path, STATS_FILE)
+        except Exception as e:
+            logger.error(f"Error publicant mètriques del worker: {e}")
+            if 'tmp_path' in locals() and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+
+def read_stats():
+    """Retorna l'última instantània publicada (``{}`` si encara no n'hi ha)."""
+    if not os.path.exists(STATS_FILE):
+        return {}
+    try:
+        with open(STATS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"Error llegint mètriques del worker: {e}")
+        return {}
@@ -0,0 +1,231 @@
+"""
+Planificador de cerques recurrents del worker.
+
+Manté un min-heap amb el moment de la pròxima execució de cada cerca
+activa, calculat un sol cop per canvi d'estat.  El worker només avalua
+les cerques que toquen (o les que tenen resultats pendents d'aplicar o
+acaben de canviar des de l'app web) i dorm fins a la primera que
+vencerà.  Així el cost de cada volta és proporcional a la feina que
+toca, no al nombre total de cerques en pausa.
+"""
+
+import heapq
+import os
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from src.search_service import MAX_RECURRENCE_HOURS, MAX_RECURRENCE_HOURS_DAILY
+
+# Cada quant es reconstrueix el heap sencer (xarxa de seguretat i
+# planificació de les hores diàries de les cerques noves)
+RESYNC_INTERVAL = int(os.getenv('SCHEDULER_RESYNC_INTERVAL', 60))
+
+# Finestra (minuts) al voltant de ``daily_time`` on es reparteixen les
+# cerques diàries perquè no arrenquin totes al mateix segon. 0 = sense repartir.
+DAILY_SPREAD_MINUTES = int(os.getenv('DAILY_SPREAD_MINUTES', 60))
+
+# Marge per a cerques que el heap dona per vençudes però que la
+# planificació no ha llançat (p. ex. desacord de rellotge al canvi d'hora)
+_MIN_RECHECK = 30
+
+
+def is_running(data):
+    """La cerca té un cicle començat (CPs pendents de la volta actual)."""
+    return data.get('current_zip_index', 0) > 0 or bool(data.get('cycle_start_time'))
+
+
+def next_run_at(data, now=None):
+    """Timestamp de la pròxima vegada que cal avaluar la cerca, o ``None``.
+
+    Reprodueix en forma de timestamp la lògica de freqüència del worker
+    (``once``, ``interval``, ``daily``) i hi afegeix el moment en què la
+    cerca expira pel límit de recurrència.
+    """
+    if not data or not data.get('active', False) or not data.get('zips'):
+        return None
+    now = time.time() if now is None else now
+
+    last_complete = data.get('last_cycle_time', 0)
+    if is_running(data) or last_complete == 0:
+        return now
+
+    freq_type = data.get('freq_type', 'once')
+    if freq_type == 'interval':
+        due = last_complete + float(data.get('interval_hours', 1)) * 3600
+    elif freq_type == 'daily':
+        due = _next_daily(data, last_complete, now)
+    else:
+        # 'once' ja acabada: el worker la desactiva a la pròxima avaluació
+        return now
+
+    created_at = data.get('created_at', 0)
+    if created_at:
+        max_h = MAX_RECURRENCE_HOURS_DAILY if freq_type == 'daily' else MAX_RECURRENCE_HOURS
+        due = min(due, created_at + max_h * 3600)
+    return due
+
+
+def _target_time(daily_time_str):
+    try:
+        return datetime.strptime(daily_time_str, '%H:%M').time()
+    except ValueError:
+        return datetime.strptime('09:00', '%H:%M').time()
+
+
+def _next_daily_day(last_complete, now):
+    """Dia de la pròxima execució diària: avui si encara no s'ha corregut."""
+    today = datetime.fromtimestamp(now).date()
+    if datetime.fromtimestamp(last_complete).date() < today:
+        return today
+    return today + timedelta(days=1)
+
+
+def _next_daily(data, last_complete, now):
+    """Inici de la pròxima execució diària (l'hora repartida si n'hi ha)."""
+    day = _next_daily_day(last_complete, now)
+    if data.get('planned_day') == day.isoformat() and data.get('planned_start'):
+        return data['planned_start']
+    return datetime.combine(day, _target_time(data.get('daily_time', '09:00'))).timestamp()
+
+
+def next_daily_run(data, now=None):
+    """Timestamp a partir del qual una cerca diària ja acabada torna a tocar."""
+    now = time.time() if now is None else now
+    return _next_daily(data, data.get('last_cycle_time', 0), now)
+
+
+def plan_daily_starts(searches, capacity, now=None):
+    """Reparteix les cerques diàries dins de ``DAILY_SPREAD_MINUTES``.
+
+    Model de capacitat: el worker pot fer *capacity* comprovacions per
+    segon, és a dir ``capacity·60`` per minut.  Cada cerca que encara no
+    té hora planificada per al seu pròxim dia s'assigna al primer minut de
+    la finestra (centrada a ``daily_time``) on les seves comprovacions hi
+    caben, amb un jitter estable dins del minut.  Les hores ja
+    planificades no es mouen.  Desa ``planned_start``/``planned_day`` a
+    cada cerca i retorna el conjunt de DNIs que ha planificat.
+    """
+    if DAILY_SPREAD_MINUTES <= 0:
+        return set()
+    now = time.time() if now is None else now
+    per_minute = max(capacity * 60, 1.0)
+    load: dict[int, float] = {}
+    unplanned = []
+
+    for dni, data in searches.items():
+        if (not data.get('active') or data.get('freq_type') != 'daily' or not data.get('zips')
+                or is_running(data) or not data.get('last_cycle_time')):
+            continue
+        day = _next_daily_day(data['last_cycle_time'], now)
+        if data.get('planned_day') == day.isoformat() and data.get('planned_start'):
+            minute = int(data['planned_start'] // 60)
+            load[minute] = load.get(minute, 0) + len(data['zips'])
+        else:
+            unplanned.append((data.get('created_at', 0), dni, data, day))
+
+    for _, dni, data, day in sorted(unplanned, key=lambda u: (u[0], u[1])):
+        target = datetime.combine(day, _target_time(data.get('daily_time', '09:00'))).timestamp()
+        half = DAILY_SPREAD_MINUTES * 30
+        first = int(max(target - half, now) // 60)
+        last = max(int((target + half) // 60), first)
+        checks = len(data['zips'])
+        minutes = range(first, last + 1)
+        minute = next((m for m in minutes if load.get(m, 0) + checks <= per_minute),
+                      min(minutes, key=lambda m: load.get(m, 0)))
+        load[minute] = load.get(minute, 0) + checks
+        jitter = zlib.crc32(f"{dni}:{day.isoformat()}".encode()) % 60
+        data['planned_start'] = max(minute * 60 + jitter, now)
+        data['planned_day'] = day.isoformat()
+    return {dni for _, dni, _, _ in unplanned}
+
+
+class SearchScheduler:
+    """Min-heap de ``(pròxima_execució, dni)``.
+
+    Les entrades velles no s'esborren del heap: ``_next`` té el valor
+    vigent de cada cerca i les que no hi coincideixen s'ignoren en treure-les.
+    """
+
+    def __init__(self, capacity=None, resync_interval=RESYNC_INTERVAL):
+        # Funció que retorna les comprovacions/segon que el worker sosté
+        self.capacity = capacity
+        self.resync_interval = resync_interval
+        self._heap: list[tuple[float, str]] = []
+        self._next: dict[str, float] = {}
+        self._synced_at = 0.0
+
+    def needs_rebuild(self):
+        """Toca la resincronització periòdica del heap sencer."""
+        return time.time() - self._synced_at >= self.resync_interval
+
+    def rebuild(self, searches):
+        """Recalcula el heap sencer a partir de l'estat acabat de llegir.
+
+        Abans planifica l'hora d'inici de les cerques diàries noves; retorna
+        les que ha modificat (i per tant cal desar).
+        """
+        now = time.time()
+        changed = set()
+        if self.capacity is not None:
+            changed = plan_daily_starts(searches, self.capacity(), now)
+        self._next = {}
+        for dni, data in searches.items():
+            due = next_run_at(data, now)
+            if due is not None:
+                self._next[dni] = due
+        self._heap = [(due, dni) for dni, due in self._next.items()]
+        heapq.heapify(self._heap)
+        self._synced_at = now
+        return changed
+
+    def update(self, dni, data):
+        """Cerca canviada per fora (creada, aturada, reiniciada o esborrada)."""
+        due = next_run_at(data)
+        if due is None:
+            self._next.pop(dni, None)
+            return
+        self._next[dni] = due
+        heapq.heappush(self._heap, (due, dni))
+
+    def reschedule(self, dni, data, queued=False):
+        """Torna a calcular la pròxima execució d'una cerca ja avaluada.
+
+        Una cerca en marxa que ja és a la cua de treball (*queued*: CPs en
+        vol o esperant forat) surt del heap: la tornarà a portar el pròxim
+        resultat que arribi.
+        """
+        now = time.time()
+        due = next_run_at(data, now)
+        if due is None or (queued and is_running(data)):
+            self._next.pop(dni, None)
+            return
+        if due <= now and not is_running(data):
+            # Vençuda però la planificació no l'ha llançada: no la reavaluem a cada volta
+            due = now + _MIN_RECHECK
+        self._next[dni] = due
+        heapq.heappush(self._heap, (due, dni))
+
+    def pop_due(self, now=None):
+        """Treu del heap i retorna el conjunt de cerques vençudes."""
+        now = time.time() if now is None else now
+        due = set()
+        while self._heap and self._heap[0][0] <= now:
+            ts, dni = heapq.heappop(self._heap)
+            if self._next.get(dni) == ts:
+                del self._next[dni]
+                due.add(dni)
+        return due
+
+    def next_due(self):
+        """Timestamp de la cerca que vencerà primer (o ``None``)."""
+        while self._heap and self._next.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def has_due(self, now=None):
+        due = self.next_due()
+        return due is not None and due <= (time.time() if now is None else now)
+
+    def __len__(self):
+        return len(self._next)
@@ -0,0 +1,123 @@
+"""
+Arxiu (emmagatzematge fred) de les cerques acabades.
+
+La política de retenció de ``search_service`` hi mou el que les cerques
+inactives ja no necessiten tenir a l'estat: els camps pesants d'una cerca
+acabada (``zips``…) i, quan caduca o sobrepassa el límit per propietari,
+el registre sencer.  Cada entrada és una línia de
+``data/search_archive.jsonl``: ``{"ts", "dni", "run_id", "reason", "fields"}``.
+Les línies s'afegeixen per la cua; llegir-lo només cal per reiniciar una
+cerca arxivada.  ``compact`` i ``purge`` el reescriuen sencer (fitxer
+temporal + ``os.replace``) per treure'n el que ja no cal, de manera que
+no creix sense límit.  Totes les escriptures passen pel lock de fitxer
+(``search_archive.lock``): el worker i el procés web hi escriuen alhora.
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows (desenvolupament): només lock entre fils
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'search_archive.jsonl')
+LOCK_FILE = ARCHIVE_FILE.replace('.jsonl', '.lock')
+
+_lock = threading.Lock()
+
+
+@contextmanager
+def _file_locked():
+    with _lock:
+        os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+        with open(LOCK_FILE, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def append(dni, reason, fields):
+    """Afegeix a l'arxiu *fields* (un tros o tot el registre) de la cerca *dni*.
+
+    Llança l'excepció si no es pot escriure: el que no s'ha arxivat no
+    s'ha de treure de l'estat.
+    """
+    line = json.dumps({'ts': int(time.time()), 'dni': dni, 'run_id': fields.get('run_id'),
+                       'reason': reason, 'fields': fields},
+                      ensure_ascii=False, separators=(',', ':'))
+    with _file_locked():
+        with open(ARCHIVE_FILE, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def find(dni, run_id):
+    """Camps arxivats de l'execució *run_id* de *dni*, fusionats (``None`` si no n'hi ha)."""
+    found = None
+    try:
+        f = open(ARCHIVE_FILE, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    with f:
+        for line in f:
+            if dni not in line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Línia tallada (escriptura interrompuda)
+            if entry.get('dni') == dni and entry.get('run_id') == run_id:
+                found = {**(found or {}), **entry.get('fields', {})}
+    return found
+
+
+def compact(select):
+    """Reescriu l'arxiu amb les entrades que *select* en conserva.
+
+    *select* rep la llista d'entrades (en ordre) i en retorna les que
+    s'han de guardar.  Les línies il·legibles es descarten.  Retorna
+    quantes línies s'han tret; si no en sobra cap, el fitxer no es toca.
+    Llança ``OSError`` si no es pot reescriure.
+    """
+    with _file_locked():
+        try:
+            with open(ARCHIVE_FILE, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return 0
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        kept = select(entries)
+        removed = len(lines) - len(kept)
+        if not removed:
+            return 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(ARCHIVE_FILE), text=True)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for entry in kept:
+                    f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+            os.replace(tmp_path, ARCHIVE_FILE)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return removed
+
+
+def purge(dni):
+    """Esborra de l'arxiu totes les entrades de *dni*. Retorna quantes n'ha tret."""
+    return compact(lambda entries: [e for e in entries if e.get('dni') != dni])
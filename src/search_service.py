@@ -9,8 +9,11 @@ import random
 import logging
 from datetime import datetime, timedelta
 
-from src.state import load_state, save_state
+from src.state import (locked_state, query_searches, count_searches, get_search,
+                       update_search, ConflictError)
 from src.locations import LocationManager
+from src.sepe_api import office_target
+from src import runtime_stats, search_archive
 
 # Límit màxim de recurrència (en hores). Si una cerca recurrent porta
 # més d'aquest temps activa, s'atura automàticament perquè l'usuari
@@ -18,6 +21,18 @@ from src.locations import LocationManager
 MAX_RECURRENCE_HOURS = int(os.getenv('MAX_RECURRENCE_HOURS', 24))
 MAX_RECURRENCE_HOURS_DAILY = int(os.getenv('MAX_RECURRENCE_HOURS_DAILY', 168))  # 1 setmana
 
+# Retenció de les cerques acabades (vegeu ``sweep_retention``): hores
+# abans de moure'n els camps pesants a l'arxiu, dies abans d'esborrar-les
+# de l'estat i quantes se'n guarden per propietari (0 ho desactiva)
+SEARCH_ARCHIVE_AFTER_HOURS = float(os.getenv('SEARCH_ARCHIVE_AFTER_HOURS', 1))
+SEARCH_RETENTION_DAYS = float(os.getenv('SEARCH_RETENTION_DAYS', 30))
+MAX_INACTIVE_PER_OWNER = int(os.getenv('MAX_INACTIVE_SEARCHES_PER_OWNER', 20))
+# Dies que es guarden a l'arxiu les cerques esborrades per la retenció (0: sempre)
+SEARCH_ARCHIVE_KEEP_DAYS = float(os.getenv('SEARCH_ARCHIVE_KEEP_DAYS', 90))
+
+# Camps que una cerca acabada només necessita per tornar-se a executar
+ARCHIVED_FIELDS = ('zips', 'email')
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,9 +40,12 @@ logger = logging.getLogger(__name__)
 # Creació de cerques
 # ---------------------------------------------------------------------------
 
-def resolve_zips(scope, value, extra_context=None):
+def resolve_zips(scope, value, extra_context=None, subtramite=None, channels=()):
     """Resol una selecció d'àmbit a una llista de codis postals.
 
+    Amb *subtramite* i *channels* es descarten els CPs que no hi tenen
+    oficines.
+
     Returns:
         tuple: (zips_list, scope_name, error_message)
     """
@@ -50,7 +68,7 @@ def resolve_zips(scope, value, extra_context=None):
             return [], None, "Has de seleccionar una Comunitat Autònoma."
         scope_name = f"Comunitats: {', '.join(value)}"
 
-    zips = LocationManager.get_zips(scope, value, extra_context)
+    zips = LocationManager.get_zips(scope, value, extra_context, subtramite, channels)
     if not zips:
         return [], scope_name, "No s'han trobat codis postals per a aquesta selecció."
 
@@ -66,26 +84,20 @@ def create_search(dni, email, appt_types, scope, value, extra_context,
     Returns:
         dict: {'ok': bool, 'message': str, 'zips_count': int}
     """
-    all_searches = load_state()
-
     # Límit global
-    total_active = sum(1 for d in all_searches.values() if d.get('active', False))
+    total_active = count_searches(active=True)
     if total_active >= max_concurrent:
         return {'ok': False, 'message': f"El servidor ha arribat al límit de {max_concurrent} cerques simultànies."}
 
     # DNI ja actiu?
-    if dni in all_searches and all_searches[dni].get('active', False):
-        if all_searches[dni].get('owner_id') == owner_id:
-            return {'ok': False, 'message': f"Ja existeix una cerca activa per al DNI {dni}. Atura-la primer."}
-        else:
-            return {'ok': False, 'message': f"Ja existeix una cerca activa per al DNI {dni} (d'un altre dispositiu)."}
-
-    # Netejar cerca anterior inactiva si és nostra
-    if dni in all_searches and all_searches[dni].get('owner_id') == owner_id:
-        del all_searches[dni]
+    existing, _ = get_search(dni)
+    active_error = _active_conflict(existing, dni, owner_id)
+    if active_error:
+        return {'ok': False, 'message': active_error}
 
     # Resoldre codis postals
-    zips, scope_name, error = resolve_zips(scope, value, extra_context)
+    subtramite, channels = office_target(tramite_id, appt_types)
+    zips, scope_name, error = resolve_zips(scope, value, extra_context, subtramite, channels)
     if error:
         return {'ok': False, 'message': f"Error: {error}"}
 
@@ -99,7 +111,8 @@ def create_search(dni, email, appt_types, scope, value, extra_context,
     elif freq_type == 'daily':
         frequency = -2
 
-    all_searches[dni] = {
+    # Substitueix la cerca anterior inactiva si n'hi havia
+    search = {
         'zips': zips,
         'current_zip_index': 0,
         'email': email,
@@ -119,7 +132,20 @@ def create_search(dni, email, appt_types, scope, value, extra_context,
         'owner_id': owner_id,
         'created_at': time.time(),
     }
-    save_state(all_searches)
+
+    def _replace(current):
+        # Entre la comprovació i l'escriptura algú pot haver-la activat
+        error = _active_conflict(current, dni, owner_id)
+        if error:
+            return error, current
+        return None, search
+
+    try:
+        active_error = update_search(dni, _replace)
+    except ConflictError:
+        return {'ok': False, 'message': _CONFLICT_MESSAGE}
+    if active_error:
+        return {'ok': False, 'message': active_error}
 
     types_str = ' i '.join(['Presencial' if t == 'person' else 'Telefònica' for t in appt_types])
     return {
@@ -135,47 +161,80 @@ def create_search(dni, email, appt_types, scope, value, extra_context,
 # Accions sobre cerques existents
 # ---------------------------------------------------------------------------
 
+def _active_conflict(existing, dni, owner_id):
+    """Missatge d'error si ja hi ha una cerca activa per al DNI."""
+    if not existing or not existing.get('active', False):
+        return None
+    if existing.get('owner_id') == owner_id:
+        return f"Ja existeix una cerca activa per al DNI {dni}. Atura-la primer."
+    return f"Ja existeix una cerca activa per al DNI {dni} (d'un altre dispositiu)."
+
+
+_CONFLICT_MESSAGE = "La cerca s'està actualitzant, torna-ho a provar."
+
+
+def _update_owned(dni, owner_id, change, message):
+    """Aplica *change* a la cerca de *owner_id* amb una actualització optimista.
+
+    *change(search)* modifica la cerca in situ (o retorna ``None`` per
+    esborrar-la).  Si el worker la desa entremig, es torna a aplicar
+    sobre la versió nova.  Retorna ``(ok, message)``.
+    """
+    def mutate(search):
+        if not search or search.get('owner_id') != owner_id:
+            return (False, "DNI no trobat"), search
+        return (True, message), change(search)
+
+    try:
+        return update_search(dni, mutate)
+    except ConflictError:
+        return False, _CONFLICT_MESSAGE
+
+
 def stop_search(dni, owner_id):
     """Atura una cerca. Retorna (ok, message)."""
-    all_searches = load_state()
-    search = all_searches.get(dni)
-    if not search or search.get('owner_id') != owner_id:
-        return False, "DNI no trobat"
-    search['active'] = False
-    search['status_message'] = "Aturat manualment"
-    search['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
-    save_state(all_searches)
-    return True, "Cerca aturada"
+    def change(search):
+        search['active'] = False
+        search['status_message'] = "Aturat manualment"
+        search['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
+        return search
+    return _update_owned(dni, owner_id, change, "Cerca aturada")
 
 
 def restart_search(dni, owner_id):
     """Reinicia una cerca. Retorna (ok, message)."""
-    all_searches = load_state()
-    search = all_searches.get(dni)
-    if not search or search.get('owner_id') != owner_id:
-        return False, "DNI no trobat"
-    search['active'] = True
-    search['current_zip_index'] = 0
-    search['cycle_start_time'] = None
-    search['finished_at'] = None
-    search['status_message'] = 'Reiniciant...'
-    search['last_cycle_time'] = 0
-    search['run_id'] = time.time()
-    search['created_at'] = time.time()  # Reset rellotge de recurrència
-    search['last_success'] = None
-    save_state(all_searches)
-    return True, "Cerca reiniciada"
+    def mutate(search):
+        if not search or search.get('owner_id') != owner_id:
+            return (False, "DNI no trobat"), search
+        # Arxivada per la retenció: primer se'n recuperen els CPs i el correu
+        if search.get('archived_at') and not _unarchive(dni, search):
+            return (False, "No s'han trobat les dades arxivades d'aquesta cerca. Crea-la de nou."), search
+        search['active'] = True
+        search['current_zip_index'] = 0
+        search['cycle_start_time'] = None
+        search['finished_at'] = None
+        search['status_message'] = 'Reiniciant...'
+        search['last_cycle_time'] = 0
+        search['run_id'] = time.time()
+        search['created_at'] = time.time()  # Reset rellotge de recurrència
+        search['last_success'] = None
+        return (True, "Cerca reiniciada"), search
+
+    try:
+        return update_search(dni, mutate)
+    except ConflictError:
+        return False, _CONFLICT_MESSAGE
 
 
 def delete_search(dni, owner_id):
-    """Elimina una cerca. Retorna (ok, message)."""
-    all_searches = load_state()
-    search = all_searches.get(dni)
-    if not search or search.get('owner_id') != owner_id:
-        return False, "DNI no trobat"
-    del all_searches[dni]
-    save_state(all_searches)
-    return True, "Cerca eliminada"
+    """Elimina una cerca i el que en quedi a l'arxiu. Retorna (ok, message)."""
+    ok, message = _update_owned(dni, owner_id, lambda search: None, "Cerca eliminada")
+    if ok:
+        try:
+            search_archive.purge(dni)
+        except OSError as e:
+            logger.error(f"No s'han pogut esborrar de l'arxiu les dades de la cerca {dni}: {e}")
+    return ok, message
 
 
 # ---------------------------------------------------------------------------
@@ -184,19 +243,18 @@ def delete_search(dni, owner_id):
 
 def get_searches_for_owner(owner_id):
     """Retorna les cerques que pertanyen a un owner_id, amb migració automàtica."""
-    all_searches = load_state()
+    my_searches = query_searches(owner_id=owner_id, orphans=True)
 
     # Migració: cerques sense owner_id → adoptar
-    adopted = False
-    for data in all_searches.values():
-        if 'owner_id' not in data:
-            data['owner_id'] = owner_id
-            adopted = True
-    if adopted:
-        save_state(all_searches)
+    if any('owner_id' not in data for data in my_searches.values()):
+        with locked_state() as all_searches:
+            for data in all_searches.values():
+                data.setdefault('owner_id', owner_id)
+        # Els registres consultats són de només lectura: se'n fa una còpia
+        my_searches = {dni: data if 'owner_id' in data else {**data, 'owner_id': owner_id}
+                       for dni, data in my_searches.items()}
 
-    return {dni: data for dni, data in all_searches.items()
-            if data.get('owner_id') == owner_id}
+    return my_searches
 
 
 def get_status_for_owner(owner_id):
@@ -226,13 +284,14 @@ def get_status_for_owner(owner_id):
 
         status[dni] = {
             'current_zip': curr_zip,
-            'total_zips': len(zips),
+            'total_zips': data.get('zips_count', len(zips)),
             'current_index': idx,
             'active': is_active,
             'last_duration': data.get('last_duration', 'N/A'),
             'status_message': data.get('status_message', ''),
             'last_result_message': data.get('last_result_message', ''),
             'next_run_time': next_run_time,
+            'planned_start': data.get('planned_start'),
             'freq_type': freq_type,
             'scope_name': data.get('scope_name', ''),
             'cycle_start_time': data.get('cycle_start_time'),
@@ -240,6 +299,7 @@ def get_status_for_owner(owner_id):
             'created_at': created_at,
             'is_expired': is_expired,
             'last_success': data.get('last_success'),
+            'sepe_calls': data.get('sepe_calls', 0),
             'max_recurrence_hours': max_h,
         }
     return status
@@ -247,8 +307,7 @@ def get_status_for_owner(owner_id):
 
 def get_server_info():
     """Retorna informació global del servidor (sense dades privades)."""
-    all_searches = load_state()
-    active = [d for d in all_searches.values() if d.get('active', False)]
+    active = list(query_searches(active=True).values())
     total_active = len(active)
 
     # Cerques que estan realment executant-se (no en pausa)
@@ -271,17 +330,202 @@ def get_server_info():
     else:
         level = 'low'
 
+    # Ritme actual cap al SEPE (publicat pel worker) i motiu dels ajustos
+    worker_stats = runtime_stats.read_stats()
+
     return {
         'active_searches': total_active,
         'running_now': running,
         'paused': total_active - running,
-        'total_searches': len(all_searches),
+        'total_searches': count_searches(),
         'max_concurrent': max_concurrent,
         'load_pct': min(load_pct, 100),
         'level': level,
+        'sepe_rate': worker_stats.get('rate_limiter'),
+        'sepe_circuit': worker_stats.get('circuit_breaker'),
+        'worker_concurrency': worker_stats.get('autoscaler'),
     }
 
 
+# ---------------------------------------------------------------------------
+# Retenció de cerques acabades
+# ---------------------------------------------------------------------------
+
+def sweep_retention(now=None):
+    """Aplica la política de retenció a les cerques inactives (el worker, periòdicament).
+
+    * Acabada fa més de ``SEARCH_ARCHIVE_AFTER_HOURS``: els ``ARCHIVED_FIELDS``
+      (la llista de CPs, sobretot) passen a l'arxiu i a l'estat en queda
+      ``zips_count``; reiniciar-la els recupera.
+    * Acabada fa més de ``SEARCH_RETENTION_DAYS`` o més enllà de les
+      ``MAX_INACTIVE_PER_OWNER`` més recents del propietari: el registre
+      sencer passa a l'arxiu i s'esborra de l'estat.  Les cerques sense
+      ``owner_id`` no són de ningú en concret i només caduquen pel temps.
+
+    Les cerques actives no es toquen mai, i cada canvi és una actualització
+    optimista: si l'usuari la reinicia entremig, es deixa estar.  Al final
+    es compacta l'arxiu (vegeu ``_compact_archive``).
+
+    Returns:
+        dict: {'archived': int, 'evicted': int, 'compacted': int}
+    """
+    now = now or time.time()
+    # Les línies escrites a partir d'ara (aquest o un altre worker) es guarden
+    since = int(time.time()) - 1
+    inactive = query_searches(active=False)
+    finished = {dni: _finished_ts(data) for dni, data in inactive.items()}
+
+    evict = {}
+    if SEARCH_RETENTION_DAYS > 0:
+        for dni, ts in finished.items():
+            if ts is not None and now - ts > SEARCH_RETENTION_DAYS * 86400:
+                evict[dni] = 'ttl'
+    if MAX_INACTIVE_PER_OWNER > 0:
+        by_owner = {}
+        for dni, data in inactive.items():
+            if dni not in evict and data.get('owner_id') is not None:
+                by_owner.setdefault(data['owner_id'], []).append(dni)
+        for dnis in by_owner.values():
+            dnis.sort(key=lambda d: finished[d] or 0, reverse=True)
+            for dni in dnis[MAX_INACTIVE_PER_OWNER:]:
+                evict[dni] = 'owner_cap'
+
+    counts = {'archived': 0, 'evicted': 0}
+    for dni, data in inactive.items():
+        ts = finished[dni]
+        try:
+            if dni in evict:
+                counts['evicted'] += _evict(dni, data.get('run_id'), evict[dni])
+            elif (SEARCH_ARCHIVE_AFTER_HOURS > 0 and ts is not None
+                  and now - ts > SEARCH_ARCHIVE_AFTER_HOURS * 3600
+                  and any(key in data for key in ARCHIVED_FIELDS)):
+                counts['archived'] += _archive_fields(dni, data.get('run_id'))
+        except ConflictError:
+            logger.info(f"Retenció: la cerca {dni} ha canviat entremig, es deixa per al pròxim escombrat")
+        except OSError as e:
+            logger.error(f"Retenció: error escrivint l'arxiu de cerques: {e}")
+            break
+
+    try:
+        counts['compacted'] = _compact_archive(now, since)
+    except OSError as e:
+        logger.error(f"Retenció: error compactant l'arxiu de cerques: {e}")
+        counts['compacted'] = 0
+    return counts
+
+
+def _compact_archive(now, since):
+    """Treu de l'arxiu les entrades que ja no poden servir. Retorna quantes línies.
+
+    Es guarden els camps arxivats de les cerques que encara són a l'estat
+    com a arxivades (reiniciar-les els necessita) i els registres esborrats
+    per la retenció durant ``SEARCH_ARCHIVE_KEEP_DAYS``, amb els camps
+    que se n'havien arxivat abans.  Les línies de després de *since* no es
+    toquen: poden ser d'un arxivat que la consulta a l'estat encara no veu.
+    """
+    archived = {(dni, data.get('run_id')) for dni, data in query_searches(active=False).items()
+                if data.get('archived_at')}
+    horizon = now - SEARCH_ARCHIVE_KEEP_DAYS * 86400 if SEARCH_ARCHIVE_KEEP_DAYS > 0 else None
+
+    def select(entries):
+        keep = set(archived)
+        keep.update((e.get('dni'), e.get('run_id')) for e in entries
+                    if e.get('reason') != 'inactive' and (horizon is None or e.get('ts', 0) >= horizon))
+        return [e for e in entries
+                if e.get('ts', 0) >= since or (e.get('dni'), e.get('run_id')) in keep]
+
+    return search_archive.compact(select)
+
+
+def _finished_ts(data):
+    """Quan va acabar la cerca (timestamp), o ``None`` si no es pot saber."""
+    try:
+        return datetime.strptime(data['finished_at'], '%d/%m/%Y %H:%M').timestamp()
+    except (KeyError, TypeError, ValueError):
+        pass
+    # Sense finished_at (cerques antigues): l'últim rastre que en tinguem
+    for key in ('last_cycle_time', 'created_at', 'run_id'):
+        if data.get(key):
+            return data[key]
+    return None
+
+
+def _still_retired(search, run_id):
+    """La cerca continua inactiva i és la mateixa execució que s'ha avaluat."""
+    return bool(search) and not search.get('active') and search.get('run_id') == run_id
+
+
+def _archive_fields(dni, run_id):
+    """Mou els ``ARCHIVED_FIELDS`` de *dni* a l'arxiu. Retorna si s'ha fet."""
+    def mutate(search):
+        if not _still_retired(search, run_id) or search.get('archived_at'):
+            return None, search
+        cold = {key: search.pop(key) for key in ARCHIVED_FIELDS if key in search}
+        search['zips_count'] = len(cold.get('zips', []))
+        search['archived_at'] = time.time()
+        return cold, search
+
+    def undo(search):
+        if not _still_retired(search, run_id) or not search.get('archived_at'):
+            return None, search
+        search.update(cold)
+        search.pop('archived_at', None)
+        search.pop('zips_count', None)
+        return None, search
+
+    cold = update_search(dni, mutate)
+    if cold is None:
+        return False
+    _archive_or_undo(dni, 'inactive', {'run_id': run_id, **cold}, undo)
+    return True
+
+
+def _evict(dni, run_id, reason):
+    """Arxiva el registre sencer de *dni* i l'esborra de l'estat. Retorna si s'ha fet."""
+    def mutate(search):
+        if not _still_retired(search, run_id):
+            return None, search
+        return {k: v for k, v in search.items() if k != '_rev'}, None
+
+    record = update_search(dni, mutate)
+    if record is None:
+        return False
+    # Si no es pot arxivar, es torna a crear (llevat que ja n'hi hagi una de nova)
+    _archive_or_undo(dni, reason, record, lambda search: (None, search or record))
+    logger.info(f"Retenció: cerca {dni} arxivada i esborrada ({reason})")
+    return True
+
+
+def _archive_or_undo(dni, reason, fields, undo):
+    """Escriu a l'arxiu el que s'acaba de treure de l'estat.
+
+    L'arxiu només s'escriu un cop desat el canvi (un reintent o un
+    conflicte no hi deixen línies de més).  Si no s'hi pot escriure, el
+    canvi es desfà amb ``update_search(dni, undo)`` i l'error es propaga.
+    """
+    try:
+        search_archive.append(dni, reason, fields)
+    except OSError:
+        try:
+            update_search(dni, undo)
+        except ConflictError:
+            logger.error(f"Retenció: no s'ha pogut restaurar la cerca {dni} després de fallar l'arxiu")
+        raise
+
+
+def _unarchive(dni, search):
+    """Torna a posar a *search* els camps arxivats. Retorna si s'ha pogut."""
+    cold = search_archive.find(dni, search.get('run_id'))
+    if not cold or 'zips' not in cold:
+        return False
+    for key in ARCHIVED_FIELDS:
+        if key in cold:
+            search[key] = cold[key]
+    search.pop('archived_at', None)
+    search.pop('zips_count', None)
+    return True
+
+
 # ---------------------------------------------------------------------------
 # Helpers interns
 # ---------------------------------------------------------------------------
@@ -296,6 +540,9 @@ def _calc_next_run(freq_type, last_complete, data):
         interval_hours = float(data.get('interval_hours', 1))
         next_ts = last_complete + (interval_hours * 3600)
         next_dt = datetime.fromtimestamp(next_ts)
+    elif freq_type == 'daily' and (data.get('planned_start') or 0) > now.timestamp():
+        # Hora real d'inici, repartida pel worker dins de la finestra diària
+        next_dt = datetime.fromtimestamp(data['planned_start'])
     elif freq_type == 'daily':
         daily_time_str = data.get('daily_time', '09:00')
         try:
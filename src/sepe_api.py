@@ -11,18 +11,62 @@ navegador:
 
 Cada crida manté la sessió (JSESSIONID) que el servidor utilitza per
 rastrejar l'estat de la conversa.
+
+Amb ``SEPE_SESSION_REUSE`` activat (per defecte) cada fil conserva una
+sessió "calenta" (cookies + connexió keep-alive) entre comprovacions i
+només repeteix els passos que depenen del CP/DNI.  Si el SEPE rebutja
+el JSESSIONID reutilitzat, es reconstrueix la sessió des de zero.
 """
 
+import json
 import logging
+import os
+import random
 import re
+import threading
+import time
+from concurrent.futures import Future
+
 import requests
 
+from src.rate_limiter import limiter_from_env
+from src.circuit_breaker import breaker_from_env
+from src.metrics import SepeMetrics
+from src import dead_zips
+from src import zip_history
+from src import slot_history
+
 logger = logging.getLogger(__name__)
 
-BASE = "https://citaprevia-sede.sepe.gob.es/citapreviasepe"
+# Es pot apuntar a un SEPE fals (scripts/fake_sepe.py) per a proves i benchmarks
+BASE = os.getenv("SEPE_BASE_URL", "https://citaprevia-sede.sepe.gob.es/citapreviasepe").rstrip("/")
+LANDING_PATH = "/?origen=sepe&codidioma=es"
+OFFICES_PATH = "/cita/cargaOficinasMapa"
 
-# Timeout per a cada petició HTTP (segons)
+# Timeout màxim per a cada petició HTTP (segons)
 REQUEST_TIMEOUT = 20
+# Pressupost total d'una comprovació (segons), compartit per tota la cadena:
+# cada petició només pot gastar el temps que en queda.
+CHECK_DEADLINE = float(os.getenv("SEPE_CHECK_DEADLINE", 45))
+# Reintents (amb jitter) dels passos idempotents després d'un error de
+# transport o un 5xx, i base del backoff exponencial (segons)
+RETRY_ATTEMPTS = int(os.getenv("SEPE_RETRIES", 1))
+RETRY_BASE_DELAY = float(os.getenv("SEPE_RETRY_BASE", 0.5))
+
+# Reutilització de sessions per fil (0 = sessió nova a cada comprovació)
+SESSION_REUSE = os.getenv("SEPE_SESSION_REUSE", "1").lower() not in ("0", "false", "no")
+# Edat màxima d'una sessió reutilitzada abans de descartar-la (segons)
+SESSION_MAX_AGE = int(os.getenv("SEPE_SESSION_MAX_AGE", 600))
+
+# Vida (segons) de la cache de disponibilitat per (CP, subtràmit, canal).
+# 0 desactiva la cache.
+AVAILABILITY_CACHE_TTL = int(os.getenv("SEPE_AVAILABILITY_TTL", 90))
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/125.0.0.0 Safari/537.36"
+)
 
 # Mapa de nivel‑2 IDs (els que l'usuari tria al UI) → subtràmit ID
 # (el que SEPE necessita com a ``idGrupoServicio``).
@@ -42,13 +86,264 @@ DEFAULT_SUBTRAMITE = "8"
 CHANNEL_PRESENCIAL = "1"
 CHANNEL_TELEFONICA = "3"
 
+# Sessió calenta de cada fil: {'session': Session, 'created': ts}
+_thread_local = threading.local()
+
+# Comptadors globals (tots els fils) per veure l'estalvi de la reutilització
+_stats_lock = threading.Lock()
+_session_stats = {
+    "checks": 0,
+    "round_trips": 0,
+    "sessions_reused": 0,
+    "sessions_created": 0,
+    "sessions_rejected": 0,
+    "cache_hits": 0,
+    "cache_confirms": 0,
+    "executed": 0,
+    "coalesced": 0,
+}
+
+
+class SessionExpiredError(Exception):
+    """El SEPE ha rebutjat el JSESSIONID d'una sessió reutilitzada."""
+
+
+class InvalidZipError(ValueError):
+    """``existeCP`` diu que el codi postal no existeix per al SEPE."""
+
+
+class SepeUnavailableError(Exception):
+    """El SEPE no respon: error de transport, timeout o HTTP 5xx."""
+
+
+class CaptchaError(SepeUnavailableError):
+    """``cargaOficinasMapa`` ha retornat ``ErrorCaptcha``.
+
+    És un senyal de saturació, no una resposta: el CP queda "desconegut"
+    i es torna a provar, no es dona per comprovat sense oficines.
+    """
+
+
+class BadResponseError(SepeUnavailableError):
+    """``cargaOficinasMapa`` ha retornat una cosa que no és JSON (p. ex. una pàgina d'error)."""
+
+
+class CircuitOpenError(SepeUnavailableError):
+    """El circuit breaker està obert i la petició no s'ha fet."""
+
+
+class DeadlineExceededError(SepeUnavailableError):
+    """S'ha esgotat el pressupost de temps de la comprovació."""
+
+
+class CheckCancelledError(Exception):
+    """La comprovació s'ha cancel·lat (cerca acabada, aturada o reiniciada)."""
+
+
+class CancelToken:
+    """Senyal de cancel·lació cooperativa per a les comprovacions en vol.
+
+    El worker en comparteix un entre totes les comprovacions d'una cerca
+    i el cancel·la quan el resultat ja no serveix; ``check_zip`` el mira
+    abans de cada petició i se salta la resta de la cadena.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = ""
+
+    def cancel(self, reason: str = "cancel·lada") -> None:
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+
+class _AvailabilityCache:
+    """Cache amb TTL del resultat de ``cargaOficinasMapa``.
+
+    La llista d'oficines i el ``primerHuecoDisponible`` depenen només de
+    (CP, subtràmit, canal), no del DNI, així que totes les cerques que
+    cobreixen el mateix CP poden compartir una sola consulta per finestra.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, tuple[float, list[dict]]] = {}
+
+    def get(self, key: tuple) -> list[dict] | None:
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, offices = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            return offices
+
+    def put(self, key: tuple, offices: list[dict]) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), offices)
+            # Purga d'entrades caducades perquè el dict no creixi sense límit
+            if len(self._entries) > 5000:
+                now = time.time()
+                self._entries = {k: v for k, v in self._entries.items()
+                                 if now - v[0] <= self.ttl}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_availability_cache = _AvailabilityCache(AVAILABILITY_CACHE_TTL)
+
+# Limitador de ritme compartit per totes les peticions al SEPE (sync i async)
+rate_limiter = limiter_from_env()
+
+# Circuit breaker compartit: talla les peticions mentre el SEPE està caigut
+circuit_breaker = breaker_from_env()
+
+# Latència, codis HTTP, mides i errors per pas de la cadena
+sepe_metrics = SepeMetrics()
+
+
+class _SingleFlight:
+    """Agrupa crides simultànies amb la mateixa clau en una sola execució.
+
+    El primer que arriba (líder) executa la funció; els altres esperen
+    el mateix ``Future`` i reben el seu resultat (o la seva excepció).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[tuple, Future] = {}
+
+    def do(self, key: tuple, fn) -> tuple:
+        """Retorna ``(resultat, és_líder)``."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        with _stats_lock:
+            _session_stats["executed" if leader else "coalesced"] += 1
+
+        if not leader:
+            return future.result(), False
+
+        try:
+            result = fn()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        return result, True
+
+
+_single_flight = _SingleFlight()
+
+
+class _CheckContext:
+    """Estat d'una sola comprovació: peticions fetes i origen de la sessió."""
+
+    def __init__(self, cancel: CancelToken | None = None):
+        self.cancel = cancel
+        self.round_trips = 0
+        self.session_reused = False
+        self.session_rejected = False
+        # 'miss' (consulta normal), 'hit' (resolt des de cache),
+        # 'confirm' (cache positiva reconfirmada amb la cadena del DNI) o
+        # 'dead' (CP de la cache negativa persistent)
+        self.cache = "miss"
+        # Algun pas ha fallat per indisponibilitat del SEPE (resultat incert)
+        self.unavailable = False
+        self.deadline_hit = False
+        self.cancelled = False
+        # Nombre d'oficines de cada canal consultat amb èxit
+        self.office_counts: list[int] = []
+        # Oficines retornades (tots els canals), per a l'historial d'encerts
+        self.offices: list[dict] = []
+        self.start_budget()
+
+    def start_budget(self) -> None:
+        """(Re)inicia el pressupost de temps (``CHECK_DEADLINE``) de la comprovació."""
+        self.started = time.monotonic()
+        self.deadline = self.started + CHECK_DEADLINE
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def check_budget(self, path: str) -> None:
+        """Comprova, abans de *path*, que la comprovació encara ha de continuar.
+
+        Llança ``CheckCancelledError`` si el worker l'ha cancel·lada i
+        ``DeadlineExceededError`` si ja no queda temps.
+        """
+        if self.cancel is not None and self.cancel.cancelled:
+            sepe_metrics.record_error(_step_name(path), "cancelled")
+            raise CheckCancelledError(f"comprovació cancel·lada ({self.cancel.reason}) abans de {path}")
+        if self.remaining() <= 0:
+            sepe_metrics.record_error(_step_name(path), "deadline")
+            raise DeadlineExceededError(f"pressupost de {CHECK_DEADLINE:g}s esgotat abans de {path}")
+
+    def rate_limited(self, path: str, acquired: bool) -> None:
+        """Després d'esperar torn al limitador (``acquire(self.remaining())``).
+
+        Si el torn arribava massa tard (*acquired* fals) o la comprovació
+        s'ha cancel·lat o ha vençut mentre esperava, llança l'error
+        corresponent en lloc d'enviar una petició que ja no serveix.
+        """
+        if not acquired:
+            sepe_metrics.record_error(_step_name(path), "deadline")
+            raise DeadlineExceededError(
+                f"pressupost de {CHECK_DEADLINE:g}s esgotat esperant torn per a {path}")
+        self.check_budget(path)
+
+    def request_timeout(self) -> tuple[float, bool]:
+        """Timeout de la propera petició i si l'ha retallat el pressupost."""
+        remaining = self.remaining()
+        if remaining < REQUEST_TIMEOUT:
+            return max(remaining, 0.1), True
+        return REQUEST_TIMEOUT, False
+
+    def note_error(self, exc: BaseException) -> None:
+        if isinstance(exc, SepeUnavailableError):
+            self.unavailable = True
+        if isinstance(exc, DeadlineExceededError):
+            self.deadline_hit = True
+        if isinstance(exc, CheckCancelledError):
+            self.cancelled = True
+
+    def as_meta(self) -> dict:
+        return {
+            "round_trips": self.round_trips,
+            "session_reused": self.session_reused,
+            "session_rejected": self.session_rejected,
+            "cache": self.cache,
+            "cancelled": self.cancelled,
+        }
+
 
 # ─────────────────────────────────────────────────────────────────────
 # Funció principal
 # ─────────────────────────────────────────────────────────────────────
 
 def check_zip(zip_code: str, dni: str, appt_types: list | None = None,
-              tramite_id: str = "158") -> dict:
+              tramite_id: str = "158", cancel: CancelToken | None = None) -> dict:
     """Comprova disponibilitat de cita per a *zip_code* / *dni*.
 
     Parameters
@@ -57,131 +352,547 @@ def check_zip(zip_code: str, dni: str, appt_types: list | None = None,
     dni      : str  – Document d'identitat.
     appt_types : list[str]  – ``['person']``, ``['phone']`` o ambdós.
     tramite_id : str  – ID de nivel 2 (per defecte ``"158"``).
+    cancel : CancelToken  – Si es cancel·la, no es fa cap petició més i
+        el resultat és incert (``'unknown'``).
 
     Returns
     -------
-    dict  – ``{<appt_type>: bool, 'offices': [{'name': …, 'date': …}, …]}``
+    dict  – ``{<appt_type>: bool, 'offices': [{'name': …, 'date': …}, …],
+              'meta': {'round_trips': int, 'session_reused': bool, …}}``
+
+    Les crides simultànies per al mateix (CP, tràmit, canals) s'agrupen:
+    només una consulta el SEPE i la resta n'esperen el resultat.
     """
     if appt_types is None:
         appt_types = ["person"]
 
+    key = _flight_key(zip_code, tramite_id, appt_types)
+    results, leader = _single_flight.do(
+        key, lambda: _check_zip(zip_code, dni, appt_types, tramite_id, cancel))
+    if leader:
+        return results
+    if _has_appointment(results, appt_types) or _needs_own_check(results, cancel):
+        # El resultat compartit té hueco però s'ha obtingut amb un altre
+        # DNI: aquest DNI fa la seva pròpia cadena (antifrau) per confirmar.
+        # També si el líder s'ha cancel·lat i aquesta comprovació no.
+        return _check_zip(zip_code, dni, appt_types, tramite_id, cancel)
+    return _coalesced_copy(results)
+
+
+def _needs_own_check(results: dict, cancel: CancelToken | None) -> bool:
+    """El resultat compartit és d'un líder cancel·lat i aquesta crida continua viva."""
+    return results.get("meta", {}).get("cancelled", False) and not (cancel and cancel.cancelled)
+
+
+def _check_zip(zip_code: str, dni: str, appt_types: list, tramite_id: str,
+               cancel: CancelToken | None = None) -> dict:
+    """Implementació de ``check_zip`` sense agrupació de crides."""
     results: dict = {t: False for t in appt_types}
+    ctx = _CheckContext(cancel)
+    results["meta"] = ctx.as_meta()
 
     subtramite = NIVEL2_TO_SUBTRAMITE.get(str(tramite_id), DEFAULT_SUBTRAMITE)
 
+    if _resolve_from_cache(zip_code, subtramite, appt_types, ctx):
+        # Cap canal té hueco segons la cache: no cal tocar el SEPE
+        return _finish(results, ctx, appt_types, zip_code)
+
     try:
-        session = _build_session(zip_code, dni, tramite_id)
+        session = _build_session_with_fallback(zip_code, dni, tramite_id, ctx)
+    except CheckCancelledError as exc:
+        logger.info("CP %s: %s", zip_code, exc)
+        ctx.note_error(exc)
+        return _finish(results, ctx, appt_types, zip_code)
     except Exception as exc:
         logger.error("Error construint la sessió SEPE per CP %s: %s", zip_code, exc)
-        return results
+        ctx.note_error(exc)
+        return _finish(results, ctx, appt_types, zip_code)
 
     # Consultar oficines per cada canal sol·licitat
     all_offices: list[dict] = []
     for appt_type in appt_types:
-        channel_id = CHANNEL_PRESENCIAL if appt_type == "person" else CHANNEL_TELEFONICA
+        channel_id = _channel_for(appt_type)
         try:
-            offices = _fetch_offices(session, zip_code, subtramite, channel_id)
+            offices = _fetch_offices(session, zip_code, subtramite, channel_id, ctx)
+        except CheckCancelledError as exc:
+            logger.info("CP %s: %s", zip_code, exc)
+            ctx.note_error(exc)
+            break
+        except SessionExpiredError:
+            # La sessió reutilitzada ha caducat entre passos: reconstruïm i reintentem
+            logger.info("Sessió SEPE rebutjada a cargaOficinasMapa (CP %s), reconstruint", zip_code)
+            _discard_thread_session()
+            ctx.session_rejected = True
+            try:
+                session = _build_session(zip_code, dni, tramite_id, ctx, fresh=True)
+                offices = _fetch_offices(session, zip_code, subtramite, channel_id, ctx)
+                _store_offices(ctx, (zip_code, subtramite, channel_id), offices)
+            except Exception as exc:
+                logger.warning("Error obtenint oficines (%s) CP %s: %s",
+                               appt_type, zip_code, exc)
+                ctx.note_error(exc)
+                offices = []
         except Exception as exc:
             logger.warning("Error obtenint oficines (%s) CP %s: %s",
                            appt_type, zip_code, exc)
+            ctx.note_error(exc)
             offices = []
+        else:
+            _store_offices(ctx, (zip_code, subtramite, channel_id), offices)
 
-        # Mirem si alguna oficina té primerHuecoDisponible no buit
-        has_appointment = any(o.get("date") for o in offices)
-        results[appt_type] = has_appointment
-
-        if has_appointment:
-            type_name = "Presencial" if appt_type == "person" else "Telefònica"
-            logger.info("CITA %s TROBADA al CP %s (%d oficines amb hueco)",
-                        type_name, zip_code, sum(1 for o in offices if o.get("date")))
-            all_offices.extend(offices)
+        _apply_offices(results, all_offices, appt_type, offices, zip_code)
 
     if all_offices:
         results["offices"] = all_offices
 
+    return _finish(results, ctx, appt_types, zip_code)
+
+
+def _finish(results: dict, ctx: _CheckContext, appt_types: list, zip_code: str) -> dict:
+    """Tanca una comprovació: comptadors, metadades i marca d'incertesa.
+
+    Si el SEPE no ha respost (o el circuit és obert) o s'ha cancel·lat la
+    comprovació i no s'ha trobat cap cita, el resultat porta
+    ``'unknown': True``: no és un "no trobat".  Si algun canal ha retornat
+    oficines, el resultat s'anota a l'historial d'encerts (``zip_history``);
+    els canals sense cap oficina ja els ha anotat ``_store_offices`` a la
+    cache negativa.
+    """
+    if (ctx.unavailable or ctx.cancelled) and not _has_appointment(results, appt_types):
+        results["unknown"] = True
+    elif any(ctx.office_counts) and ctx.cache != "hit":
+        # Resposta real del SEPE (no de la cache): alimenta l'ordre dels CPs
+        zip_history.record(zip_code, _has_appointment(results, appt_types), ctx.offices)
+    if ctx.round_trips:
+        if ctx.cancelled:
+            outcome = "cancelled"
+        elif ctx.deadline_hit:
+            outcome = "deadline"
+        else:
+            outcome = "unknown" if ctx.unavailable else "ok"
+        sepe_metrics.record_check((time.monotonic() - ctx.started) * 1000, outcome)
+    _record_check(ctx)
+    results["meta"] = ctx.as_meta()
     return results
 
 
+def _flight_key(zip_code: str, tramite_id: str, appt_types: list) -> tuple:
+    return (zip_code, str(tramite_id), tuple(sorted(_channel_for(t) for t in appt_types)))
+
+
+def _has_appointment(results: dict, appt_types: list) -> bool:
+    return any(results.get(t) for t in appt_types)
+
+
+def _coalesced_copy(results: dict) -> dict:
+    """Còpia del resultat compartit per a una crida agrupada (0 peticions pròpies)."""
+    copy = {k: v for k, v in results.items() if k not in ("meta", "offices")}
+    if "offices" in results:
+        copy["offices"] = [dict(o) for o in results["offices"]]
+    copy["meta"] = dict(results.get("meta", {}), round_trips=0, session_reused=False,
+                        coalesced=True)
+    return copy
+
+
+def _store_offices(ctx: _CheckContext, key: tuple, offices: list[dict]) -> None:
+    """Guarda una consulta d'oficines correcta a la cache de disponibilitat.
+
+    Les oficines amb hueco s'anoten també a l'historial de cites
+    (``slot_history``); si no n'hi ha cap, el CP es dona per mort per a
+    aquest subtràmit i canal (``dead_zips``).
+    """
+    ctx.office_counts.append(len(offices))
+    ctx.offices.extend(offices)
+    _availability_cache.put(key, offices)
+    zip_code, subtramite, channel_id = key
+    if not offices:
+        dead_zips.mark_dead(zip_code, dead_zips.REASON_NO_OFFICES, subtramite, channel_id)
+    channel = "person" if channel_id == CHANNEL_PRESENCIAL else "phone"
+    slot_history.record(zip_code, channel, subtramite, offices)
+
+
+def _resolve_from_cache(zip_code: str, subtramite: str, appt_types: list,
+                        ctx: _CheckContext) -> bool:
+    """Consulta la cache de disponibilitat per a tots els canals demanats.
+
+    Retorna ``True`` si la comprovació queda resolta com a "sense cita"
+    sense cap petició.  Si la cache indica hueco, marca ``ctx.cache`` com
+    a ``'confirm'`` i retorna ``False``: el DNI ha de fer la seva pròpia
+    cadena (amb antifrau) abans de notificar res.  Els CPs de la cache
+    negativa (``dead_zips``: inexistents, o sense oficines per a tots els
+    canals demanats d'aquest subtràmit) es resolen directament com a "sense
+    cita"; un canal sense oficines compta com a resposta buida.
+    """
+    channels = [_channel_for(t) for t in appt_types]
+    dead = [dead_zips.is_dead(zip_code, subtramite, c) for c in channels]
+    if all(dead):
+        ctx.cache = "dead"
+        return True
+
+    cached = [[] if is_dead else _availability_cache.get((zip_code, subtramite, c))
+              for c, is_dead in zip(channels, dead)]
+    if any(offices is None for offices in cached):
+        return False
+
+    if any(o.get("date") for offices in cached for o in offices):
+        ctx.cache = "confirm"
+        with _stats_lock:
+            _session_stats["cache_confirms"] += 1
+        return False
+
+    ctx.cache = "hit"
+    with _stats_lock:
+        _session_stats["cache_hits"] += 1
+    return True
+
+
+def _channel_for(appt_type: str) -> str:
+    return CHANNEL_PRESENCIAL if appt_type == "person" else CHANNEL_TELEFONICA
+
+
+def office_target(tramite_id, appt_types: list) -> tuple[str, list[str]]:
+    """Subtràmit i canals SEPE que consultarà una cerca (claus de ``dead_zips``)."""
+    subtramite = NIVEL2_TO_SUBTRAMITE.get(str(tramite_id), DEFAULT_SUBTRAMITE)
+    return subtramite, [_channel_for(t) for t in appt_types]
+
+
+def _apply_offices(results: dict, all_offices: list, appt_type: str,
+                   offices: list[dict], zip_code: str) -> None:
+    """Anota a *results* si alguna oficina té ``primerHuecoDisponible``."""
+    has_appointment = any(o.get("date") for o in offices)
+    results[appt_type] = has_appointment
+
+    if has_appointment:
+        type_name = "Presencial" if appt_type == "person" else "Telefònica"
+        logger.info("CITA %s TROBADA al CP %s (%d oficines amb hueco)",
+                    type_name, zip_code, sum(1 for o in offices if o.get("date")))
+        all_offices.extend(offices)
+
+
+def get_session_stats() -> dict:
+    """Retorna una còpia dels comptadors acumulats de sessions i peticions."""
+    with _stats_lock:
+        stats = dict(_session_stats)
+    checks = stats["checks"]
+    stats["avg_round_trips"] = round(stats["round_trips"] / checks, 2) if checks else 0.0
+    return stats
+
+
+def _record_check(ctx: _CheckContext) -> None:
+    with _stats_lock:
+        _session_stats["checks"] += 1
+        _session_stats["round_trips"] += ctx.round_trips
+        if ctx.session_reused:
+            _session_stats["sessions_reused"] += 1
+        if ctx.session_rejected:
+            _session_stats["sessions_rejected"] += 1
+
+
 # ─────────────────────────────────────────────────────────────────────
 # Construcció de sessió (cadena d'estat)
 # ─────────────────────────────────────────────────────────────────────
 
-def _build_session(zip_code: str, dni: str, tramite_id: str) -> requests.Session:
-    """Executa tota la cadena d'AJAX per establir l'estat de sessió."""
+# Passos que no es reintenten mai: l'antifrau pot comptar cada intent
+NON_IDEMPOTENT_STEPS = frozenset({"compruebaCitasDocumentoAntifraude"})
+
+
+def _request(session: requests.Session, ctx: _CheckContext, method: str,
+             path: str, data: dict | None = None) -> requests.Response:
+    """Fa una petició al SEPE comptant-la com a round-trip de la comprovació.
+
+    Passa pel limitador de ritme global i li notifica el resultat.  El
+    timeout és el que queda del pressupost de la comprovació (com a màxim
+    ``REQUEST_TIMEOUT``) i els passos idempotents es reintenten segons
+    ``_retry_delay``.
+    """
+    attempt = 0
+    while True:
+        try:
+            return _send(session, ctx, method, path, data)
+        except SepeUnavailableError as exc:
+            delay = _retry_delay(ctx, path, attempt, exc)
+            if delay is None:
+                raise
+            attempt += 1
+            time.sleep(delay)
+
+
+def _send(session: requests.Session, ctx: _CheckContext, method: str,
+          path: str, data: dict | None) -> requests.Response:
+    """Un sol intent de ``_request``."""
+    ctx.check_budget(path)
+    _check_circuit(path)
+    try:
+        ctx.rate_limited(path, rate_limiter.acquire(ctx.remaining()))
+    except BaseException:
+        # No s'ha enviat res: si era la prova del circuit mig obert, queda lliure
+        circuit_breaker.release_probe()
+        raise
+    timeout, budget_limited = ctx.request_timeout()
+    ctx.round_trips += 1
+    start = time.perf_counter()
+    try:
+        r = session.request(method, f"{BASE}{path}", data=data, timeout=timeout)
+    except requests.Timeout as exc:
+        _signal_transport_error("deadline" if budget_limited else "timeout", path, exc, start)
+    except requests.RequestException as exc:
+        _signal_transport_error("connection", path, exc, start)
+    sepe_metrics.record_request(_step_name(path), (time.perf_counter() - start) * 1000,
+                                r.status_code, len(r.content))
+    _signal_status(r.status_code, path)
+    return r
+
+
+def _retry_delay(ctx: _CheckContext, path: str, attempt: int,
+                 exc: SepeUnavailableError) -> float | None:
+    """Espera abans de reintentar *path*, o ``None`` si no s'ha de reintentar.
+
+    Backoff exponencial amb "full jitter" (``0..RETRY_BASE_DELAY·2^intent``).
+    No es reintenta amb el circuit obert, amb el pressupost esgotat o la
+    comprovació cancel·lada, en passos no idempotents ni si l'espera no
+    cap en el temps que queda.
+    """
+    step = _step_name(path)
+    if (attempt >= RETRY_ATTEMPTS or step in NON_IDEMPOTENT_STEPS
+            or isinstance(exc, (CircuitOpenError, DeadlineExceededError))
+            or (ctx.cancel is not None and ctx.cancel.cancelled)):
+        return None
+    delay = random.uniform(0, RETRY_BASE_DELAY * (2 ** attempt))
+    if delay >= ctx.remaining():
+        return None
+    sepe_metrics.record_error(step, "retry")
+    logger.info("Reintent %d de %s d'aquí %.2fs (%s)", attempt + 1, step, delay, exc)
+    return delay
+
+
+def _step_name(path: str) -> str:
+    """Nom del pas per a les mètriques (``landing``, ``existeCP``…)."""
+    return "landing" if path == LANDING_PATH else path.rsplit("/", 1)[-1]
+
+
+def _check_circuit(path: str) -> None:
+    """Llança ``CircuitOpenError`` si el breaker no deixa fer la petició."""
+    if not circuit_breaker.allow():
+        sepe_metrics.record_error(_step_name(path), "circuit_open")
+        raise CircuitOpenError(f"circuit SEPE obert, {path} no s'ha enviat")
+
+
+def _signal_transport_error(reason: str, path: str, exc: BaseException,
+                            start: float) -> None:
+    """Registra un error de transport i el rellança com ``SepeUnavailableError``.
+
+    *reason* és ``'timeout'``, ``'connection'`` o ``'deadline'``: un timeout
+    retallat pel pressupost de la comprovació, que no penalitza limitador
+    ni breaker perquè el SEPE no ha tingut el temps sencer per respondre.
+    """
+    step = _step_name(path)
+    sepe_metrics.record_request(step, (time.perf_counter() - start) * 1000)
+    sepe_metrics.record_error(step, reason)
+    if reason == "deadline":
+        circuit_breaker.release_probe()
+        raise DeadlineExceededError(f"pressupost esgotat a {path}: {exc}") from exc
+    if reason == "timeout":
+        rate_limiter.on_throttle("timeout")
+    circuit_breaker.record_failure(reason)
+    raise SepeUnavailableError(f"{reason} a {path}: {exc}") from exc
+
+
+def _signal_status(status: int, path: str) -> None:
+    """Informa limitador, breaker i mètriques segons el codi HTTP.
+
+    Un 5xx es considera indisponibilitat i es llança ``SepeUnavailableError``.
+    """
+    if status >= 500 or status == 429:
+        rate_limiter.on_throttle(f"http_{status}")
+    else:
+        rate_limiter.on_success()
+    if status >= 400:
+        sepe_metrics.record_error(_step_name(path), f"http_{status // 100}xx")
+    if status >= 500:
+        circuit_breaker.record_failure(f"http_{status}")
+        raise SepeUnavailableError(f"HTTP {status} a {path}")
+    circuit_breaker.record_success()
+
+
+def _new_session(ctx: _CheckContext) -> requests.Session:
+    """Crea una sessió i carrega la pàgina principal per obtenir JSESSIONID."""
     s = requests.Session()
-    s.headers["User-Agent"] = (
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-        "AppleWebKit/537.36 (KHTML, like Gecko) "
-        "Chrome/125.0.0.0 Safari/537.36"
-    )
+    s.headers["User-Agent"] = USER_AGENT
 
     # 1. Pàgina principal → obtenim JSESSIONID
-    s.get(f"{BASE}/?origen=sepe&codidioma=es", timeout=REQUEST_TIMEOUT)
+    _request(s, ctx, "GET", LANDING_PATH)
     s.headers.update({
         "X-Requested-With": "XMLHttpRequest",
-        "Referer": f"{BASE}/?origen=sepe&codidioma=es",
+        "Referer": f"{BASE}{LANDING_PATH}",
     })
+    with _stats_lock:
+        _session_stats["sessions_created"] += 1
+    return s
+
+
+def _get_session(ctx: _CheckContext, fresh: bool = False) -> requests.Session:
+    """Retorna la sessió calenta del fil actual o en crea una de nova."""
+    if not SESSION_REUSE:
+        return _new_session(ctx)
+
+    session = getattr(_thread_local, "session", None)
+    created = getattr(_thread_local, "created", 0.0)
+    if session is not None and not fresh and (time.time() - created) < SESSION_MAX_AGE:
+        ctx.session_reused = True
+        return session
+
+    _discard_thread_session()
+    session = _new_session(ctx)
+    _thread_local.session = session
+    _thread_local.created = time.time()
+    return session
+
+
+def _discard_thread_session() -> None:
+    """Tanca i oblida la sessió calenta del fil actual (si n'hi ha)."""
+    session = getattr(_thread_local, "session", None)
+    _thread_local.session = None
+    if session is not None:
+        try:
+            session.close()
+        except Exception:
+            pass
 
-    # 2. Validar codi postal
-    r = s.post(f"{BASE}/cita/existeCP", data={
-        "idCliente": "39", "codigoPostal": zip_code, "usoBloqueoIframe": "false",
-    }, timeout=REQUEST_TIMEOUT)
-    if r.text.strip() != "true":
-        raise ValueError(f"CP {zip_code} no vàlid segons SEPE (resp: {r.text[:60]})")
-
-    # 3. Nivel 1 (PRESTACIONES)
-    s.post(f"{BASE}/cita/cargaComboNivelesTramitesCPEntidad", data={
-        "idCliente": "39", "codigoPostal": zip_code, "usoBloqueoIframe": "false",
-        "nivel": "1", "idNivel": "0", "idsNiveles": "",
-        "origen": "sepe", "usaOrdenManual": "false", "codigoEntidad": "",
-    }, timeout=REQUEST_TIMEOUT)
-
-    # 4. Carregar subtràmits (estableix estat servidor)
-    s.post(f"{BASE}/cita/cargarComboGruposTramitesByNivel", data={
-        "idCliente": "39", "codigoPostal": zip_code, "usoBloqueoIframe": "false",
-        "nivel": "2", "idNivel": str(tramite_id), "idsNiveles": "",
-        "esServicio": "true",
-    }, timeout=REQUEST_TIMEOUT)
-
-    # 5. Validar DNI
-    s.post(f"{BASE}/cita/compruebaMascaraDNI", data={
-        "documento": dni, "codIdioma": "es",
-    }, timeout=REQUEST_TIMEOUT)
-
-    # 6. Anti-frau
-    s.post(f"{BASE}/cita/compruebaCitasDocumentoAntifraude", data={
-        "documento": dni,
-        "validacionControlFraude": "1",
-        "idConfiguracionAntifraude": "2",
-        "moduloGrupoLimitanteCita": "1",
-        "codIdioma": "es",
-    }, timeout=REQUEST_TIMEOUT)
-
-    # 7. Carregar missatges
-    s.post(f"{BASE}/cita/loadMensajes", data={
-        "codigoEntidad": "", "tieneTramiteRelacionado": "false",
-        "codigoEntidadTR": "", "codIdioma": "es",
-    }, timeout=REQUEST_TIMEOUT)
-
-    # 8. Mostrar pantalla mapa (step 2 del SEPE)
-    r = s.post(f"{BASE}/cita/showPantallaMapa", data={
-        "busquedaPorCP": "true", "codigoEntidad": "",
-        "codIdioma": "es", "tieneTramiteRelacionado": "false",
-    }, timeout=REQUEST_TIMEOUT)
-    if len(r.text.strip()) < 100:
-        logger.warning("showPantallaMapa ha retornat %d chars (esperat >100)", len(r.text))
+
+def _build_session_with_fallback(zip_code: str, dni: str, tramite_id: str,
+                                 ctx: _CheckContext) -> requests.Session:
+    """Com ``_build_session`` però reconstrueix la sessió si el SEPE la rebutja."""
+    try:
+        return _build_session(zip_code, dni, tramite_id, ctx)
+    except SessionExpiredError:
+        logger.info("Sessió SEPE reutilitzada rebutjada (CP %s), reconstruint", zip_code)
+        _discard_thread_session()
+        ctx.session_rejected = True
+        return _build_session(zip_code, dni, tramite_id, ctx, fresh=True)
+
+
+def _build_session(zip_code: str, dni: str, tramite_id: str,
+                   ctx: _CheckContext | None = None,
+                   fresh: bool = False) -> requests.Session:
+    """Executa tota la cadena d'AJAX per establir l'estat de sessió.
+
+    Si hi ha una sessió calenta al fil, se salta la pàgina principal i
+    només es repeteixen els passos dependents del CP/DNI.
+    """
+    if ctx is None:
+        ctx = _CheckContext()
+    s = _get_session(ctx, fresh=fresh)
+
+    for step, path, form in _chain_steps(zip_code, dni, tramite_id):
+        r = _request(s, ctx, "POST", path, data=form)
+        _validate_step(step, r.status_code, r.text, zip_code, ctx)
 
     return s
 
 
+def _chain_steps(zip_code: str, dni: str, tramite_id: str) -> list[tuple[str, str, dict]]:
+    """Passos 2‑8 de la cadena (els que depenen del CP/DNI).
+
+    Retorna ``[(nom_pas, path, formulari), …]``.  El client síncron i
+    l'asíncron (``sepe_async``) recorren la mateixa llista.
+    """
+    return [
+        # 2. Validar codi postal
+        ("existeCP", "/cita/existeCP", {
+            "idCliente": "39", "codigoPostal": zip_code, "usoBloqueoIframe": "false",
+        }),
+        # 3. Nivel 1 (PRESTACIONES)
+        ("cargaComboNivelesTramitesCPEntidad", "/cita/cargaComboNivelesTramitesCPEntidad", {
+            "idCliente": "39", "codigoPostal": zip_code, "usoBloqueoIframe": "false",
+            "nivel": "1", "idNivel": "0", "idsNiveles": "",
+            "origen": "sepe", "usaOrdenManual": "false", "codigoEntidad": "",
+        }),
+        # 4. Carregar subtràmits (estableix estat servidor)
+        ("cargarComboGruposTramitesByNivel", "/cita/cargarComboGruposTramitesByNivel", {
+            "idCliente": "39", "codigoPostal": zip_code, "usoBloqueoIframe": "false",
+            "nivel": "2", "idNivel": str(tramite_id), "idsNiveles": "",
+            "esServicio": "true",
+        }),
+        # 5. Validar DNI
+        ("compruebaMascaraDNI", "/cita/compruebaMascaraDNI", {
+            "documento": dni, "codIdioma": "es",
+        }),
+        # 6. Anti-frau
+        ("compruebaCitasDocumentoAntifraude", "/cita/compruebaCitasDocumentoAntifraude", {
+            "documento": dni,
+            "validacionControlFraude": "1",
+            "idConfiguracionAntifraude": "2",
+            "moduloGrupoLimitanteCita": "1",
+            "codIdioma": "es",
+        }),
+        # 7. Carregar missatges
+        ("loadMensajes", "/cita/loadMensajes", {
+            "codigoEntidad": "", "tieneTramiteRelacionado": "false",
+            "codigoEntidadTR": "", "codIdioma": "es",
+        }),
+        # 8. Mostrar pantalla mapa (step 2 del SEPE)
+        ("showPantallaMapa", "/cita/showPantallaMapa", {
+            "busquedaPorCP": "true", "codigoEntidad": "",
+            "codIdioma": "es", "tieneTramiteRelacionado": "false",
+        }),
+    ]
+
+
+def _validate_step(step: str, status: int, text: str, zip_code: str,
+                   ctx: _CheckContext) -> None:
+    """Valida la resposta d'un pas de la cadena (comú sync/async)."""
+    if step == "existeCP":
+        answer = text.strip()
+        if ctx.session_reused and (status != 200 or answer not in ("true", "false")):
+            # Una sessió vàlida sempre respon true/false; qualsevol altra cosa
+            # (HTML de la portada, error 5xx…) indica JSESSIONID caducat.
+            sepe_metrics.record_error(step, "session_expired")
+            raise SessionExpiredError(f"existeCP ha retornat {status}: {answer[:60]}")
+        if answer != "true":
+            sepe_metrics.record_error(step, "invalid_cp")
+            if answer == "false":
+                dead_zips.mark_dead(zip_code, dead_zips.REASON_INVALID)
+            raise InvalidZipError(f"CP {zip_code} no vàlid segons SEPE (resp: {text[:60]})")
+    elif step == "showPantallaMapa":
+        if len(text.strip()) < 100:
+            sepe_metrics.record_error(step, "short_body")
+            logger.warning("showPantallaMapa ha retornat %d chars (esperat >100)", len(text))
+
+
 # ─────────────────────────────────────────────────────────────────────
 # Obtenció d'oficines
 # ─────────────────────────────────────────────────────────────────────
 
 def _fetch_offices(session: requests.Session, zip_code: str,
-                   subtramite: str, channel_id: str) -> list[dict]:
+                   subtramite: str, channel_id: str,
+                   ctx: _CheckContext | None = None) -> list[dict]:
     """Crida ``cargaOficinasMapa`` i retorna llista d'oficines."""
-    r = session.post(f"{BASE}/cita/cargaOficinasMapa", data={
+    if ctx is None:
+        ctx = _CheckContext()
+    r = _request(session, ctx, "POST", OFFICES_PATH,
+                 data=_offices_form(zip_code, subtramite, channel_id))
+    return _decode_offices(r.status_code, r.text, zip_code, ctx)
+
+
+def _decode_offices(status: int, text: str, zip_code: str, ctx: _CheckContext) -> list[dict]:
+    """Descodifica la resposta de ``cargaOficinasMapa`` (comú sync/async)."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        step = _step_name(OFFICES_PATH)
+        if ctx.session_reused and not ctx.session_rejected:
+            sepe_metrics.record_error(step, "session_expired")
+            raise SessionExpiredError(f"cargaOficinasMapa no ha retornat JSON ({status})")
+        sepe_metrics.record_error(step, "non_json")
+        rate_limiter.on_throttle("non_json")
+        raise BadResponseError(f"cargaOficinasMapa no ha retornat JSON ({status}) per CP {zip_code}")
+
+    return _parse_offices(data, zip_code)
+
+
+def _offices_form(zip_code: str, subtramite: str, channel_id: str) -> dict:
+    """Formulari de ``cargaOficinasMapa``."""
+    return {
         "idCliente": "39",
         "codigoEntidad": "",
         "idGrupoServicio": subtramite,
@@ -192,13 +903,15 @@ def _fetch_offices(session: requests.Session, zip_code: str,
         "lngOrigen": "0",
         "tieneTramiteRelacionado": "0",
         "idsJerarquiaTramites": "",
-    }, timeout=REQUEST_TIMEOUT)
+    }
 
-    data = r.json()
 
+def _parse_offices(data: dict, zip_code: str) -> list[dict]:
+    """Converteix el JSON de ``cargaOficinasMapa`` a ``[{'name', 'date'}, …]``."""
     if data.get("Error") == "ErrorCaptcha":
-        logger.warning("SEPE ha retornat ErrorCaptcha per CP %s", zip_code)
-        return []
+        sepe_metrics.record_error(_step_name(OFFICES_PATH), "captcha")
+        rate_limiter.on_throttle("captcha")
+        raise CaptchaError(f"ErrorCaptcha per CP {zip_code}")
 
     offices: list[dict] = []
     for ofi in data.get("listaOficina", []):
@@ -0,0 +1,336 @@
+"""
+Client asíncron (asyncio + aiohttp) per a l'API de Cita Prèvia del SEPE.
+
+Reprodueix la mateixa cadena que ``sepe_api`` — els passos, formularis i
+validacions es comparteixen — però sense bloquejar un fil per
+comprovació: un sol bucle d'esdeveniments pot tenir centenars de
+comprovacions en vol, limitades per un semàfor global.
+
+Com que el SEPE guarda l'estat de la conversa al servidor (JSESSIONID),
+cada comprovació en vol fa servir la seva pròpia cookie jar.  Les
+connexions TCP/TLS es comparteixen a través d'un únic ``TCPConnector`` i
+les sessions acabades tornen a un pool per reutilitzar-les (equivalent
+asíncron de la sessió calenta per fil de ``sepe_api``).
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import aiohttp
+
+from src import sepe_api
+from src.sepe_api import (
+    NIVEL2_TO_SUBTRAMITE, DEFAULT_SUBTRAMITE, LANDING_PATH, OFFICES_PATH,
+    USER_AGENT, CancelToken, CheckCancelledError, SessionExpiredError, _CheckContext,
+)
+
+logger = logging.getLogger(__name__)
+
+# Límit global de comprovacions simultànies en vol
+ASYNC_MAX_CONCURRENCY = int(os.getenv("SEPE_ASYNC_CONCURRENCY", 200))
+
+
+class AsyncSepeClient:
+    """Client asíncron amb límit de concurrència i pool de sessions.
+
+    Ús::
+
+        async with AsyncSepeClient(max_concurrency=300) as client:
+            results = await client.check_zip("08001", dni, ["person"])
+    """
+
+    def __init__(self, max_concurrency: int | None = None):
+        self.max_concurrency = max_concurrency or ASYNC_MAX_CONCURRENCY
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._connector: aiohttp.TCPConnector | None = None
+        # Sessions calentes lliures: [(session, created_ts), …]
+        self._idle: list[tuple[aiohttp.ClientSession, float]] = []
+        # Moment de creació de cada sessió viva (per a SESSION_MAX_AGE)
+        self._created: dict[aiohttp.ClientSession, float] = {}
+        # Consultes en curs per clau (CP, tràmit, canals) — single-flight
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.in_flight = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for session, _ in idle:
+            await self._close_session(session)
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+
+    # ─────────────────────────────────────────────────────────────────
+    # Funció principal
+    # ─────────────────────────────────────────────────────────────────
+
+    async def check_zip(self, zip_code: str, dni: str, appt_types: list | None = None,
+                        tramite_id: str = "158", cancel: CancelToken | None = None) -> dict:
+        """Versió asíncrona de ``sepe_api.check_zip`` (mateix format de retorn).
+
+        Igual que la versió síncrona, les comprovacions simultànies del
+        mateix (CP, tràmit, canals) comparteixen una sola consulta, i
+        *cancel* atura la cadena abans de la petició següent.
+        """
+        if appt_types is None:
+            appt_types = ["person"]
+
+        key = sepe_api._flight_key(zip_code, tramite_id, appt_types)
+        future = self._inflight.get(key)
+        if future is not None:
+            with sepe_api._stats_lock:
+                sepe_api._session_stats["coalesced"] += 1
+            results = await asyncio.shield(future)
+            if (sepe_api._has_appointment(results, appt_types)
+                    or sepe_api._needs_own_check(results, cancel)):
+                # Hueco trobat amb un altre DNI (o líder cancel·lat): cadena pròpia
+                return await self._check_zip(zip_code, dni, appt_types, tramite_id, cancel)
+            return sepe_api._coalesced_copy(results)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        with sepe_api._stats_lock:
+            sepe_api._session_stats["executed"] += 1
+        try:
+            results = await self._check_zip(zip_code, dni, appt_types, tramite_id, cancel)
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Evita l'avís "exception was never retrieved" si ningú esperava
+            future.exception()
+            raise
+        else:
+            future.set_result(results)
+        finally:
+            self._inflight.pop(key, None)
+        return results
+
+    async def _check_zip(self, zip_code: str, dni: str, appt_types: list,
+                         tramite_id: str, cancel: CancelToken | None = None) -> dict:
+        results: dict = {t: False for t in appt_types}
+        ctx = _CheckContext(cancel)
+        subtramite = NIVEL2_TO_SUBTRAMITE.get(str(tramite_id), DEFAULT_SUBTRAMITE)
+
+        if sepe_api._resolve_from_cache(zip_code, subtramite, appt_types, ctx):
+            return sepe_api._finish(results, ctx, appt_types, zip_code)
+
+        async with self._semaphore:
+            # L'espera al semàfor no compta dins del pressupost de la comprovació
+            ctx.start_budget()
+            self.in_flight += 1
+            try:
+                await self._check(zip_code, dni, appt_types, tramite_id,
+                                  subtramite, results, ctx)
+            finally:
+                self.in_flight -= 1
+
+        return sepe_api._finish(results, ctx, appt_types, zip_code)
+
+    async def _check(self, zip_code, dni, appt_types, tramite_id, subtramite,
+                     results, ctx) -> None:
+        try:
+            session = await self._build_session_with_fallback(zip_code, dni, tramite_id, ctx)
+        except CheckCancelledError as exc:
+            logger.info("CP %s: %s", zip_code, exc)
+            ctx.note_error(exc)
+            return
+        except Exception as exc:
+            logger.error("Error construint la sessió SEPE per CP %s: %s", zip_code, exc)
+            ctx.note_error(exc)
+            return
+
+        all_offices: list[dict] = []
+        healthy = True
+        for appt_type in appt_types:
+            channel_id = sepe_api._channel_for(appt_type)
+            try:
+                offices = await self._fetch_offices(session, zip_code, subtramite, channel_id, ctx)
+            except CheckCancelledError as exc:
+                logger.info("CP %s: %s", zip_code, exc)
+                ctx.note_error(exc)
+                break
+            except SessionExpiredError:
+                logger.info("Sessió SEPE rebutjada a cargaOficinasMapa (CP %s), reconstruint", zip_code)
+                await self._close_session(session)
+                ctx.session_rejected = True
+                try:
+                    session = await self._build_session(zip_code, dni, tramite_id, ctx, fresh=True)
+                    offices = await self._fetch_offices(session, zip_code, subtramite, channel_id, ctx)
+                    sepe_api._store_offices(ctx, (zip_code, subtramite, channel_id), offices)
+                except Exception as exc:
+                    logger.warning("Error obtenint oficines (%s) CP %s: %s",
+                                   appt_type, zip_code, exc)
+                    ctx.note_error(exc)
+                    offices = []
+                    healthy = False
+            except Exception as exc:
+                logger.warning("Error obtenint oficines (%s) CP %s: %s",
+                               appt_type, zip_code, exc)
+                ctx.note_error(exc)
+                offices = []
+                healthy = False
+            else:
+                sepe_api._store_offices(ctx, (zip_code, subtramite, channel_id), offices)
+
+            sepe_api._apply_offices(results, all_offices, appt_type, offices, zip_code)
+
+        if all_offices:
+            results["offices"] = all_offices
+
+        if healthy and not session.closed:
+            self._release_session(session)
+        else:
+            await self._close_session(session)
+
+    # ─────────────────────────────────────────────────────────────────
+    # Sessions
+    # ─────────────────────────────────────────────────────────────────
+
+    def _get_connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None:
+            self._connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        return self._connector
+
+    async def _new_session(self, ctx: _CheckContext) -> aiohttp.ClientSession:
+        """Crea una sessió (cookie jar pròpia) i carrega la pàgina principal."""
+        session = aiohttp.ClientSession(
+            connector=self._get_connector(), connector_owner=False,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            headers={"User-Agent": USER_AGENT},
+        )
+        self._created[session] = time.time()
+        try:
+            await _request(session, ctx, "GET", LANDING_PATH)
+        except BaseException:
+            await self._close_session(session)
+            raise
+        session.headers.update({
+            "X-Requested-With": "XMLHttpRequest",
+            "Referer": f"{sepe_api.BASE}{LANDING_PATH}",
+        })
+        with sepe_api._stats_lock:
+            sepe_api._session_stats["sessions_created"] += 1
+        return session
+
+    async def _get_session(self, ctx: _CheckContext, fresh: bool = False) -> aiohttp.ClientSession:
+        if sepe_api.SESSION_REUSE and not fresh:
+            while self._idle:
+                session, created = self._idle.pop()
+                if (time.time() - created) < sepe_api.SESSION_MAX_AGE and not session.closed:
+                    ctx.session_reused = True
+                    return session
+                await self._close_session(session)
+        return await self._new_session(ctx)
+
+    def _release_session(self, session: aiohttp.ClientSession) -> None:
+        if sepe_api.SESSION_REUSE:
+            self._idle.append((session, self._created.get(session, 0.0)))
+        else:
+            asyncio.ensure_future(self._close_session(session))
+
+    async def _close_session(self, session: aiohttp.ClientSession) -> None:
+        self._created.pop(session, None)
+        await session.close()
+
+    async def _build_session_with_fallback(self, zip_code, dni, tramite_id, ctx):
+        try:
+            return await self._build_session(zip_code, dni, tramite_id, ctx)
+        except SessionExpiredError:
+            logger.info("Sessió SEPE reutilitzada rebutjada (CP %s), reconstruint", zip_code)
+            ctx.session_rejected = True
+            return await self._build_session(zip_code, dni, tramite_id, ctx, fresh=True)
+
+    async def _build_session(self, zip_code: str, dni: str, tramite_id: str,
+                             ctx: _CheckContext, fresh: bool = False) -> aiohttp.ClientSession:
+        """Executa la cadena d'AJAX (passos 2‑8) sobre una sessió del pool."""
+        session = await self._get_session(ctx, fresh=fresh)
+        try:
+            for step, path, form in sepe_api._chain_steps(zip_code, dni, tramite_id):
+                status, text = await _request(session, ctx, "POST", path, data=form)
+                sepe_api._validate_step(step, status, text, zip_code, ctx)
+        except CheckCancelledError:
+            # La sessió continua sent vàlida: la propera comprovació repeteix els passos
+            self._release_session(session)
+            raise
+        except BaseException:
+            await self._close_session(session)
+            raise
+        return session
+
+    async def _fetch_offices(self, session, zip_code, subtramite, channel_id, ctx) -> list[dict]:
+        status, text = await _request(session, ctx, "POST", OFFICES_PATH,
+                                      data=sepe_api._offices_form(zip_code, subtramite, channel_id))
+        return sepe_api._decode_offices(status, text, zip_code, ctx)
+
+
+async def _request(session: aiohttp.ClientSession, ctx: _CheckContext, method: str,
+                   path: str, data: dict | None = None) -> tuple[int, str]:
+    """Petició asíncrona al SEPE; retorna ``(status, text)``.
+
+    Comparteix el limitador de ritme, el pressupost de temps i la política
+    de reintents de ``sepe_api``.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await _send(session, ctx, method, path, data)
+        except sepe_api.SepeUnavailableError as exc:
+            delay = sepe_api._retry_delay(ctx, path, attempt, exc)
+            if delay is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+async def _send(session: aiohttp.ClientSession, ctx: _CheckContext, method: str,
+                path: str, data: dict | None) -> tuple[int, str]:
+    """Un sol intent de ``_request``."""
+    ctx.check_budget(path)
+    sepe_api._check_circuit(path)
+    try:
+        ctx.rate_limited(path, await sepe_api.rate_limiter.acquire_async(ctx.remaining()))
+    except BaseException:
+        # Vençuda o cancel·lada abans d'enviar res: la prova del circuit queda lliure
+        sepe_api.circuit_breaker.release_probe()
+        raise
+    total, budget_limited = ctx.request_timeout()
+    ctx.round_trips += 1
+    timeout = aiohttp.ClientTimeout(total=total)
+    start = time.perf_counter()
+    try:
+        async with session.request(method, f"{sepe_api.BASE}{path}", data=data,
+                                   timeout=timeout) as r:
+            body = await r.read()
+            text = await r.text(errors="replace")
+            status = r.status
+    except asyncio.TimeoutError as exc:
+        sepe_api._signal_transport_error("deadline" if budget_limited else "timeout",
+                                         path, exc, start)
+    except aiohttp.ClientError as exc:
+        sepe_api._signal_transport_error("connection", path, exc, start)
+    except asyncio.CancelledError:
+        # Una prova del circuit mig obert cancel·lada no ha de bloquejar-lo
+        sepe_api.circuit_breaker.release_probe()
+        raise
+    sepe_api.sepe_metrics.record_request(sepe_api._step_name(path),
+                                         (time.perf_counter() - start) * 1000,
+                                         status, len(body))
+    sepe_api._signal_status(status, path)
+    return status, text
+
+
+async def check_zip_async(zip_code: str, dni: str, appt_types: list | None = None,
+                          tramite_id: str = "158",
+                          client: AsyncSepeClient | None = None,
+                          cancel: CancelToken | None = None) -> dict:
+    """Drecera per a una comprovació puntual (crea un client temporal si cal)."""
+    if client is not None:
+        return await client.check_zip(zip_code, dni, appt_types, tramite_id, cancel)
+    async with AsyncSepeClient() as tmp_client:
+        return await tmp_client.check_zip(zip_code, dni, appt_types, tramite_id, cancel)
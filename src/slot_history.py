@@ -0,0 +1,162 @@
+"""
+Historial persistent de cites alliberades pel SEPE.
+
+Cada vegada que ``cargaOficinasMapa`` retorna una oficina amb
+``primerHuecoDisponible``, ``sepe_api`` n'afegeix una línia a
+``data/slot_history.jsonl``: ``[ts, cp, oficina, canal, subtràmit, data]``.
+El fitxer només creix per la cua (és segur escriure-hi des de diversos
+fils i processos) i, quan passa de ``SLOT_HISTORY_MAX_MB``, es rota a
+``slot_history.1.jsonl`` (se'n guarda un de vell).
+
+El mateix hueco es veu a cada comprovació mentre no l'agafa ningú: només
+s'anota quan la data canvia o si fa més de ``SLOT_HISTORY_DEDUP_MINUTES``
+que no s'anotava, de manera que el fitxer reflecteix quan apareixen les
+cites i no quantes vegades les hem consultades.
+
+``release_patterns`` agrega l'historial per hora del dia i dia de la
+setmana (amb filtres per CP, oficina, canal, tràmit i període) per saber
+on i quan el SEPE allibera cites.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# ``SEPE_HISTORY_DIR`` l'aparta de ``data/`` (proves contra el SEPE fals)
+SLOT_HISTORY_FILE = os.path.join(os.getenv('SEPE_HISTORY_DIR', os.path.join(os.path.dirname(__file__), '..', 'data')),
+                                 'slot_history.jsonl')
+ROTATED_FILE = SLOT_HISTORY_FILE.replace('.jsonl', '.1.jsonl')
+
+# Mida (MB) a partir de la qual el fitxer es rota
+MAX_MB = float(os.getenv('SLOT_HISTORY_MAX_MB', 20))
+# Minuts durant els quals el mateix hueco no es torna a anotar
+DEDUP_MINUTES = float(os.getenv('SLOT_HISTORY_DEDUP_MINUTES', 60))
+
+WEEKDAYS = ['dl', 'dt', 'dc', 'dj', 'dv', 'ds', 'dg']
+
+_lock = threading.Lock()
+# (cp, oficina, canal, subtràmit) → (data, ts) de l'última anotació
+_last_seen = {}
+
+
+def record(zip_code, channel, subtramite, offices):
+    """Anota les oficines de *offices* que tenen hueco (``date``).
+
+    *channel* és ``'person'`` o ``'phone'``; *subtramite*, l'id del
+    subtràmit consultat.
+    """
+    now = time.time()
+    lines = []
+    with _lock:
+        for office in offices:
+            date = office.get('date')
+            if not date:
+                continue
+            key = (zip_code, office.get('name', ''), channel, str(subtramite))
+            previous = _last_seen.get(key)
+            if previous and previous[0] == date and now - previous[1] < DEDUP_MINUTES * 60:
+                continue
+            _last_seen[key] = (date, now)
+            lines.append(json.dumps([int(now), *key, date], ensure_ascii=False,
+                                    separators=(',', ':')))
+        if not lines:
+            return
+        try:
+            os.makedirs(os.path.dirname(SLOT_HISTORY_FILE), exist_ok=True)
+            _rotate_if_needed()
+            with open(SLOT_HISTORY_FILE, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+        except Exception as e:
+            logger.error(f"Error guardant l'historial de cites: {e}")
+
+
+def _rotate_if_needed():
+    try:
+        size = os.path.getsize(SLOT_HISTORY_FILE)
+    except OSError:
+        return
+    if size >= MAX_MB * 1024 * 1024:
+        os.replace(SLOT_HISTORY_FILE, ROTATED_FILE)
+        logger.info(f"Historial de cites rotat ({size // 1024} KB)")
+
+
+def iter_records(since=None):
+    """Recorre l'historial (el rotat primer) com a diccionaris."""
+    for path in (ROTATED_FILE, SLOT_HISTORY_FILE):
+        try:
+            f = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with f:
+            for line in f:
+                try:
+                    ts, zip_code, office, channel, subtramite, date = json.loads(line)
+                except ValueError:
+                    continue  # Línia tallada (escriptura interrompuda)
+                if since is not None and ts < since:
+                    continue
+                yield {'ts': ts, 'zip': zip_code, 'office': office, 'channel': channel,
+                       'tramite': subtramite, 'date': date}
+
+
+def _lead_days(record):
+    """Dies entre que es veu el hueco i la data de la cita (``None`` si no s'entén)."""
+    try:
+        appointment = datetime.strptime(record['date'][:10], '%d/%m/%Y')
+    except ValueError:
+        return None
+    return (appointment.date() - datetime.fromtimestamp(record['ts']).date()).days
+
+
+def release_patterns(days=None, zip_code=None, office=None, channel=None, tramite=None, top=10):
+    """Agrega les cites alliberades per hora i dia de la setmana.
+
+    Filtra pels últims *days* dies i, si es donen, per CP (o prefix de
+    CP), oficina, canal (``'person'``/``'phone'``) i subtràmit.  Retorna
+    ``{'total', 'by_hour': [24], 'by_weekday': {dl…dg}, 'heatmap': {dl: [24]…},
+    'top_zips', 'top_offices', 'median_lead_days', 'first_ts', 'last_ts'}``.
+    """
+    since = time.time() - days * 86400 if days else None
+    by_hour = [0] * 24
+    heatmap = {d: [0] * 24 for d in WEEKDAYS}
+    zips, offices = Counter(), Counter()
+    leads = []
+    first_ts = last_ts = None
+
+    for record in iter_records(since):
+        if zip_code and not record['zip'].startswith(zip_code):
+            continue
+        if office and office.lower() not in record['office'].lower():
+            continue
+        if channel and record['channel'] != channel:
+            continue
+        if tramite and record['tramite'] != str(tramite):
+            continue
+        seen = datetime.fromtimestamp(record['ts'])
+        by_hour[seen.hour] += 1
+        heatmap[WEEKDAYS[seen.weekday()]][seen.hour] += 1
+        zips[record['zip']] += 1
+        offices[record['office']] += 1
+        lead = _lead_days(record)
+        if lead is not None:
+            leads.append(lead)
+        first_ts = record['ts'] if first_ts is None else min(first_ts, record['ts'])
+        last_ts = record['ts'] if last_ts is None else max(last_ts, record['ts'])
+
+    leads.sort()
+    return {
+        'total': sum(by_hour),
+        'by_hour': by_hour,
+        'by_weekday': {d: sum(hours) for d, hours in heatmap.items()},
+        'heatmap': heatmap,
+        'top_zips': zips.most_common(top),
+        'top_offices': offices.most_common(top),
+        'median_lead_days': leads[len(leads) // 2] if leads else None,
+        'first_ts': first_ts,
+        'last_ts': last_ts,
+    }
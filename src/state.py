@@ -1,8 +1,16 @@
 import os
+import copy
 import json
+import time
 import logging
 import tempfile
 import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: només el lock entre fils
+    fcntl = None
 
 logger = logging.getLogger('state_manager')
 STATE_FILE = os.path.join('data', 'state.json')
@@ -10,32 +18,517 @@ STATE_FILE = os.path.join('data', 'state.json')
 # Lock per evitar race conditions entre Flask i el worker
 _state_lock = threading.Lock()
 
-def load_state():
-    """Carrega l'estat de les cerques actives des d'un fitxer JSON."""
-    with _state_lock:
-        if os.path.exists(STATE_FILE):
+@contextmanager
+def _file_lock():
+    """Bloqueig entre processos (web, un o més workers) sobre l'estat."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _generation(st):
+    """Identifica una versió concreta del fitxer (cada escriptura és un inode nou)."""
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _read_file_generation():
+    """``(generació, estat)`` llegits del mateix fitxer obert (``(None, {})`` si no n'hi ha)."""
+    try:
+        f = open(STATE_FILE, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return None, {}
+    with f:
+        generation = _generation(os.fstat(f.fileno()))
+        try:
+            return generation, json.load(f)
+        except Exception as e:
+            logger.error(f"Error carregant l'estat: {e}")
+            return generation, {}
+
+def _read_file():
+    return _read_file_generation()[1]
+
+def _write_file(current_state):
+    try:
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(STATE_FILE), text=True)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(current_state, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, STATE_FILE)
+    except Exception as e:
+        logger.error(f"Error guardant l'estat: {e}")
+        if 'tmp_path' in locals() and os.path.exists(tmp_path):
             try:
-                with open(STATE_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                return data
-            except Exception as e:
-                logger.error(f"Error carregant l'estat: {e}")
-                return {}
-        return {}
+                os.remove(tmp_path)
+            except:
+                pass
+
+class ConflictError(Exception):
+    """La cerca ha canviat (o ha aparegut o desaparegut) des que es va llegir."""
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError("Vista de només lectura de l'estat: fes-ne una còpia amb thaw() per modificar-la")
+
+
+class FrozenDict(dict):
+    """Registre (o estat) de només lectura compartit entre lectors.
+
+    És un ``dict`` (``jsonify``, ``==``, ``get`` funcionen igual) però
+    no es pot modificar; ``copy.deepcopy`` i ``thaw`` en retornen una
+    còpia normal.
+    """
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    setdefault = pop = popitem = clear = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    """Llista de només lectura (p. ex. els ``zips`` d'una cerca)."""
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value):
+    """Còpia de només lectura de *value* (les parts ja congelades es comparteixen)."""
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Còpia modificable (dicts i llistes normals) d'una vista de ``freeze``."""
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    return value
+
+
+class _JsonTransaction:
+    """Operacions sobre ``state.json`` amb el bloqueig agafat.
+
+    És la interfície que han de tenir les transaccions de qualsevol
+    backend: ``version()``, ``read(since)``, ``write(state, dnis, fields)``
+    i ``cas(dni, expected_rev, data)``.  Aquest backend sempre llegeix i
+    escriu el fitxer sencer; la revisió de cada cerca va al camp ``_rev``.
+    """
+
+    def version(self):
+        return _file_version()
+
+    def read(self, since=None):
+        """``(versió, cerques, None)``: aquí les cerques són sempre l'estat sencer."""
+        return _read_file_generation() + (None,)
+
+    def query(self, owner_id=None, active=None, orphans=False):
+        return _filter(_read_file(), owner_id, active, orphans)
+
+    def count(self, active=None):
+        return len(_filter(_read_file(), None, active))
+
+    def get(self, dni):
+        return _read_file().get(dni)
+
+    def write(self, state, dnis=None, fields=None):
+        """Desa *state* sencer; puja la revisió de les cerques *dnis* i la retorna."""
+        revs = {}
+        for dni in dnis or ():
+            if dni in state:
+                state[dni]['_rev'] = state[dni].get('_rev', 0) + 1
+                revs[dni] = state[dni]['_rev']
+        _write_file(state)
+        return revs
+
+    def cas(self, dni, expected_rev, data):
+        """Desa (o esborra, amb ``None``) la cerca si la revisió és *expected_rev*."""
+        state = _read_file()
+        current = state.get(dni)
+        if (None if current is None else current.get('_rev', 0)) != expected_rev:
+            raise ConflictError(dni)
+        if data is None:
+            state.pop(dni, None)
+            _write_file(state)
+            return None
+        data['_rev'] = (expected_rev or 0) + 1
+        state[dni] = data
+        _write_file(state)
+        return data['_rev']
+
+
+def _filter(searches, owner_id=None, active=None, orphans=False):
+    result = {}
+    for dni, data in searches.items():
+        if owner_id is not None:
+            owner = data.get('owner_id')
+            if owner != owner_id and not (orphans and owner is None):
+                continue
+        if active is not None and bool(data.get('active', False)) != active:
+            continue
+        result[dni] = data
+    return result
+
+
+class JsonBackend:
+    """Tot l'estat en un sol fitxer JSON (``data/state.json``), el per defecte.
+
+    Les consultes (``view``, ``get``, ``query``, ``count``) es serveixen
+    d'una còpia congelada que només es torna a llegir quan canvia la
+    generació del fitxer (inode, mida, mtime): els sondejos de l'app web
+    costen un ``stat``, no un parseig de tot l'estat.
+    """
+
+    name = 'json'
+
+    def __init__(self):
+        # (generació, vista) de l'última lectura
+        self._view = (None, FrozenDict())
+
+    def view(self):
+        """Estat sencer de només lectura, rellegint el fitxer només si ha canviat."""
+        with _state_lock:
+            try:
+                generation = _generation(os.stat(STATE_FILE))
+            except OSError:
+                generation = None
+            if generation != self._view[0]:
+                generation, state = _read_file_generation()
+                self._view = (generation, freeze(state))
+            return self._view[1]
+
+    @contextmanager
+    def transaction(self, write=True):
+        """Bloqueig entre fils i, si és d'escriptura, entre processos."""
+        with _state_lock:
+            if not write:
+                yield _JsonTransaction()
+                return
+            with _file_lock():
+                yield _JsonTransaction()
+
+    def version(self):
+        return _file_version()
+
+    def get(self, dni):
+        return self.view().get(dni)
+
+    def query(self, owner_id=None, active=None, orphans=False):
+        return _filter(self.view(), owner_id, active, orphans)
+
+    def count(self, active=None):
+        return len(_filter(self.view(), None, active))
+
+
+_backend = None
+
+
+def get_backend():
+    """Backend configurat amb ``STATE_BACKEND`` (``json``, ``sqlite`` o ``journal``)."""
+    global _backend
+    if _backend is None:
+        name = os.getenv('STATE_BACKEND', 'json').lower()
+        if name == 'sqlite':
+            from src.state_sqlite import SqliteBackend
+            _backend = SqliteBackend(json_file=STATE_FILE)
+        elif name == 'journal':
+            from src.state_journal import JournalBackend
+            _backend = JournalBackend(json_file=STATE_FILE)
+        else:
+            _backend = JsonBackend()
+    return _backend
+
+
+def load_state():
+    """Estat sencer de les cerques, com a vista de només lectura.
+
+    Cada procés en guarda l'última lectura i només la refà quan l'estat
+    canvia; tots els lectors comparteixen la mateixa vista.  Per
+    modificar-lo, ``locked_state``/``update_search`` (o ``thaw`` per
+    treballar sobre una còpia).
+    """
+    return get_backend().view()
 
 def save_state(current_state):
-    """Guarda l'estat de les cerques actives a un fitxer JSON de manera atòmica."""
-    with _state_lock:
+    """Substitueix l'estat sencer de manera atòmica."""
+    with get_backend().transaction() as tx:
+        tx.write(current_state)
+
+def query_searches(owner_id=None, active=None, orphans=False):
+    """Cerques d'un *owner_id* i/o amb ``active`` donat (amb índexs a SQLite).
+
+    Amb *orphans*, també les que no tenen ``owner_id`` (per adoptar-les).
+    Els registres són vistes de només lectura (``FrozenDict``).
+    """
+    return get_backend().query(owner_id, active, orphans)
+
+def count_searches(active=None):
+    """Nombre de cerques (totes, o només les actives/inactives)."""
+    return get_backend().count(active)
+
+@contextmanager
+def locked_state():
+    """Llegeix, modifica i desa l'estat sense que ningú hi escrigui entremig.
+
+    Per a l'app web: ``with locked_state() as all_searches: ...``.  Així
+    cada acció (crear, aturar, reiniciar, esborrar) es basa en l'estat
+    més recent i el worker la pot veure com un canvi sobre el que ell
+    mateix va escriure.  Amb els backends SQLite i de diari només es desen
+    les cerques (i els camps) que han canviat.
+    """
+    with get_backend().transaction() as tx:
+        current_state = tx.read()[1]
+        original = copy.deepcopy(current_state)
+        yield current_state
+        dnis = {dni for dni in set(original) | set(current_state)
+                if original.get(dni) != current_state.get(dni)}
+        tx.write(current_state, dnis, {dni: _changed_keys(original.get(dni), current_state[dni])
+                                       for dni in dnis if dni in current_state})
+
+
+# Intents d'una actualització optimista abans de rendir-se
+CAS_RETRIES = int(os.getenv('STATE_CAS_RETRIES', 5))
+
+
+def get_search(dni):
+    """``(cerca, revisió)`` d'un DNI, o ``(None, None)`` si no existeix.
+
+    La cerca és una vista de només lectura (``thaw`` en fa una còpia).
+    """
+    data = get_backend().get(dni)
+    if data is None:
+        return None, None
+    return data, data.get('_rev', 0)
+
+def compare_and_swap(dni, expected_rev, data):
+    """Desa *data* (o l'esborra, amb ``None``) si ningú l'ha canviat des de *expected_rev*.
+
+    *expected_rev* és la revisió llegida amb ``get_search`` (``None``: la
+    cerca no ha d'existir).  Retorna la revisió nova; si la cerca ha
+    canviat entremig llança ``ConflictError``.  Només bloqueja durant la
+    comparació i l'escriptura (amb SQLite, una sola fila).
+    """
+    with get_backend().transaction() as tx:
+        return tx.cas(dni, expected_rev, data)
+
+def update_search(dni, mutate, retries=None):
+    """Actualització optimista d'una cerca amb reintents.
+
+    ``mutate(cerca)`` rep una còpia fresca (o ``None`` si no existeix) i
+    retorna ``(resultat, cerca_nova)``: la mateixa cerca modificada, una
+    de nova o ``None`` per esborrar-la.  Si no hi ha canvis no s'escriu
+    res.  Si un altre procés (el worker, una altra petició web) l'ha
+    canviat entremig, es torna a llegir i ``mutate`` s'aplica sobre la
+    versió nova: els canvis dels dos costats es conserven.  Retorna el
+    resultat de ``mutate``; ``ConflictError`` si s'esgoten els intents.
+    """
+    retries = CAS_RETRIES if retries is None else retries
+    for attempt in range(retries):
+        original, rev = get_search(dni)
+        result, new_data = mutate(thaw(original))
+        if new_data == original:
+            return result
         try:
-            os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(STATE_FILE), text=True)
-            with os.fdopen(fd, 'w', encoding='utf-8') as f:
-                json.dump(current_state, f, ensure_ascii=False, indent=4)
-            os.replace(tmp_path, STATE_FILE)
-        except Exception as e:
-            logger.error(f"Error guardant l'estat: {e}")
-            if 'tmp_path' in locals() and os.path.exists(tmp_path):
-                try:
-                    os.remove(tmp_path)
-                except:
-                    pass
+            compare_and_swap(dni, rev, new_data)
+            return result
+        except ConflictError:
+            logger.info(f"Conflicte desant la cerca {dni} (intent {attempt + 1}), reintentant")
+            time.sleep(0.01 * (attempt + 1))
+    raise ConflictError(dni)
+
+def _file_version():
+    try:
+        return _generation(os.stat(STATE_FILE))
+    except OSError:
+        return None
+
+def state_version():
+    """Versió de l'estat (o ``None`` si encara no n'hi ha).
+
+    Permet al worker saber si algú altre (l'app web) ha canviat l'estat
+    sense haver de llegir-lo sencer: amb el fitxer JSON és la seva
+    generació (inode, mida i mtime en ns: dues escriptures dins del mateix
+    tic del rellotge del sistema de fitxers tenen el mateix mtime); amb
+    SQLite, el comptador d'escriptures.
+    """
+    return get_backend().version()
+
+
+# Cada quant el worker bolca al disc els canvis en memòria (segons) ...
+CHECKPOINT_INTERVAL = float(os.getenv('STATE_CHECKPOINT_INTERVAL', 5))
+# ... o abans, si n'ha acumulat tants
+CHECKPOINT_MUTATIONS = int(os.getenv('STATE_CHECKPOINT_MUTATIONS', 500))
+
+
+def _changed_keys(base, ours):
+    """Claus que difereixen entre dues versions d'un registre (``None`` si és nou)."""
+    if base is None:
+        return None
+    return {key for key in set(base) | set(ours) if base.get(key, _MISSING) != ours.get(key, _MISSING)}
+
+
+_MISSING = object()
+
+
+class StateStore:
+    """Model en memòria de les cerques per al worker (write-behind).
+
+    El worker treballa sobre ``searches`` i marca amb ``mark()`` les
+    cerques que modifica; ``checkpoint()`` les bolca al fitxer cada
+    ``CHECKPOINT_INTERVAL`` segons o cada ``CHECKPOINT_MUTATIONS`` canvis.
+    Els canvis de l'app web (o d'altres workers) es detecten per la
+    versió del fitxer i s'apliquen com a esdeveniments: es compara cada
+    registre del disc amb l'última versió coneguda (``_base``) i només
+    els camps que hi difereixen sobreescriuen la còpia en memòria.  Una
+    cerca nova, reiniciada (``run_id`` diferent) o esborrada es
+    substitueix o s'elimina sencera.
+
+    Cada volta del worker costa un ``stat`` del fitxer (o una consulta
+    del comptador, amb SQLite); llegir l'estat només passa quan algú altre
+    l'ha canviat (amb SQLite, només les files canviades) i escriure'l,
+    quan toca checkpoint.
+    """
+
+    def __init__(self, checkpoint_interval=CHECKPOINT_INTERVAL,
+                 checkpoint_mutations=CHECKPOINT_MUTATIONS, backend=None):
+        self.backend = backend or get_backend()
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_mutations = checkpoint_mutations
+        self.searches = {}
+        # Còpia de l'últim estat llegit o escrit al disc (no comparteix objectes amb searches)
+        self._base = {}
+        self._version = None
+        self._dirty = set()
+        self._mutations = 0
+        self._checkpoint_at = time.time()
+        # Cerques canviades per fora detectades durant un checkpoint
+        self._events = set()
+        self.checkpoints = 0
+        self.events = 0
+
+    def load(self):
+        """Lectura inicial de l'estat sencer."""
+        with self.backend.transaction(write=False) as tx:
+            self._version, self._base, _ = tx.read()
+        self.searches = copy.deepcopy(self._base)
+        return self.searches
+
+    def refresh(self):
+        """Aplica els canvis fets per fora; retorna el conjunt de DNIs afectats."""
+        events, self._events = self._events, set()
+        if self.backend.version() != self._version:
+            with self.backend.transaction(write=False) as tx:
+                events |= self._apply(*tx.read(self._version))
+        return events
+
+    def mark(self, dnis):
+        """El worker ha modificat aquestes cerques en memòria."""
+        dnis = set(dnis)
+        self._dirty |= dnis
+        self._mutations += len(dnis)
+
+    def checkpoint(self, force=False):
+        """Desa les cerques modificades si toca (o sempre, amb *force*).
+
+        Dins de la transacció es rellegeix l'estat si ha canviat: els canvis
+        aliens s'incorporen abans d'escriure i només se sobreescriuen els
+        registres que ha tocat el worker (amb SQLite, només les seves
+        files, i només les columnes si és l'únic que ha canviat).
+        """
+        if not self._dirty:
+            return False
+        if not force and (time.time() - self._checkpoint_at < self.checkpoint_interval
+                          and self._mutations < self.checkpoint_mutations):
+            return False
+        with self.backend.transaction() as tx:
+            if tx.version() != self._version:
+                self._events |= self._apply(*tx.read(self._version))
+            fields = {}
+            for dni in self._dirty:
+                if dni in self.searches:
+                    ours = copy.deepcopy(self.searches[dni])
+                    fields[dni] = _changed_keys(self._base.get(dni), ours)
+                    self._base[dni] = ours
+            revs = tx.write(self._base, self._dirty, fields)
+            self._version = tx.version()
+        # La revisió l'assigna el backend: la còpia en memòria l'ha de tenir
+        for dni, rev in revs.items():
+            self._base[dni]['_rev'] = rev
+            if dni in self.searches:
+                self.searches[dni]['_rev'] = rev
+        self._dirty = set()
+        self._mutations = 0
+        self._checkpoint_at = time.time()
+        self.checkpoints += 1
+        return True
+
+    def _apply(self, version, rows, dnis):
+        """Incorpora una lectura del backend (``tx.read``) i retorna els DNIs canviats.
+
+        *rows* és l'estat sencer si *dnis* és ``None``; si no, només les
+        files canviades, i *dnis* les cerques que encara existeixen.
+        """
+        if dnis is None:
+            disk = rows
+        else:
+            disk = {dni: rows[dni] if dni in rows else self._base[dni]
+                    for dni in dnis if dni in rows or dni in self._base}
+        changed = self._merge(disk)
+        self._base = disk
+        self._version = version
+        return changed
+
+    def _merge(self, disk):
+        """Aplica a ``searches`` les diferències entre *disk* i ``_base``."""
+        changed = set()
+        for dni in set(self._base) | set(disk):
+            theirs, base = disk.get(dni), self._base.get(dni)
+            if theirs == base:
+                continue
+            changed.add(dni)
+            ours = self.searches.get(dni)
+            if theirs is None:
+                # Esborrada
+                self.searches.pop(dni, None)
+                self._dirty.discard(dni)
+            elif base is None or ours is None or theirs.get('run_id') != base.get('run_id'):
+                # Creada o reiniciada: el registre nou mana sencer
+                self.searches[dni] = copy.deepcopy(theirs)
+                self._dirty.discard(dni)
+            else:
+                for key in set(base) | set(theirs):
+                    if key not in theirs:
+                        ours.pop(key, None)
+                    elif theirs[key] != base.get(key):
+                        ours[key] = copy.deepcopy(theirs[key])
+        self.events += len(changed)
+        return changed
+
+    def snapshot(self):
+        return {
+            "searches": len(self.searches),
+            "dirty": len(self._dirty),
+            "checkpoints": self.checkpoints,
+            "events": self.events,
+        }
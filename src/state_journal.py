@@ -0,0 +1,398 @@
+"""
+Backend de diari de l'estat de les cerques (``STATE_BACKEND=journal``).
+
+En lloc de reescriure l'estat sencer, cada canvi s'afegeix com una línia
+JSON petita a ``data/state.journal``:
+
+* ``{"s": 17, "d": "<dni>", "set": {"current_zip_index": 4, …}, "unset": […]}``
+  (només els camps que han canviat: el progrés d'una volta del worker
+  són uns quants centenars de bytes, tinguin les cerques els CPs que tinguin);
+* ``{"s": 18, "d": "<dni>", "put": {…}}`` per a cerques noves o reescrites;
+* ``{"s": 19, "d": "<dni>", "del": 1}`` per a les esborrades.
+
+``s`` és un número de seqüència creixent.  L'estat és l'última
+instantània (``data/state.snapshot.json``, ``{"seq": N, "searches": …}``)
+més les línies del diari posteriors.  Cada procés en manté una còpia
+en memòria i només llegeix el tros de diari que encara no ha vist.
+
+El compactador (un fil del worker, cada ``STATE_COMPACT_INTERVAL``
+segons si el diari passa de ``STATE_COMPACT_BYTES``) escriu una
+instantània nova i comença un diari buit, que porta a la capçalera la
+seqüència de la instantània; un lector que s'hi creua ho detecta i torna
+a llegir.  Les escriptures (i la compactació) es fan amb ``flock`` sobre
+``data/state.journal.lock``.
+"""
+
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: només el lock entre fils
+    fcntl = None
+
+from src.state import ConflictError, freeze
+
+logger = logging.getLogger('state_manager')
+
+JOURNAL_FILE = os.path.join('data', 'state.journal')
+SNAPSHOT_FILE = os.path.join('data', 'state.snapshot.json')
+
+# Cada quant el compactador mira el diari (segons) ...
+COMPACT_INTERVAL = float(os.getenv('STATE_COMPACT_INTERVAL', 60))
+# ... i a partir de quina mida en fa una instantània nova
+COMPACT_BYTES = int(os.getenv('STATE_COMPACT_BYTES', 1024 * 1024))
+
+# Intents de lectura si una compactació es creua amb la lectura
+_READ_RETRIES = 5
+
+
+def _atomic_write(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', text=True)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _dumps(entry):
+    return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+class _JournalTransaction:
+    """Operacions amb el bloqueig agafat (vegeu ``state._JsonTransaction``)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def version(self):
+        return self.backend.version()
+
+    def read(self, since=None):
+        """``(versió, cerques, dnis)``; incremental si *since* és l'última lectura."""
+        return self.backend._read(since)
+
+    def get(self, dni):
+        return self.backend.get(dni)
+
+    def write(self, state, dnis=None, fields=None):
+        """Afegeix al diari els canvis de les cerques *dnis* de *state*.
+
+        Amb *fields* (``{dni: claus canviades}``) només s'hi escriuen
+        aquests camps.  Sense *dnis*, *state* substitueix l'estat sencer
+        (instantània nova).  Retorna les revisions noves.
+        """
+        backend = self.backend
+        if dnis is None:
+            backend._snapshot(copy.deepcopy(state))
+            return {}
+        current = backend._state
+        fields = fields or {}
+        entries, revs = [], {}
+        for dni in dnis:
+            data = state.get(dni)
+            if data is None:
+                if dni in current:
+                    entries.append({'d': dni, 'del': 1})
+                continue
+            changed = fields.get(dni)
+            if changed is not None and not changed:
+                continue  # Marcada però sense canvis
+            rev = current.get(dni, {}).get('_rev', 0) + 1
+            data['_rev'] = revs[dni] = rev
+            if changed is not None and dni in current:
+                changed = set(changed) | {'_rev'}
+                entries.append({
+                    'd': dni,
+                    'set': {k: data[k] for k in changed if k in data},
+                    'unset': [k for k in changed if k not in data],
+                })
+            else:
+                entries.append({'d': dni, 'put': data})
+        backend._append(entries)
+        return revs
+
+    def cas(self, dni, expected_rev, data):
+        """Desa (o esborra, amb ``None``) la cerca si la revisió és *expected_rev*."""
+        current = self.backend._state.get(dni)
+        if (None if current is None else current.get('_rev', 0)) != expected_rev:
+            raise ConflictError(dni)
+        if data is None:
+            self.backend._append([{'d': dni, 'del': 1}])
+            return None
+        data['_rev'] = (expected_rev or 0) + 1
+        self.backend._append([{'d': dni, 'put': data}])
+        return data['_rev']
+
+
+class JournalBackend:
+    """Instantània + diari d'escriptures, amb la còpia materialitzada en memòria."""
+
+    name = 'journal'
+
+    def __init__(self, journal=JOURNAL_FILE, snapshot=SNAPSHOT_FILE, json_file=None):
+        self.journal = journal
+        self.snapshot = snapshot
+        self.json_file = json_file
+        self._lock = threading.RLock()
+        self._state = None
+        self._seq = 0
+        # Fins on s'ha llegit el diari (i de quin fitxer: inode)
+        self._ino = None
+        self._offset = 0
+        # Versió de l'última lectura servida i cerques que hi han canviat
+        self._served = None
+        self._changed = set()
+        # Vistes de només lectura per cerca (es refan quan la cerca canvia)
+        self._views = {}
+        self._compactor = None
+        self.compactions = 0
+
+    # ── Bloqueig i versió ───────────────────────────────────────────
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.journal) or '.', exist_ok=True)
+        with open(self.journal + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def version(self):
+        try:
+            st = os.stat(self.journal)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    @contextmanager
+    def transaction(self, write=True):
+        with self._lock:
+            if not write:
+                self._sync()
+                yield _JournalTransaction(self)
+                return
+            with self._file_lock():
+                self._init_files()
+                self._sync()
+                yield _JournalTransaction(self)
+
+    # ── Lectura ────────────────────────────────────────────────────
+
+    def _init_files(self):
+        """Primer accés: instantània inicial (de ``state.json`` si n'hi ha) i diari buit."""
+        if os.path.exists(self.journal):
+            return
+        state = {}
+        if self.json_file and os.path.exists(self.json_file) and not os.path.exists(self.snapshot):
+            try:
+                with open(self.json_file, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                logger.info(f"Estat migrat de {self.json_file} al diari: {len(state)} cerques")
+            except Exception as e:
+                logger.error(f"Error llegint {self.json_file} per migrar-lo: {e}")
+        elif os.path.exists(self.snapshot):
+            self._seq, state = self._read_snapshot()
+        self._state = None
+        self._snapshot(state)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data.get('seq', 0), data.get('searches', {})
+        except FileNotFoundError:
+            return 0, {}
+
+    def _sync(self):
+        """Posa al dia la còpia en memòria; retorna si ha calgut rellegir-ho tot."""
+        if not os.path.exists(self.journal):
+            with self._file_lock():
+                self._init_files()
+        version = self.version()
+        if (self._state is None or version is None or version[0] != self._ino
+                or version[1] < self._offset):
+            self._reload()
+            return True
+        if version[1] > self._offset:
+            with open(self.journal, 'rb') as f:
+                f.seek(self._offset)
+                self._apply_lines(f.read())
+        return False
+
+    def _reload(self):
+        for _ in range(_READ_RETRIES):
+            seq, state = self._read_snapshot()
+            try:
+                f = open(self.journal, 'rb')
+            except FileNotFoundError:
+                self._state, self._seq, self._ino, self._offset = state, seq, None, 0
+                self._changed = set(state)
+                self._views = {}
+                return
+            with f:
+                ino = os.fstat(f.fileno()).st_ino
+                header = f.readline()
+                try:
+                    base = json.loads(header).get('base', 0)
+                except ValueError:
+                    base = 0
+                if base > seq:
+                    continue  # Compactació entremig: la instantània llegida ja és vella
+                self._state, self._seq, self._ino = state, seq, ino
+                self._offset = len(header)
+                self._changed = set(state)
+                self._views = {}
+                self._apply_lines(f.read())
+            return
+        raise RuntimeError("no s'ha pogut llegir un estat coherent del diari")
+
+    def _apply_lines(self, chunk):
+        """Aplica les línies completes de *chunk* i n'avança l'offset."""
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning("Línia del diari d'estat il·legible, s'ignora")
+                continue
+            self._apply(entry)
+        self._offset += end
+
+    def _apply(self, entry):
+        seq = entry.get('s', 0)
+        if seq <= self._seq:
+            return  # Ja inclosa a la instantània
+        self._seq = seq
+        dni = entry['d']
+        self._changed.add(dni)
+        self._views.pop(dni, None)
+        if 'put' in entry:
+            self._state[dni] = entry['put']
+        elif entry.get('del'):
+            self._state.pop(dni, None)
+        elif dni in self._state:
+            record = self._state[dni]
+            record.update(entry.get('set', {}))
+            for key in entry.get('unset', []):
+                record.pop(key, None)
+
+    def _read(self, since=None):
+        """Lectura amb el bloqueig agafat (vegeu ``_JournalTransaction.read``)."""
+        version = self.version()
+        incremental = since is not None and since == self._served
+        changed, self._changed = self._changed, set()
+        self._served = version
+        if not incremental:
+            return version, copy.deepcopy(self._state), None
+        rows = {dni: copy.deepcopy(self._state[dni]) for dni in changed if dni in self._state}
+        return version, rows, set(self._state)
+
+    def _view(self, dni):
+        view = self._views.get(dni)
+        if view is None and dni in self._state:
+            view = self._views[dni] = freeze(self._state[dni])
+        return view
+
+    def view(self):
+        """Estat sencer de només lectura (les cerques sense canvis reutilitzen la vista)."""
+        with self._lock:
+            self._sync()
+            return freeze({dni: self._view(dni) for dni in self._state})
+
+    def get(self, dni):
+        with self._lock:
+            self._sync()
+            return self._view(dni)
+
+    def query(self, owner_id=None, active=None, orphans=False):
+        from src.state import _filter
+        with self._lock:
+            self._sync()
+            return {dni: self._view(dni) for dni in _filter(self._state, owner_id, active, orphans)}
+
+    def count(self, active=None):
+        from src.state import _filter
+        with self._lock:
+            self._sync()
+            return len(_filter(self._state, None, active))
+
+    # ── Escriptura ─────────────────────────────────────────────────
+
+    def _append(self, entries):
+        """Afegeix *entries* al diari (amb el bloqueig i la còpia al dia)."""
+        if not entries:
+            return
+        lines = []
+        for entry in entries:
+            entry = {'s': self._seq + 1, **entry}
+            lines.append(_dumps(entry))
+            self._apply(copy.deepcopy(entry))
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        with open(self.journal, 'ab') as f:
+            f.write(data)
+        self._offset += len(data)
+        # Les nostres pròpies escriptures no són canvis "aliens"
+        for entry in entries:
+            self._changed.discard(entry['d'])
+        self._served = self.version()
+
+    def _snapshot(self, state):
+        """Instantània de *state* i diari nou buit (amb el bloqueig agafat)."""
+        os.makedirs(os.path.dirname(self.snapshot) or '.', exist_ok=True)
+        _atomic_write(self.snapshot, json.dumps({'seq': self._seq, 'searches': state},
+                                                ensure_ascii=False))
+        header = _dumps({'base': self._seq}) + '\n'
+        _atomic_write(self.journal, header)
+        if state is not self._state:
+            self._views = {}
+        self._state = state
+        self._ino = os.stat(self.journal).st_ino
+        self._offset = len(header.encode('utf-8'))
+
+    # ── Compactació ────────────────────────────────────────────────
+
+    def compact(self, force=False):
+        """Escriu una instantània nova si el diari és prou gran (o sempre, amb *force*)."""
+        version = self.version()
+        if not force and (version is None or version[1] < COMPACT_BYTES):
+            return False
+        started = time.monotonic()
+        with self._lock, self._file_lock():
+            self._sync()
+            size = self._offset
+            # La còpia en memòria no canvia: les lectures incrementals continuen
+            self._snapshot(self._state)
+        self.compactions += 1
+        logger.info(f"Diari d'estat compactat: {size // 1024} KB → instantània de "
+                    f"{len(self._state)} cerques ({(time.monotonic() - started) * 1000:.0f} ms)")
+        return True
+
+    def start_compactor(self, interval=COMPACT_INTERVAL):
+        """Arrenca el fil de compactació en segon pla (un per procés)."""
+        if self._compactor is not None:
+            return
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.error(f"Error compactant el diari d'estat: {e}")
+        self._compactor = threading.Thread(target=run, name='state-compactor', daemon=True)
+        self._compactor.start()
@@ -0,0 +1,300 @@
+"""
+Backend SQLite de l'estat de les cerques (``STATE_BACKEND=sqlite``).
+
+Una fila per cerca a ``data/state.db`` (mode WAL, de manera que l'app
+web llegeix mentre el worker escriu):
+
+* ``owner_id``, ``active``, ``current_zip_index`` i ``status_message`` són
+  columnes pròpies (amb índexs a ``owner_id`` i ``active``); la resta del
+  registre va en JSON a ``data``;
+* ``version`` és el comptador global (taula ``meta``) de l'última
+  transacció que ha escrit la fila.  Cada escriptura l'incrementa un cop,
+  i així el worker només rellegeix les files que han canviat.  És també
+  la revisió de la cerca (``_rev``) per a ``compare_and_swap``.
+
+Avançar ``current_zip_index`` o canviar ``status_message`` és un
+``UPDATE`` de dues columnes, no una reescriptura del registre (ni de
+tot l'estat, com amb el fitxer JSON).
+
+Les consultes de l'app web (``view``, ``get``, ``query``, ``count``)
+guarden el resultat, congelat, fins que canvia la versió: mentre ningú
+escriu, un sondeig costa una lectura del comptador.
+
+En obrir-lo per primer cop, si hi ha ``data/state.json`` se n'importen
+les cerques (el fitxer es deixa com a còpia).  ``scripts/migrate_state.py``
+fa la migració (o la inversa) a mà.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from src.state import ConflictError, freeze
+
+logger = logging.getLogger('state_manager')
+
+STATE_DB = os.getenv('STATE_DB', os.path.join('data', 'state.db'))
+
+# Camps amb columna pròpia: es poden actualitzar sense tocar ``data``
+COLUMNS = ('owner_id', 'active', 'current_zip_index', 'status_message')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS searches (
+    dni TEXT PRIMARY KEY,
+    owner_id TEXT,
+    active INTEGER,
+    current_zip_index INTEGER,
+    status_message TEXT,
+    version INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_searches_owner ON searches(owner_id);
+CREATE INDEX IF NOT EXISTS idx_searches_active ON searches(active);
+CREATE INDEX IF NOT EXISTS idx_searches_version ON searches(version);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+
+
+def _split(data):
+    """Registre → ``(columnes, json)``.  Els ``None`` es queden al JSON."""
+    columns = {}
+    rest = dict(data)
+    rest.pop('_rev', None)
+    for key in COLUMNS:
+        if rest.get(key) is not None:
+            columns[key] = rest.pop(key)
+    if 'active' in columns:
+        columns['active'] = int(bool(columns['active']))
+    return columns, json.dumps(rest, ensure_ascii=False)
+
+
+def _join(row):
+    owner_id, active, index, message, version, blob = row
+    data = json.loads(blob)
+    data['_rev'] = version
+    if owner_id is not None:
+        data['owner_id'] = owner_id
+    if active is not None:
+        data['active'] = bool(active)
+    if index is not None:
+        data['current_zip_index'] = index
+    if message is not None:
+        data['status_message'] = message
+    return data
+
+
+_SELECT = ("SELECT dni, owner_id, active, current_zip_index, status_message, version, data "
+           "FROM searches")
+
+
+class _SqliteTransaction:
+    """Operacions dins d'una transacció (vegeu ``state.JsonBackend``)."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._bumped = None
+
+    def version(self):
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def read(self, since=None):
+        """``(versió, files, dnis)``: totes les files o les canviades des de *since*.
+
+        Amb *since*, ``dnis`` són totes les cerques existents (per
+        detectar les esborrades); sense, és ``None`` (les files són l'estat sencer).
+        """
+        version = self.version()
+        if since is None:
+            rows = self.conn.execute(_SELECT).fetchall()
+            return version, {r[0]: _join(r[1:]) for r in rows}, None
+        rows = self.conn.execute(_SELECT + " WHERE version > ?", (since,)).fetchall()
+        dnis = {r[0] for r in self.conn.execute("SELECT dni FROM searches")}
+        return version, {r[0]: _join(r[1:]) for r in rows}, dnis
+
+    def query(self, owner_id=None, active=None, orphans=False):
+        clauses, params = [], []
+        if owner_id is not None:
+            clauses.append("(owner_id = ? OR owner_id IS NULL)" if orphans else "owner_id = ?")
+            params.append(owner_id)
+        if active is not None:
+            clauses.append("active = 1" if active else "(active IS NULL OR active = 0)")
+        sql = _SELECT + (" WHERE " + " AND ".join(clauses) if clauses else "")
+        return {r[0]: _join(r[1:]) for r in self.conn.execute(sql, params)}
+
+    def count(self, active=None):
+        sql = "SELECT COUNT(*) FROM searches"
+        if active is not None:
+            sql += " WHERE active = 1" if active else " WHERE active IS NULL OR active = 0"
+        return self.conn.execute(sql).fetchone()[0]
+
+    def get(self, dni):
+        row = self.conn.execute(_SELECT + " WHERE dni = ?", (dni,)).fetchone()
+        return _join(row[1:]) if row else None
+
+    def _next_version(self):
+        if self._bumped is None:
+            self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            self._bumped = self.version()
+        return self._bumped
+
+    def write(self, state, dnis=None, fields=None):
+        """Desa les files *dnis* de *state* (o tot *state*, esborrant la resta).
+
+        *fields* (``{dni: claus canviades}``) permet fer un ``UPDATE`` només
+        de les columnes quan les úniques claus canviades en tenen.
+        """
+        fields = fields or {}
+        revs = {}
+        if dnis is None:
+            existing = {r[0] for r in self.conn.execute("SELECT dni FROM searches")}
+            for dni in existing - set(state):
+                self._delete(dni)
+            dnis = state
+        for dni in dnis:
+            data = state.get(dni)
+            if data is None:
+                self._delete(dni)
+                continue
+            changed = fields.get(dni)
+            if changed is not None and not changed:
+                continue  # Marcada però sense canvis
+            if changed and set(changed) <= set(COLUMNS) and all(data.get(k) is not None for k in changed):
+                columns, _ = _split({k: data[k] for k in changed})
+                sets = ", ".join(f"{k} = ?" for k in columns)
+                self.conn.execute(f"UPDATE searches SET {sets}, version = ? WHERE dni = ?",
+                                  (*columns.values(), self._next_version(), dni))
+            else:
+                self._put(dni, data)
+            revs[dni] = self._next_version()
+        return revs
+
+    def _put(self, dni, data):
+        columns, blob = _split(data)
+        values = [columns.get(k) for k in COLUMNS]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO searches "
+            "(dni, owner_id, active, current_zip_index, status_message, version, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (dni, *values, self._next_version(), blob))
+
+    def cas(self, dni, expected_rev, data):
+        """Desa (o esborra, amb ``None``) la fila si la seva versió és *expected_rev*."""
+        row = self.conn.execute("SELECT version FROM searches WHERE dni = ?", (dni,)).fetchone()
+        if (row[0] if row else None) != expected_rev:
+            raise ConflictError(dni)
+        if data is None:
+            self._delete(dni)
+            return None
+        self._put(dni, data)
+        return self._next_version()
+
+    def _delete(self, dni):
+        self.conn.execute("DELETE FROM searches WHERE dni = ?", (dni,))
+        self._next_version()
+
+
+class SqliteBackend:
+    """Estat a SQLite/WAL, amb una connexió per fil."""
+
+    name = 'sqlite'
+
+    def __init__(self, path=STATE_DB, json_file=None):
+        self.path = path
+        self.json_file = json_file
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        # (versió, {consulta: resultat}): resultats congelats de la versió vigent
+        self._cache = (None, {})
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Autocommit: les transaccions s'obren explícitament amb BEGIN
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(_SCHEMA)
+                    self._migrate_json(conn)
+                    self._initialized = True
+        return conn
+
+    @contextmanager
+    def transaction(self, write=True):
+        """Transacció (``BEGIN IMMEDIATE`` si és d'escriptura); confirma en sortir."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield _SqliteTransaction(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def version(self):
+        return _SqliteTransaction(self._conn()).version()
+
+    def _cached(self, key, compute):
+        """Resultat de *compute* per a la versió actual, reutilitzat fins que canviï."""
+        version = self.version()
+        if self._cache[0] != version:
+            self._cache = (version, {})
+        results = self._cache[1]
+        if key not in results:
+            results[key] = compute()
+        return results[key]
+
+    def view(self):
+        """Estat sencer de només lectura; només es rellegeix si ha canviat la versió."""
+        def compute():
+            with self.transaction(write=False) as tx:
+                return freeze(tx.read()[1])
+        return self._cached(('view',), compute)
+
+    def get(self, dni):
+        return self._cached(('get', dni), lambda: freeze(_SqliteTransaction(self._conn()).get(dni)))
+
+    def query(self, owner_id=None, active=None, orphans=False):
+        def compute():
+            rows = _SqliteTransaction(self._conn()).query(owner_id, active, orphans)
+            return {dni: freeze(data) for dni, data in rows.items()}
+        return dict(self._cached(('query', owner_id, active, orphans), compute))
+
+    def count(self, active=None):
+        return self._cached(('count', active), lambda: _SqliteTransaction(self._conn()).count(active))
+
+    def _migrate_json(self, conn):
+        """Importa ``state.json`` la primera vegada que s'obre la base de dades."""
+        if not self.json_file or not os.path.exists(self.json_file):
+            return
+        if conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        try:
+            with open(self.json_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as e:
+            logger.error(f"Error llegint {self.json_file} per migrar-lo: {e}")
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Un altre procés pot haver-lo migrat mentre llegíem
+            done = conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+            if done is None:
+                tx = _SqliteTransaction(conn)
+                if not tx.count():
+                    tx.write(state)
+                    logger.info(f"Estat migrat de {self.json_file} a {self.path}: {len(state)} cerques")
+                conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (time.time(),))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
@@ -0,0 +1,293 @@
+"""
+Cua de treball contínua del worker.
+
+En lloc de llançar un lot per cerca i esperar que acabin *tots* els CPs
+abans de tornar a planificar, el worker manté sempre ple un executor de
+llarga durada: cada cop que una comprovació acaba se n'aplica el resultat
+i el forat es torna a omplir.  Aquesta classe recorda, per a cada
+cerca, quins CPs ja s'han enviat en el cicle actual, quins són en vol i
+quins s'han de repetir perquè el resultat ha estat desconegut.
+
+Els forats lliures es reparteixen entre les cerques en marxa per servei
+rebut ponderat (com el *vruntime* del planificador CFS de Linux): cada
+comprovació suma a la cerca les peticions SEPE que li costen de mitjana
+dividides pel seu pes, i cada forat va a la cerca que acabaria abans
+(en temps virtual) les seves ``FAIR_SHARE_HORIZON`` comprovacions
+següents.  Entre cerques grans això és un repartiment just segons el pes;
+una cerca a la qual queden pocs CPs (o acabada de començar) passa al
+davant fins a ``depth`` CPs en vol, en lloc de quedar darrere d'una
+cerca regional de 50 CPs amb dos canals.
+
+L'índex persistent ``current_zip_index`` continua comptant CPs comprovats
+sense cita; el cursor en memòria només evita enviar dues vegades el
+mateix CP mentre el cicle està en curs.
+
+Cada cursor té un ``CancelToken`` que comparteixen totes les
+comprovacions del cicle: quan la cerca troba cita, s'atura, s'esborra o
+es reinicia, el token es cancel·la i les comprovacions en vol se salten
+la resta de la cadena SEPE.
+
+Un CP amb resultat desconegut es repeteix com a màxim ``MAX_ZIP_RETRIES``
+vegades per cicle; després es dona per no trobat (es tornarà a mirar al
+cicle següent) perquè un CP que SEPE no respon mai no encalli la cerca.
+"""
+
+import os
+import logging
+import threading
+import time
+from collections import deque
+
+from src.sepe_api import CancelToken
+
+logger = logging.getLogger(__name__)
+
+# Comprovacions pendents que compten per decidir qui rep el pròxim forat
+FAIR_SHARE_HORIZON = int(os.getenv('FAIR_SHARE_HORIZON', 10))
+
+# Reintents per CP i cicle quan el resultat és desconegut
+MAX_ZIP_RETRIES = int(os.getenv('MAX_ZIP_RETRIES', 3))
+
+# Peticions de la cadena comunes a tots els canals (pàgina + passos 2‑8)
+_CHAIN_CALLS = 8
+
+
+class _Cursor:
+    def __init__(self, dni: str, key: tuple, start: int, zips: list, cost: float):
+        self.dni = dni
+        self.key = key
+        self.zips = zips
+        self.next_pos = start
+        self.retry: deque[str] = deque()
+        self.in_flight: set[str] = set()
+        # Reintents fets per CP en aquest cicle
+        self.retries: dict[str, int] = {}
+        self.weight = 1.0
+        # Servei rebut en el cicle: peticions estimades / pes
+        self.vruntime = 0.0
+        # Peticions SEPE estimades per comprovació (mitjana mòbil)
+        self.cost = cost
+        self.token = CancelToken()
+
+    def has_next(self) -> bool:
+        return bool(self.retry) or self.next_pos < len(self.zips)
+
+    def remaining(self) -> int:
+        return len(self.retry) + max(len(self.zips) - self.next_pos, 0)
+
+    def finish_tag(self, horizon: int) -> float:
+        """Temps virtual en què acabaria les *horizon* comprovacions següents."""
+        return self.vruntime + min(self.remaining(), horizon) * self.cost / self.weight
+
+    def ready(self, depth: int) -> bool:
+        return self.has_next() and len(self.in_flight) < depth
+
+    def next_zip(self) -> str | None:
+        while self.has_next():
+            if self.retry:
+                zip_code = self.retry.popleft()
+            else:
+                zip_code = self.zips[self.next_pos]
+                self.next_pos += 1
+            if zip_code not in self.in_flight:
+                return zip_code
+        return None
+
+
+class WorkQueue:
+    """Seguiment dels CPs enviats per cerca i repartiment just dels forats.
+
+    Parameters
+    ----------
+    depth : int  – CPs en vol com a màxim per cerca (``BATCH_SIZE``).
+    slots : int  – Comprovacions en vol com a màxim entre totes les cerques.
+    """
+
+    def __init__(self, depth: int, slots: int):
+        self.depth = max(1, depth)
+        self.slots = max(1, slots)
+        self._lock = threading.Lock()
+        self._cursors: dict[str, _Cursor] = {}
+        # Cerques amb CPs pendents de rebre forat
+        self._waiting: set[str] = set()
+        self._in_flight = 0
+        self._completed: deque[float] = deque()
+        self.completed_total = 0
+
+    def activate(self, dni: str, data: dict) -> None:
+        """Afegeix una cerca que toca al repartiment.
+
+        El cursor es reinicia si la cerca s'ha reiniciat (``run_id``) o ha
+        començat un cicle nou.
+        """
+        key = (data.get('run_id', 0), data.get('cycle_start_time'))
+        with self._lock:
+            cursor = self._cursors.get(dni)
+            if cursor is None or cursor.key != key:
+                if cursor is not None and cursor.key[0] != key[0]:
+                    cursor.token.cancel("cerca reiniciada")
+                cost = cursor.cost if cursor else _CHAIN_CALLS + len(data.get('appt_types') or ['person'])
+                cursor = self._cursors[dni] = _Cursor(
+                    dni, key, data.get('current_zip_index', 0), list(data.get('zips', [])), cost)
+            cursor.weight = max(float(data.get('weight', 1) or 1), 0.1)
+            if cursor.has_next():
+                self._waiting.add(dni)
+
+    def allocate(self) -> list[tuple[str, str]]:
+        """Reparteix els forats lliures entre les cerques actives.
+
+        Cada forat va a la cerca amb el ``finish_tag`` més baix d'entre les
+        que encara poden tenir més CPs en vol.  Retorna ``[(dni, zip), …]``;
+        primer es repeteixen els CPs amb resultat desconegut i després es
+        continua per la llista.
+        """
+        taken = []
+        with self._lock:
+            free = self.slots - self._in_flight
+            for dni in [d for d in self._waiting
+                        if d not in self._cursors or not self._cursors[d].has_next()]:
+                self._waiting.discard(dni)
+            while free > 0:
+                ready = [self._cursors[d] for d in self._waiting
+                         if self._cursors[d].ready(self.depth)]
+                if not ready:
+                    break
+                cursor = min(ready, key=lambda c: (c.finish_tag(FAIR_SHARE_HORIZON), c.dni))
+                zip_code = cursor.next_zip()
+                if zip_code is None:
+                    self._waiting.discard(cursor.dni)
+                    continue
+                cursor.in_flight.add(zip_code)
+                cursor.vruntime += cursor.cost / cursor.weight
+                self._in_flight += 1
+                free -= 1
+                taken.append((cursor.dni, zip_code))
+        return taken
+
+    def complete(self, dni: str, zip_code: str, run_id, found, calls: int = 0):
+        """Allibera un CP en vol; si el resultat és desconegut (``None``) es repetirà.
+
+        *calls* són les peticions SEPE que ha costat la comprovació.  Retorna
+        el resultat que s'ha d'aplicar: *found*, o ``False`` si el CP ja ha
+        esgotat els ``MAX_ZIP_RETRIES`` reintents del cicle.
+        """
+        now = time.time()
+        with self._lock:
+            self._in_flight = max(self._in_flight - 1, 0)
+            self.completed_total += 1
+            self._completed.append(now)
+            while self._completed and now - self._completed[0] > 60:
+                self._completed.popleft()
+
+            cursor = self._cursors.get(dni)
+            if cursor is None:
+                return found
+            cursor.cost = 0.8 * cursor.cost + 0.2 * max(calls, 1)
+            if cursor.key[0] != run_id or zip_code not in cursor.in_flight:
+                return found
+            cursor.in_flight.discard(zip_code)
+            if found is None:
+                retries = cursor.retries.get(zip_code, 0)
+                if retries >= MAX_ZIP_RETRIES:
+                    logger.warning(f"CP {zip_code} ({dni}): {retries} reintents sense resposta, "
+                                   f"es dona per no trobat fins al cicle següent")
+                    cursor.retries.pop(zip_code, None)
+                    return False
+                cursor.retries[zip_code] = retries + 1
+                cursor.retry.append(zip_code)
+                self._waiting.add(dni)
+            else:
+                cursor.retries.pop(zip_code, None)
+            return found
+
+    def release(self, dni: str, zip_code: str) -> None:
+        """Retorna un forat reservat per ``allocate`` que no s'ha arribat a llançar."""
+        with self._lock:
+            self._in_flight = max(self._in_flight - 1, 0)
+            cursor = self._cursors.get(dni)
+            if cursor is not None:
+                cursor.in_flight.discard(zip_code)
+
+    def prune(self, active_dnis, draining=()) -> None:
+        """Oblida els cursors de cerques esborrades o aturades (i en cancel·la el vol).
+
+        Les de *draining* (mode repartit) s'obliden sense cancel·lar: les
+        comprovacions en vol acaben i se n'apliquen els resultats.
+        """
+        with self._lock:
+            for dni in list(self._cursors):
+                if dni not in active_dnis:
+                    cursor = self._cursors.pop(dni)
+                    if dni not in draining:
+                        cursor.token.cancel("cerca aturada")
+            self._waiting &= set(self._cursors)
+
+    def token(self, dni: str) -> CancelToken | None:
+        """Token de cancel·lació del cicle en curs de la cerca."""
+        with self._lock:
+            cursor = self._cursors.get(dni)
+            return cursor.token if cursor else None
+
+    def cancel(self, dni: str, reason: str, run_id=None) -> bool:
+        """Cancel·la les comprovacions en vol de la cerca i n'oblida el cursor.
+
+        Amb *run_id*, només si el cursor és d'una altra execució
+        (la cerca s'ha reiniciat).  Retorna si s'ha cancel·lat res.
+        """
+        with self._lock:
+            cursor = self._cursors.get(dni)
+            if cursor is None or (run_id is not None and cursor.key[0] == run_id):
+                return False
+            del self._cursors[dni]
+            self._waiting.discard(dni)
+            cursor.token.cancel(reason)
+            return bool(cursor.in_flight)
+
+    def has_work(self, dni: str) -> bool:
+        """La cerca té CPs en vol o pendents de rebre un forat."""
+        with self._lock:
+            cursor = self._cursors.get(dni)
+            return cursor is not None and (bool(cursor.in_flight) or cursor.has_next())
+
+    def in_flight(self, dni: str | None = None) -> int:
+        """CPs en vol d'una cerca (o de totes si *dni* és ``None``)."""
+        with self._lock:
+            if dni is not None:
+                cursor = self._cursors.get(dni)
+                return len(cursor.in_flight) if cursor else 0
+            return self._in_flight
+
+    def resize(self, slots: int | None = None, depth: int | None = None) -> None:
+        """Canvia els forats totals i/o la profunditat per cerca (autoescalat).
+
+        Si n'hi ha menys que en vol, els que sobren no es tornen a omplir.
+        """
+        with self._lock:
+            if slots is not None:
+                self.slots = max(1, slots)
+            if depth is not None:
+                self.depth = max(1, depth)
+
+    def backlog(self) -> tuple[int, int]:
+        """``(CPs pendents de forat, cerques frenades per la profunditat)``."""
+        with self._lock:
+            cursors = [self._cursors[d] for d in self._waiting if d in self._cursors]
+            pending = sum(c.remaining() for c in cursors)
+            blocked = sum(1 for c in cursors if c.has_next() and len(c.in_flight) >= self.depth)
+            return pending, blocked
+
+    def zips_per_minute(self) -> int:
+        """CPs comprovats durant l'últim minut."""
+        now = time.time()
+        with self._lock:
+            return sum(1 for t in self._completed if now - t <= 60)
+
+    def snapshot(self) -> dict:
+        return {
+            "depth": self.depth,
+            "slots": self.slots,
+            "in_flight": self.in_flight(),
+            "queued_searches": len(self._waiting),
+            "completed": self.completed_total,
+            "zips_per_min": self.zips_per_minute(),
+        }
@@ -1,18 +1,29 @@
 ﻿import time
 import os
+import asyncio
+import atexit
 import logging
+import signal
 import sys
+import threading
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 
 # Afegim el directori arrel al path per poder importar src
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from src.sepe_api import check_zip
-from src.state import load_state, save_state
+from src.sepe_api import (check_zip, get_session_stats, rate_limiter, circuit_breaker,
+                          sepe_metrics)
+from src import runtime_stats
+from src import zip_history
+from src.work_queue import WorkQueue
+from src.scheduler import SearchScheduler, next_daily_run
+from src.state import StateStore
+from src.leases import LeaseManager
+from src.autoscaler import ConcurrencyAutoscaler
 from src.email_service import send_email, build_appointment_email
-from src.search_service import MAX_RECURRENCE_HOURS, MAX_RECURRENCE_HOURS_DAILY
+from src.search_service import MAX_RECURRENCE_HOURS, MAX_RECURRENCE_HOURS_DAILY, sweep_retention
 
 # Configurar logging — stdout + fitxer rotatiu perquè /api/logs pugui llegir-lo
 LOG_FILE = os.path.join(os.path.dirname(__file__), '..', 'data', 'worker.log')
@@ -33,8 +44,12 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 
-def check_single_zip(dni, data, zip_code):
-    """Comprova un sol codi postal via HTTP API (sense Chrome)."""
+def check_single_zip(dni, data, zip_code, cancel=None):
+    """Comprova un sol codi postal via HTTP API (sense Chrome).
+
+    Si es cancel·la *cancel* (``CancelToken``) la cadena s'atura abans de
+    la petició següent i el resultat és incert.
+    """
     try:
         logger.info(f"--> [Thread] Comprovant DNI {dni} a CP {zip_code}")
         
@@ -48,236 +63,631 @@ def check_single_zip(dni, data, zip_code):
             zip_code=zip_code, 
             dni=dni, 
             appt_types=appt_types,
-            tramite_id=tramite_id
+            tramite_id=tramite_id,
+            cancel=cancel
         )
-        
-        # Extreure info d'oficines (si n'hi ha)
-        offices_info = results.get('offices', [])
-        
-        # Mirar si algun tipus ha trobat cita
-        for appt_type, found in results.items():
-            if appt_type == 'offices':
-                continue  # Skip metadata key
-            if found:
-                type_name = 'Presencial' if appt_type == 'person' else 'Telefònica'
-                logger.info(f"!!! CITA {type_name} TROBADA per {dni} a {zip_code} !!!")
-                return True, zip_code, appt_type, offices_info
-        
-        return False, None, None, []
+        return _interpret_results(dni, zip_code, appt_types, results)
             
     except Exception as e:
         logger.error(f"Error comprovant per {dni} a {zip_code}: {e}")
-        return False, None, None, []
+        return None, None, None, [], 0
 
-def run_worker():
-    logger.info("Iniciant Worker del Bot SEPE...")
-    
+
+async def check_single_zip_async(client, dni, data, zip_code, cancel=None):
+    """Equivalent asíncron de ``check_single_zip`` sobre un ``AsyncSepeClient``."""
     try:
-        MAX_WORKERS = int(os.getenv('MAX_WORKERS', 3)) # Fils simultanis per verificar CPs en paral·lel
-    except ValueError:
-        MAX_WORKERS = 3
+        logger.info(f"--> [Async] Comprovant DNI {dni} a CP {zip_code}")
+        tramite_id = data.get('tramite_id', '158')
+        appt_types = data.get('appt_types', [data.get('type', 'person')])
+        results = await client.check_zip(zip_code, dni, appt_types, tramite_id, cancel)
+        return _interpret_results(dni, zip_code, appt_types, results)
+    except Exception as e:
+        logger.error(f"Error comprovant per {dni} a {zip_code}: {e}")
+        return None, None, None, [], 0
+
+
+def _interpret_results(dni, zip_code, appt_types, results):
+    """Converteix el dict de ``check_zip`` a ``(found, zip, type, offices, calls)``.
+
+    ``found`` és ``None`` quan el resultat és incert (SEPE caigut o circuit
+    obert): el CP s'ha de tornar a comprovar, no comptar com a "no trobat".
+    ``calls`` són les peticions SEPE que ha costat la comprovació.
+    """
+    # Extreure info d'oficines (si n'hi ha)
+    offices_info = results.get('offices', [])
+    meta = results.get('meta', {})
+    calls = meta.get('round_trips', 0)
+    notes = []
+    if meta.get('session_reused'):
+        notes.append('sessió reutilitzada')
+    if meta.get('cache') in ('hit', 'confirm', 'dead'):
+        notes.append(f"cache: {meta['cache']}")
+    if meta.get('cancelled'):
+        notes.append('cancel·lada')
+    logger.info(f"    CP {zip_code}: {meta.get('round_trips', '?')} peticions SEPE"
+                f"{' (' + ', '.join(notes) + ')' if notes else ''}")
     
+    # Mirar si algun tipus ha trobat cita (ignorant claus de metadades)
+    for appt_type in appt_types:
+        if results.get(appt_type):
+            type_name = 'Presencial' if appt_type == 'person' else 'Telefònica'
+            logger.info(f"!!! CITA {type_name} TROBADA per {dni} a {zip_code} !!!")
+            return True, zip_code, appt_type, offices_info, calls
+    
+    if results.get('unknown'):
+        return None, None, None, [], calls
+    return False, None, None, [], calls
+
+
+_last_stats_log = 0.0
+_last_stats_publish = 0.0
+_last_retention_sweep = 0.0
+
+
+def _report_stats(queue, store, leases=None, autoscaler=None):
+    """Publica les mètriques per a l'app web i en deixa un resum al log."""
+    global _last_stats_publish
+    if time.time() - _last_stats_publish >= _env_int('STATS_PUBLISH_INTERVAL', 5):
+        _last_stats_publish = time.time()
+        sections = {
+            'rate_limiter': rate_limiter.snapshot(),
+            'circuit_breaker': circuit_breaker.snapshot(),
+            'sepe_client': get_session_stats(),
+            'sepe_metrics': sepe_metrics.snapshot(),
+            'check_duration': sepe_metrics.checks_snapshot(),
+            'worker': queue.snapshot(),
+            'state': store.snapshot(),
+            'zip_history': zip_history.snapshot(),
+        }
+        if leases is not None:
+            sections['leases'] = leases.snapshot()
+        if autoscaler is not None:
+            sections['autoscaler'] = autoscaler.snapshot()
+        runtime_stats.publish(sections)
+    _log_client_stats(queue)
+
+
+def _log_client_stats(queue):
+    """Escriu periòdicament un resum dels comptadors del client SEPE."""
+    global _last_stats_log
+    interval = _env_int('STATS_LOG_INTERVAL', 60)
+    if time.time() - _last_stats_log < interval:
+        return
+    _last_stats_log = time.time()
+    stats = get_session_stats()
+    logger.info(
+        f"[STATS] comprovacions executades={stats['executed']} agrupades={stats['coalesced']} "
+        f"cache_hits={stats['cache_hits']} peticions/comprovació={stats['avg_round_trips']} "
+        f"sessions reutilitzades={stats['sessions_reused']} rebutjades={stats['sessions_rejected']} "
+        f"ritme={rate_limiter.rate:.2f}/s "
+        f"CPs/min={queue.zips_per_minute()} en_vol={queue.in_flight()}/{queue.slots} "
+        f"profunditat={queue.depth}"
+    )
+    logger.info(f"[METRICS] {sepe_metrics.summary_line()}")
+
+
+def _sweep_retention():
+    """Aplica la retenció de cerques acabades cada ``SEARCH_RETENTION_INTERVAL`` segons.
+
+    Els canvis es fan a l'estat com els de l'app web: el ``StateStore``
+    els rep com a esdeveniments a la volta següent.
+    """
+    global _last_retention_sweep
+    if time.time() - _last_retention_sweep < _env_int('SEARCH_RETENTION_INTERVAL', 600):
+        return
+    _last_retention_sweep = time.time()
     try:
-        BATCH_SIZE = int(os.getenv('BATCH_SIZE', 3)) # CPs a comprovar per DNI per iteració
+        counts = sweep_retention()
+    except Exception as e:
+        logger.error(f"Error aplicant la retenció de cerques: {e}")
+        return
+    if counts['archived'] or counts['evicted'] or counts['compacted']:
+        logger.info(f"Retenció: {counts['archived']} cerques acabades arxivades, "
+                    f"{counts['evicted']} esborrades de l'estat, "
+                    f"{counts['compacted']} línies d'arxiu compactades")
+
+
+def _outage_pause():
+    """Segons a esperar abans de la propera iteració si el circuit no accepta peticions.
+
+    Amb la prova del circuit mig obert en curs, el bucle es desperta
+    quan acaba (és una de les comprovacions pendents) o, com a molt, a
+    la pròxima comprovació de l'estat.
+    """
+    if circuit_breaker.probe_in_flight:
+        return STATE_POLL_INTERVAL
+    wait = circuit_breaker.retry_after()
+    if wait > 0:
+        logger.info(f"SEPE no disponible (circuit obert): esperant {wait:.0f}s abans de reprendre")
+    return min(wait, 60)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
     except ValueError:
-        BATCH_SIZE = 3
-        
-    logger.info(f"Worker configurat amb {MAX_WORKERS} fils simultanis i BATCH_SIZE={BATCH_SIZE}.")
+        return default
 
-    while True:
-        try:
-            start_time = time.time()
-            active_searches = load_state()
-            
-            if not active_searches:
-                # Si no hi ha res a fer, dormim més
-                time.sleep(10)
-                continue
 
-            # Itera sobre còpia per seguretat
-            active_items = list(active_searches.items())
-            updates_made = False
+def _set_status(data, message):
+    """Canvia el missatge d'estat; retorna si ha canviat (i cal desar)."""
+    if data.get('status_message') == message:
+        return False
+    data['status_message'] = message
+    return True
 
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = {}
-                
-                # Planifiquem tasques
-                for dni, data in active_items:
-                    if not data.get('active', False) or not data.get('zips'):
-                        continue
-
-                    # --- LÍMIT DE RECURRÈNCIA ---
-                    freq_type = data.get('freq_type', 'once')
-                    if freq_type != 'once':
-                        created_at = data.get('created_at', 0)
-                        max_h = MAX_RECURRENCE_HOURS_DAILY if freq_type == 'daily' else MAX_RECURRENCE_HOURS
-                        if created_at and (time.time() - created_at) > max_h * 3600:
-                            data['active'] = False
-                            if freq_type == 'daily':
-                                data['status_message'] = f"Expirada (màxim {max_h // 24} dies de recurrència)"
-                            else:
-                                data['status_message'] = f"Expirada (màxim {max_h}h de recurrència)"
-                            data['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
-                            updates_made = True
-                            logger.info(f"Cerca {dni} expirada per límit de recurrència ({max_h}h)")
-                            continue
-
-                    # --- GESTIÓ DE FREQÜÈNCIA (Lògica Temporal) ---
-                    last_complete = data.get('last_cycle_time', 0)
-                    now = time.time()
-                    
+
+def _plan_checks(active_searches, queue, dnis=None):
+    """Decideix quines cerques toquen i quins CPs s'han de comprovar.
+
+    Aplica el límit de recurrència i la lògica de freqüència sobre
+    *active_searches* (només les de *dnis*, si es dona) modificant els
+    missatges d'estat, i retorna
+    ``(jobs, updates_made)`` on ``jobs`` és ``[(dni, data, zip, run_id), …]``.
+    Els CPs els reparteix *queue* (``WorkQueue``) entre totes les cerques
+    en marxa segons el seu pes; cada cerca en té com a molt ``queue.depth``
+    en vol i no se n'envia cap dues vegades per cicle.
+    """
+    jobs = []
+    updates_made = False
+
+    if dnis is None:
+        dnis = list(active_searches)
+
+    for dni in dnis:
+        data = active_searches.get(dni)
+        if not data or not data.get('active', False) or not data.get('zips'):
+            continue
+
+        # --- LÍMIT DE RECURRÈNCIA ---
+        freq_type = data.get('freq_type', 'once')
+        if freq_type != 'once':
+            created_at = data.get('created_at', 0)
+            max_h = MAX_RECURRENCE_HOURS_DAILY if freq_type == 'daily' else MAX_RECURRENCE_HOURS
+            if created_at and (time.time() - created_at) > max_h * 3600:
+                data['active'] = False
+                if freq_type == 'daily':
+                    data['status_message'] = f"Expirada (màxim {max_h // 24} dies de recurrència)"
+                else:
+                    data['status_message'] = f"Expirada (màxim {max_h}h de recurrència)"
+                data['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
+                updates_made = True
+                logger.info(f"Cerca {dni} expirada per límit de recurrència ({max_h}h)")
+                continue
+
+        # --- GESTIÓ DE FREQÜÈNCIA (Lògica Temporal) ---
+        last_complete = data.get('last_cycle_time', 0)
+        now = time.time()
+        
+        should_run = False
+        
+        # Si encara no hem acabat la volta actual (current_zip_index > 0), continuem
+        if data.get('current_zip_index', 0) > 0:
+            should_run = True
+        else:
+            # Estem a l'inici d'un cicle, comprovem si toca començar
+            if last_complete == 0:
+                should_run = True # Primera vegada
+            else:
+                # Ja hem acabat almenys una volta, mirem temporització
+                if freq_type == 'once':
+                    # Ja s'hauria d'haver marcat com inactiu, però per si de cas
+                    data['active'] = False
+                    data['status_message'] = "Finalitzat (mode 'una vegada')"
+                    updates_made = True
                     should_run = False
                     
-                    # Si encara no hem acabat la volta actual (current_zip_index > 0), continuem
-                    if data.get('current_zip_index', 0) > 0:
+                elif freq_type == 'interval':
+                    interval_hours = float(data.get('interval_hours', 1))
+                    if (now - last_complete) >= (interval_hours * 3600):
                         should_run = True
                     else:
-                        # Estem a l'inici d'un cicle, comprovem si toca començar
-                        if last_complete == 0:
-                            should_run = True # Primera vegada
-                        else:
-                            # Ja hem acabat almenys una volta, mirem temporització
-                            if freq_type == 'once':
-                                # Ja s'hauria d'haver marcat com inactiu, però per si de cas
-                                data['active'] = False
-                                data['status_message'] = "Finalitzat (mode 'una vegada')"
-                                updates_made = True
-                                should_run = False
-                                
-                            elif freq_type == 'interval':
-                                interval_hours = float(data.get('interval_hours', 1))
-                                if (now - last_complete) >= (interval_hours * 3600):
-                                    should_run = True
-                                else:
-                                    # Calculate next run time
-                                    next_ts = last_complete + (interval_hours * 3600)
-                                    next_time = datetime.fromtimestamp(next_ts).strftime('%H:%M')
-                                    data['status_message'] = f"En pausa (propera: {next_time})"
-                                    updates_made = True
-                                    
-                            elif freq_type == 'daily':
-                                daily_time_str = data.get('daily_time', '09:00')
-                                # Simplificació: si ja hem corregut avui, no correm més
-                                last_dt = datetime.fromtimestamp(last_complete)
-                                now_dt = datetime.now()
-                                target_time = datetime.strptime(daily_time_str, '%H:%M').time()
-                                
-                                if last_dt.date() < now_dt.date() and now_dt.time() >= target_time:
-                                    should_run = True
-                                else:
-                                    data['status_message'] = f"En pausa fins demà a les {daily_time_str}"
-                                    updates_made = True
-
-                    if not should_run:
-                        continue
-
-                    # --- EXECUCIÓ ---
-                    # Registrem inici de cicle si toca
-                    if data.get('current_zip_index', 0) == 0 and not data.get('cycle_start_time'):
-                        data['cycle_start_time'] = time.time()
-
-                    # Agafem un BATCH de ZIPs a comprovar en paral·lel
-                    zips = data['zips']
-                    idx = data.get('current_zip_index', 0)
-                    
-                    if idx < len(zips):
-                        batch_end = min(idx + BATCH_SIZE, len(zips))
-                        batch_zips = zips[idx:batch_end]
-                        
-                        # Actualitzem estat abans de llançar (perquè UI vegi que treballa)
-                        data['status_message'] = f"Cercant a {batch_zips[0]}..."
-                        active_searches[dni] = data # Important actualitzar l'objecte pare
-                        updates_made = True 
+                        # Calculate next run time
+                        next_ts = last_complete + (interval_hours * 3600)
+                        next_time = datetime.fromtimestamp(next_ts).strftime('%H:%M')
+                        updates_made |= _set_status(data, f"En pausa (propera: {next_time})")
                         
-                        for zip_to_check in batch_zips:
-                            run_id = data.get('run_id', 0)
-                            future = executor.submit(check_single_zip, dni, data, zip_to_check)
-                            futures[future] = (dni, zip_to_check, run_id)
-                
-                # Si hem fet actualitzacions d'estat (missatges "En pausa"), guardem abans de bloquejar en futures
-                if updates_made:
-                    save_state(active_searches)
-                    updates_made = False # Reset
-
-                # Recarreguem estat fresc del disc per capturar stop/restart/delete
-                active_searches = load_state()
-
-                # Processar resultats dels fils
-                for future in futures:
-                    dni, checked_zip, submitted_run_id = futures[future]
-                    found, success_zip, found_type, offices_info = future.result()
+                elif freq_type == 'daily':
+                    # Un cop al dia, a l'hora planificada dins de la finestra
+                    # de repartiment (o a daily_time si no n'hi ha)
+                    start_ts = next_daily_run(data, now)
                     
-                    data = active_searches.get(dni)
-                    if not data:
-                        continue  # Esborrat durant el processament
-
-                    # Si l'usuari ha aturat o reiniciat, ignorem resultats antics
-                    if not data.get('active'):
-                        continue
-                    if data.get('run_id', 0) != submitted_run_id:
-                        logger.info(f"Ignorant resultat antic de {checked_zip} per {dni} (cerca reiniciada)")
-                        continue
-
-                    if found:
-                        # !!! ÈXIT !!!
-                        type_name = 'Presencial' if found_type == 'person' else 'Telefònica'
-                        now_str = datetime.now().strftime('%d/%m %H:%M')
-                        data['status_message'] = f"ÈXIT! Cita {type_name} al CP {success_zip}"
-                        data['last_result_message'] = f"CITA {type_name} DISPONIBLE DETECTADA EL {now_str}"
-                        data['last_success'] = f"Cita {type_name} al CP {success_zip} ({now_str})"
-                        data['last_cycle_time'] = time.time()
-                        
-                        # Determinar tipus de cita per al correu
-                        appt_types = data.get('appt_types', [data.get('type', 'person')])
-                        types_str = ' i '.join(['Presencial' if t == 'person' else 'Telefònica' for t in appt_types])
-                        
-                        # Enviar Email HTML estilitzat
-                        email_html = build_appointment_email(
-                            dni, success_zip, type_name, types_str,
-                            data.get('scope_name', ''), offices_info,
-                            freq_type=data.get('freq_type', 'once')
-                        )
-                        send_email(data.get('email'), f"\U00002705 CITA SEPE TROBADA! ({type_name} a {success_zip})", email_html)
-                        
-                        # Aturem la cerca (tant 'once' com recurrents)
-                        data['active'] = False
-                        data['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
-                        freq_type = data.get('freq_type', 'once')
-                        if freq_type != 'once':
-                            data['status_message'] += f" (cerca aturada automàticament)"
-                            logger.info(f"Cerca recurrent {dni}: èxit trobat, aturant automàticament")
-                        updates_made = True
-                        
+                    if now >= start_ts:
+                        should_run = True
                     else:
-                        # No trobat, avancem índex
-                        logger.info(f"    CP {checked_zip} — no trobat.")
-                        data['current_zip_index'] += 1
-                        updates_made = True
-                        
-                        # Comprovem si hem acabat la llista de ZIPs
-                        if data['current_zip_index'] >= len(data['zips']):
-                            data['current_zip_index'] = 0 # Reset índex
-                            data['last_cycle_time'] = time.time() # Marquem fi de cicle
-                            data['cycle_start_time'] = None  # Reset per al pròxim cicle
-                            
-                            # Si era 'once', marquem com acabadat
-                            if data.get('freq_type') == 'once':
-                                data['active'] = False
-                                data['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
-                                data['status_message'] = "Finalitzat sense èxit."
-                            else:
-                                data['status_message'] = "Cicle completat. Esperant següent interval."
+                        start_dt = datetime.fromtimestamp(start_ts)
+                        day_str = "demà" if start_dt.date() > datetime.now().date() else "avui"
+                        updates_made |= _set_status(
+                            data, f"En pausa fins {day_str} a les {start_dt.strftime('%H:%M')}")
+
+        if not should_run:
+            continue
+
+        # --- EXECUCIÓ ---
+        # Registrem inici de cicle si toca
+        if data.get('current_zip_index', 0) == 0 and not data.get('cycle_start_time'):
+            data['cycle_start_time'] = time.time()
+            # CPs amb més probabilitat de cita (segons l'historial) primer
+            data['zips'] = zip_history.prioritize(data['zips'])
+
+        # La cerca entra al repartiment de forats (fins a BATCH_SIZE en vol)
+        if data.get('current_zip_index', 0) < len(data['zips']):
+            queue.activate(dni, data)
+
+    # Forats lliures repartits entre totes les cerques en marxa (DRR ponderat)
+    for dni, zip_to_check in queue.allocate():
+        data = active_searches.get(dni)
+        if not data or not data.get('active', False):
+            # Aturada o esborrada: el forat s'allibera de seguida sense consultar res
+            queue.release(dni, zip_to_check)
+            continue
+        # Actualitzem estat abans de llançar (perquè UI vegi que treballa)
+        data['status_message'] = f"Cercant a {zip_to_check}..."
+        updates_made = True
+        jobs.append((dni, data, zip_to_check, data.get('run_id', 0)))
+
+    return jobs, updates_made
+
+
+def _apply_results(active_searches, outcomes):
+    """Aplica els resultats dels fils sobre l'estat fresc. Retorna si hi ha canvis.
+
+    *outcomes* és ``[((dni, zip, run_id), (found, success_zip, type, offices, calls)), …]``.
+    Les peticions SEPE de cada comprovació s'acumulen a ``sepe_calls`` de la cerca.
+    """
+    updates_made = False
+
+    for (dni, checked_zip, submitted_run_id), outcome in outcomes:
+        found, success_zip, found_type, offices_info, calls = outcome
+        
+        data = active_searches.get(dni)
+        if not data:
+            continue  # Esborrat durant el processament
+
+        if calls:
+            data['sepe_calls'] = data.get('sepe_calls', 0) + calls
+            updates_made = True
+
+        # Si l'usuari ha aturat o reiniciat, ignorem resultats antics
+        if not data.get('active'):
+            continue
+        if data.get('run_id', 0) != submitted_run_id:
+            logger.info(f"Ignorant resultat antic de {checked_zip} per {dni} (cerca reiniciada)")
+            continue
+
+        if found:
+            # !!! ÈXIT !!!
+            type_name = 'Presencial' if found_type == 'person' else 'Telefònica'
+            now_str = datetime.now().strftime('%d/%m %H:%M')
+            data['status_message'] = f"ÈXIT! Cita {type_name} al CP {success_zip}"
+            data['last_result_message'] = f"CITA {type_name} DISPONIBLE DETECTADA EL {now_str}"
+            data['last_success'] = f"Cita {type_name} al CP {success_zip} ({now_str})"
+            data['last_cycle_time'] = time.time()
+            
+            # Determinar tipus de cita per al correu
+            appt_types = data.get('appt_types', [data.get('type', 'person')])
+            types_str = ' i '.join(['Presencial' if t == 'person' else 'Telefònica' for t in appt_types])
             
-            # Guardem canvis al final de la iteració del bucle principal
-            if updates_made:
-                save_state(active_searches)
+            # Enviar Email HTML estilitzat
+            email_html = build_appointment_email(
+                dni, success_zip, type_name, types_str,
+                data.get('scope_name', ''), offices_info,
+                freq_type=data.get('freq_type', 'once')
+            )
+            send_email(data.get('email'), f"\U00002705 CITA SEPE TROBADA! ({type_name} a {success_zip})", email_html)
+            
+            # Aturem la cerca (tant 'once' com recurrents)
+            data['active'] = False
+            data['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
+            freq_type = data.get('freq_type', 'once')
+            if freq_type != 'once':
+                data['status_message'] += f" (cerca aturada automàticament)"
+                logger.info(f"Cerca recurrent {dni}: èxit trobat, aturant automàticament")
+            updates_made = True
+            
+        elif found is None:
+            # Resultat incert (SEPE no disponible): no avancem l'índex
+            logger.info(f"    CP {checked_zip} — resultat desconegut, es tornarà a comprovar.")
+            data['status_message'] = f"SEPE no disponible, reintentant {checked_zip}..."
+            updates_made = True
+
+        else:
+            # No trobat, avancem índex
+            logger.info(f"    CP {checked_zip} — no trobat.")
+            data['current_zip_index'] += 1
+            updates_made = True
+            
+            # Comprovem si hem acabat la llista de ZIPs
+            if data['current_zip_index'] >= len(data['zips']):
+                data['current_zip_index'] = 0 # Reset índex
+                data['last_cycle_time'] = time.time() # Marquem fi de cicle
+                data['cycle_start_time'] = None  # Reset per al pròxim cicle
+                
+                # Si era 'once', marquem com acabadat
+                if data.get('freq_type') == 'once':
+                    data['active'] = False
+                    data['finished_at'] = datetime.now().strftime('%d/%m/%Y %H:%M')
+                    data['status_message'] = "Finalitzat sense èxit."
+                else:
+                    data['status_message'] = "Cicle completat. Esperant següent interval."
+
+    return updates_made
+
+
+def _collect_done(queue, pending):
+    """Treu de *pending* les comprovacions acabades i en retorna els ``outcomes``.
+
+    *pending* és ``{future_o_task: (dni, zip, run_id)}``.
+    """
+    outcomes = []
+    for future in [f for f in pending if f.done()]:
+        dni, zip_to_check, run_id = pending.pop(future)
+        result = future.result()
+        found = queue.complete(dni, zip_to_check, run_id, result[0], result[4])
+        if found is not result[0]:
+            # Reintents esgotats: es compta com a comprovat sense cita
+            result = (found,) + tuple(result[1:])
+        outcomes.append(((dni, zip_to_check, run_id), result))
+    return outcomes
+
+
+# Cada quant es mira si l'app web ha canviat el fitxer d'estat (segons)
+STATE_POLL_INTERVAL = 2
+
+# Durada suposada d'una comprovació mentre encara no n'hi ha cap de mesurada
+DEFAULT_CHECK_SECONDS = 5.0
+
+
+def _check_capacity(concurrency):
+    """Comprovacions per segon que el worker pot sostenir ara mateix.
+
+    És el mínim entre el que permeten les *concurrency* comprovacions
+    simultànies amb la durada mediana mesurada i el que permet el ritme
+    actual del limitador amb les peticions mitjanes per comprovació.
+    """
+    p50_ms = sepe_metrics.checks_snapshot()['p50']
+    check_seconds = p50_ms / 1000 if p50_ms else DEFAULT_CHECK_SECONDS
+    by_workers = concurrency / max(check_seconds, 0.1)
+    round_trips = get_session_stats()['avg_round_trips'] or 9
+    by_rate = rate_limiter.rate / round_trips
+    return max(min(by_workers, by_rate), 0.01)
+
+
+def _pipeline_step(queue, scheduler, store, pending, submit, leases=None, autoscaler=None):
+    """Una volta de la cua contínua, comuna als dos motors.
+
+    Treballa sobre l'estat en memòria de *store* (``StateStore``): aplica
+    els canvis de l'app web com a esdeveniments, aplica els resultats,
+    omple els forats de les cerques que toquen (llevat que el circuit SEPE
+    no accepti peticions: obert, o mig obert amb la prova en curs), marca les cerques modificades i en fa checkpoint quan
+    toca.  *submit(dni, data, zip, cancel)* llança una comprovació (amb el
+    ``CancelToken`` del cicle) i en retorna el future/tasca.  Amb *leases* (mode repartit) només es processen les
+    cerques d'aquest worker.  *autoscaler* (``ConcurrencyAutoscaler``)
+    ajusta els forats i la profunditat de *queue* a cada volta.
+
+    Retorna quants segons pot esperar el bucle abans de la volta següent.
+    """
+    outcomes = _collect_done(queue, pending)
+    sepe_ok = circuit_breaker.accepting()
+    searches = store.searches
+    rebuild = scheduler.needs_rebuild()
+
+    if leases is not None and leases.needs_sync():
+        # Abans de deixar anar cap lease, el disc ha de tenir l'última versió
+        store.checkpoint(force=True)
+        before = leases.active()
+        # Amb CPs en vol o resultats encara per aplicar: es drenen, no s'alliberen
+        busy = {dni for dni, _, _ in pending.values()} | {dni for (dni, _, _), _ in outcomes}
+        leases.sync([dni for dni, data in searches.items() if data.get('active')], busy)
+        rebuild = rebuild or leases.active() != before
+
+    # Després dels leases: les cerques acabades d'agafar ja són al disc
+    changed = store.refresh()
+
+    # En mode repartit: de les cerques que drena només n'aplica els resultats
+    owns = (lambda dni: True) if leases is None else leases.owned.__contains__
+    assigned = (lambda dni: True) if leases is None else leases.active().__contains__
+
+    # Canvis de l'app web (crear, aturar, reiniciar, esborrar): el vol
+    # de les cerques aturades o reiniciades es cancel·la de seguida
+    for dni in changed:
+        data = searches.get(dni)
+        if not data:
+            queue.cancel(dni, "cerca esborrada")
+        elif not data.get('active'):
+            queue.cancel(dni, "cerca aturada")
+        else:
+            queue.cancel(dni, "cerca reiniciada", run_id=data.get('run_id', 0))
+
+    draining = leases.draining if leases is not None else ()
+    dirty = set()
+    if rebuild:
+        mine = {dni: data for dni, data in searches.items() if assigned(dni)}
+        dirty |= scheduler.rebuild(mine)
+        queue.prune({dni for dni, data in mine.items() if data.get('active')}, draining)
+    elif changed:
+        for dni in changed:
+            scheduler.update(dni, searches.get(dni) if assigned(dni) else None)
+
+    outcomes = [outcome for outcome in outcomes if owns(outcome[0][0])]
+    results = {dni for (dni, _, _), _ in outcomes}
+    if outcomes and _apply_results(searches, outcomes):
+        dirty |= results
+    for dni in results:
+        if not searches.get(dni, {}).get('active'):
+            # Cita trobada o cerca acabada: la resta de CPs en vol ja no serveixen
+            queue.cancel(dni, "cerca acabada")
+
+    # Cerques a avaluar: les vençudes i les que acaben de rebre resultats
+    due = set(results)
+    if sepe_ok:
+        # Amb el circuit obert (o la prova en curs) no s'envia res de nou: tornaria "desconegut" a l'instant
+        due = {dni for dni in due | scheduler.pop_due() if assigned(dni)}
+        jobs, planned = _plan_checks(searches, queue, due)
+        for dni, data, zip_to_check, run_id in jobs:
+            pending[submit(dni, data, zip_to_check, queue.token(dni))] = (dni, zip_to_check, run_id)
+        if planned:
+            dirty |= due | {dni for dni, _, _, _ in jobs}
+    for dni in due:
+        scheduler.reschedule(dni, searches.get(dni) if assigned(dni) else None,
+                             queue.has_work(dni))
+
+    store.mark(dirty)
+    store.checkpoint()
+
+    if leases is not None:
+        # Cerques acabades: el lease queda lliure de seguida
+        finished = {dni for dni in results if not searches.get(dni, {}).get('active')}
+        if finished:
+            store.checkpoint(force=True)
+            leases.release(finished)
+
+    if autoscaler is not None:
+        autoscaler.step()
+    _report_stats(queue, store, leases, autoscaler)
+    _sweep_retention()
+
+    if not sepe_ok:
+        return max(STATE_POLL_INTERVAL, _outage_pause())
+    next_due = scheduler.next_due()
+    if next_due is None:
+        return STATE_POLL_INTERVAL
+    return min(max(next_due - time.time(), 0), STATE_POLL_INTERVAL)
+
+
+def _autoscaler(queue, min_workers, max_workers, max_depth):
+    """``ConcurrencyAutoscaler`` de *queue* (``WORKER_AUTOSCALE=0`` el deixa fix)."""
+    enabled = os.getenv('WORKER_AUTOSCALE', '1').lower() not in ('0', 'false', 'no', '')
+    autoscaler = ConcurrencyAutoscaler(
+        queue, min_workers, max_workers, _env_int('MIN_BATCH_SIZE', 1), max_depth,
+        metrics=sepe_metrics, limiter=rate_limiter, breaker=circuit_breaker, enabled=enabled)
+    if enabled:
+        logger.info(f"Autoescalat: {autoscaler.min_workers}-{autoscaler.max_workers} en vol, "
+                    f"profunditat {autoscaler.min_depth}-{autoscaler.max_depth}")
+    return autoscaler
+
+
+def _state_store():
+    """Estat en memòria del worker, carregat i amb checkpoint en aturar-se."""
+    store = StateStore()
+    store.load()
+    atexit.register(store.checkpoint, force=True)
+    if store.backend.name == 'journal':
+        # Instantànies periòdiques perquè el diari no creixi sense límit
+        store.backend.start_compactor()
+    # L'historial d'encerts per CP es desa a intervals: el que quedi, en sortir
+    zip_history.load()
+    atexit.register(zip_history.flush, force=True)
+    logger.info(f"Estat carregat: {len(store.searches)} cerques "
+                f"(checkpoint cada {store.checkpoint_interval:g}s)")
+    return store
+
+
+def _lease_manager():
+    """``LeaseManager`` si el worker corre en mode repartit (``WORKER_SHARDED=1``)."""
+    if os.getenv('WORKER_SHARDED', '0').lower() in ('0', 'false', 'no', ''):
+        return None
+    leases = LeaseManager()
+    atexit.register(leases.release_all)
+    logger.info(f"Mode repartit: worker {leases.worker_id}, leases de {leases.ttl}s")
+    return leases
+
+
+def run_worker():
+    logger.info("Iniciant Worker del Bot SEPE...")
+    
+    MAX_WORKERS = _env_int('MAX_WORKERS', 3) # Fils simultanis per verificar CPs en paral·lel
+    BATCH_SIZE = _env_int('BATCH_SIZE', 3) # CPs en vol com a màxim per cerca
+        
+    logger.info(f"Worker configurat amb {MAX_WORKERS} fils simultanis i BATCH_SIZE={BATCH_SIZE}.")
+
+    # Executor de llarga durada: cada fil que acaba agafa la comprovació
+    # següent de la cua sense esperar la resta del lot.  Un forat per fil:
+    # el forat que s'allibera es torna a omplir a la mateixa volta, i una
+    # comprovació encuada a l'executor ja no es pot reassignar ni cancel·lar
+    queue = WorkQueue(BATCH_SIZE, slots=MAX_WORKERS)
+    # Amb autoescalat, els forats són les comprovacions simultànies (entre
+    # MIN_WORKERS i MAX_WORKERS); l'executor només crea els fils que s'usen
+    autoscaler = _autoscaler(queue, _env_int('MIN_WORKERS', 1), MAX_WORKERS, BATCH_SIZE)
+    scheduler = SearchScheduler(capacity=lambda: _check_capacity(MAX_WORKERS))
+    leases = _lease_manager()
+    # Després dels leases: atexit desa l'estat abans d'alliberar-los
+    store = _state_store()
+    pending = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        submit = lambda dni, data, zip_code, cancel: executor.submit(
+            check_single_zip, dni, data, zip_code, cancel)
+        while True:
+            try:
+                timeout = _pipeline_step(queue, scheduler, store, pending, submit, leases, autoscaler)
+
+                # Dormim fins al pròxim resultat, la pròxima cerca que venci
+                # o la pròxima comprovació de canvis a l'estat
+                if pending:
+                    wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(timeout)
+
+            except Exception as e:
+                logger.error(f"Error al bucle principal del Worker: {e}")
+                time.sleep(5)
+
+
+async def run_worker_async():
+    """Variant asyncio del worker: totes les comprovacions en un sol fil.
+
+    Fa servir la mateixa cua contínua que ``run_worker``, però cada
+    comprovació és una tasca sobre un ``AsyncSepeClient``, limitat per
+    ``SEPE_ASYNC_CONCURRENCY`` comprovacions simultànies.  Amb aquest motor
+    ``BATCH_SIZE`` pot ser molt més gran (per defecte 20).
+    """
+    from src.sepe_async import AsyncSepeClient, ASYNC_MAX_CONCURRENCY
+
+    logger.info("Iniciant Worker asíncron del Bot SEPE...")
+
+    BATCH_SIZE = _env_int('BATCH_SIZE', 20)
+    concurrency = _env_int('SEPE_ASYNC_CONCURRENCY', ASYNC_MAX_CONCURRENCY)
+    logger.info(f"Worker asíncron amb {concurrency} comprovacions simultànies i BATCH_SIZE={BATCH_SIZE}.")
+
+    queue = WorkQueue(BATCH_SIZE, slots=concurrency)
+    autoscaler = _autoscaler(queue, _env_int('SEPE_ASYNC_MIN_CONCURRENCY', 10), concurrency, BATCH_SIZE)
+    scheduler = SearchScheduler(capacity=lambda: _check_capacity(concurrency))
+    leases = _lease_manager()
+    # Després dels leases: atexit desa l'estat abans d'alliberar-los
+    store = _state_store()
+    pending = {}
+    async with AsyncSepeClient(max_concurrency=concurrency) as client:
+        submit = lambda dni, data, zip_code, cancel: asyncio.ensure_future(
+            check_single_zip_async(client, dni, data, zip_code, cancel))
+        while True:
+            try:
+                timeout = _pipeline_step(queue, scheduler, store, pending, submit, leases, autoscaler)
+
+                if pending:
+                    await asyncio.wait(list(pending), timeout=timeout,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(timeout)
+
+            except Exception as e:
+                logger.error(f"Error al bucle principal del Worker asíncron: {e}")
+                await asyncio.sleep(5)
+
 
-            # Petita pausa per no saturar CPU en bucles molt ràpids
-            time.sleep(2)
+def main():
+    """Arrenca el motor triat amb ``WORKER_ENGINE`` (``threads`` o ``async``)."""
+    engine = os.getenv('WORKER_ENGINE', 'threads').lower()
+    # supervisord atura amb SIGTERM: sortim net perquè es desi l'estat
+    # (i, en mode repartit, s'alliberin els leases).  Només es pot fer des
+    # del fil principal: amb run.py el worker corre en un fil i el procés
+    # l'atura Flask
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if engine == 'async':
+        asyncio.run(run_worker_async())
+    else:
+        run_worker()
 
-        except Exception as e:
-            logger.error(f"Error al bucle principal del Worker: {e}")
-            time.sleep(5)
 
 if __name__ == "__main__":
-    run_worker()
+    main()
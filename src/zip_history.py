@@ -0,0 +1,274 @@
+"""
+Historial d'encerts per codi postal i per oficina.
+
+``sepe_api`` hi anota cada comprovació que el SEPE ha resolt de debò
+(no les de la cache ni les incertes): si hi havia cita, a quina hora del
+dia i quines oficines han respost (i quines tenien hueco).  El worker el
+fa servir en començar cada cicle d'una cerca per ordenar-ne els CPs per
+probabilitat estimada de trobar cita ara mateix:
+
+* taxa d'encert del CP a aquesta hora, suavitzada cap a la taxa del CP;
+* la del CP, suavitzada cap a la de les seves oficines (CPs veïns que
+  comparteixen oficina s'aprofiten de l'historial dels altres);
+* la de les oficines, suavitzada cap a la taxa global.
+
+Una part ``ZIP_EXPLORATION`` de les posicions es reparteix a l'atzar
+perquè els CPs poc vistos també es continuïn provant.  Els comptadors
+decauen amb una vida mitjana de ``ZIP_HISTORY_HALF_LIFE_DAYS`` dies (el
+SEPE obre agendes de manera diferent segons l'època).
+
+Les anotacions s'acumulen en memòria i es desen a
+``data/zip_history.json`` com a molt cada ``ZIP_HISTORY_FLUSH_INTERVAL``
+segons, sumant-les al que hi hagi al fitxer (llegir, sumar i escriure es
+fa amb ``flock`` sobre ``data/zip_history.lock``): diversos workers poden
+compartir-lo sense trepitjar-se els comptadors.
+"""
+import os
+import json
+import time
+import random
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: sense bloqueig entre processos (un sol worker)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ``SEPE_HISTORY_DIR`` l'aparta de ``data/`` (proves contra el SEPE fals)
+ZIP_HISTORY_FILE = os.path.join(os.getenv('SEPE_HISTORY_DIR', os.path.join(os.path.dirname(__file__), '..', 'data')),
+                                'zip_history.json')
+LOCK_FILE = ZIP_HISTORY_FILE.replace('.json', '.lock')
+
+# Proporció de posicions de cada cicle que es trien a l'atzar
+ZIP_EXPLORATION = float(os.getenv('ZIP_EXPLORATION', 0.1))
+# Vida mitjana (dies) dels comptadors
+HALF_LIFE_DAYS = float(os.getenv('ZIP_HISTORY_HALF_LIFE_DAYS', 14))
+# Segons màxims entre dues escriptures del fitxer
+FLUSH_INTERVAL = float(os.getenv('ZIP_HISTORY_FLUSH_INTERVAL', 60))
+
+# Pes (en comprovacions) de la taxa "pare" a cada nivell del suavitzat
+_PRIOR_WEIGHT = 5.0
+# Oficines que es recorden per CP
+_MAX_OFFICES = 10
+# Per sota d'aquest pes (després del decaïment) l'entrada s'oblida
+_MIN_WEIGHT = 0.01
+
+_lock = threading.Lock()
+# Estat conegut: fitxer a l'última lectura/escriptura + anotacions pròpies
+_zips = {}
+_offices = {}
+# Anotacions pròpies encara no desades (increments sense decaïment)
+_pending_zips = {}
+_pending_offices = {}
+_flushed_at = time.time()
+
+
+def _decay(entry, now):
+    """Aplica el decaïment a *entry* fins a *now* (in situ)."""
+    elapsed = now - entry.get('ts', now)
+    if elapsed > 0 and HALF_LIFE_DAYS > 0:
+        factor = 0.5 ** (elapsed / (HALF_LIFE_DAYS * 86400))
+        entry['n'] = entry.get('n', 0) * factor
+        entry['h'] = entry.get('h', 0) * factor
+        for bucket in entry.get('hours', {}).values():
+            bucket[0] *= factor
+            bucket[1] *= factor
+    entry['ts'] = now
+    return entry
+
+
+def _add(target, delta):
+    """Suma a *target* els comptadors de *delta* (mateix format d'entrada)."""
+    target['n'] = target.get('n', 0) + delta.get('n', 0)
+    target['h'] = target.get('h', 0) + delta.get('h', 0)
+    for hour, (n, h) in delta.get('hours', {}).items():
+        bucket = target.setdefault('hours', {}).setdefault(hour, [0, 0])
+        bucket[0] += n
+        bucket[1] += h
+    if delta.get('last_hit'):
+        target['last_hit'] = max(target.get('last_hit', 0), delta['last_hit'])
+    if delta.get('offices'):
+        names = target.get('offices', [])
+        names = [o for o in names if o not in delta['offices']] + list(delta['offices'])
+        target['offices'] = names[-_MAX_OFFICES:]
+
+
+def _note(entries, key, found, now, hour=None, offices=None):
+    entry = entries.setdefault(key, {'n': 0, 'h': 0, 'ts': now})
+    _add(entry, {
+        'n': 1,
+        'h': 1 if found else 0,
+        'hours': {hour: [1, 1 if found else 0]} if hour is not None else {},
+        'last_hit': now if found else 0,
+        'offices': offices,
+    })
+
+
+def record(zip_code, found, offices=()):
+    """Anota una comprovació resolta pel SEPE.
+
+    *offices* són les oficines retornades (``[{'name', 'date'}, …]``, de
+    tots els canals); les que tenen ``date`` compten com a encert de l'oficina.
+    """
+    now = time.time()
+    hour = str(time.localtime(now).tm_hour)
+    names = list(dict.fromkeys(o.get('name') for o in offices if o.get('name')))
+    with _lock:
+        for entries in (_zips, _pending_zips):
+            if entries is _zips and zip_code in entries:
+                _decay(entries[zip_code], now)
+            _note(entries, zip_code, found, now, hour, names)
+        for name in names:
+            office_found = any(o.get('date') for o in offices if o.get('name') == name)
+            for entries in (_offices, _pending_offices):
+                if entries is _offices and name in entries:
+                    _decay(entries[name], now)
+                _note(entries, name, office_found, now)
+    flush()
+
+
+@contextmanager
+def _file_locked():
+    os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+    with open(LOCK_FILE, 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_file():
+    try:
+        with open(ZIP_HISTORY_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get('zips', {}), data.get('offices', {})
+    except FileNotFoundError:
+        return {}, {}
+    except Exception as e:
+        logger.warning(f"Error llegint l'historial de CPs: {e}")
+        return {}, {}
+
+
+def _merge(stored, pending, now):
+    for entry in stored.values():
+        _decay(entry, now)
+    for key, delta in pending.items():
+        _add(stored.setdefault(key, {'n': 0, 'h': 0, 'ts': now}), delta)
+    return {k: e for k, e in stored.items() if e.get('n', 0) >= _MIN_WEIGHT}
+
+
+def flush(force=False):
+    """Desa les anotacions pendents si ha passat ``FLUSH_INTERVAL`` (o *force*)."""
+    global _zips, _offices, _flushed_at
+    now = time.time()
+    with _lock:
+        if not (_pending_zips or _pending_offices):
+            return
+        if not force and now - _flushed_at < FLUSH_INTERVAL:
+            return
+        try:
+            # Un altre worker pot estar sumant les seves anotacions alhora
+            with _file_locked():
+                stored_zips, stored_offices = _read_file()
+                zips = _merge(stored_zips, _pending_zips, now)
+                offices = _merge(stored_offices, _pending_offices, now)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(ZIP_HISTORY_FILE), text=True)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({'zips': zips, 'offices': offices}, f, ensure_ascii=False)
+                os.replace(tmp_path, ZIP_HISTORY_FILE)
+        except Exception as e:
+            logger.error(f"Error guardant l'historial de CPs: {e}")
+            if 'tmp_path' in locals() and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            _flushed_at = now
+            return
+        _zips, _offices = zips, offices
+        _pending_zips.clear()
+        _pending_offices.clear()
+        _flushed_at = now
+
+
+def load():
+    """Carrega l'historial del fitxer (en arrencar el worker)."""
+    global _zips, _offices
+    zips, offices = _read_file()
+    with _lock:
+        _zips, _offices = zips, offices
+    return len(zips)
+
+
+def _rate(hits, checks, prior):
+    return (hits + prior * _PRIOR_WEIGHT) / (checks + _PRIOR_WEIGHT)
+
+
+def _scores(zips, hour):
+    """Probabilitat d'encert estimada de cada CP de *zips* a l'hora *hour*."""
+    total_n = sum(e.get('n', 0) for e in _zips.values())
+    total_h = sum(e.get('h', 0) for e in _zips.values())
+    base = (total_h + 1) / (total_n + 100)
+    scores = {}
+    for zip_code in zips:
+        entry = _zips.get(zip_code)
+        if entry is None:
+            scores[zip_code] = base
+            continue
+        office_rates = [_rate(o.get('h', 0), o.get('n', 0), base)
+                        for o in (_offices.get(name) for name in entry.get('offices', [])) if o]
+        prior = max(office_rates) if office_rates else base
+        rate = _rate(entry.get('h', 0), entry.get('n', 0), prior)
+        bucket = entry.get('hours', {}).get(hour)
+        if bucket:
+            rate = _rate(bucket[1], bucket[0], rate)
+        scores[zip_code] = rate
+    return scores
+
+
+def prioritize(zips, exploration=None, rng=random):
+    """Retorna *zips* ordenats per probabilitat d'encert, amb exploració.
+
+    Cada posició, amb probabilitat *exploration* (``ZIP_EXPLORATION``) es
+    tria un CP a l'atzar d'entre els que queden; si no, el millor.  Sense
+    historial (tots empatats) l'ordre original es manté.
+    """
+    if len(zips) < 2:
+        return list(zips)
+    exploration = ZIP_EXPLORATION if exploration is None else exploration
+    hour = str(time.localtime().tm_hour)
+    with _lock:
+        scores = _scores(zips, hour)
+    if len(set(scores.values())) == 1:
+        return list(zips)
+    ranked = sorted(zips, key=lambda z: -scores[z])
+    ordered = []
+    while ranked:
+        if exploration > 0 and len(ranked) > 1 and rng.random() < exploration:
+            ordered.append(ranked.pop(rng.randrange(len(ranked))))
+        else:
+            ordered.append(ranked.pop(0))
+    return ordered
+
+
+def snapshot():
+    """Resum per a ``/api/server-info``."""
+    with _lock:
+        checks = sum(e.get('n', 0) for e in _zips.values())
+        hits = sum(e.get('h', 0) for e in _zips.values())
+        return {
+            'zips': len(_zips),
+            'offices': len(_offices),
+            'checks': round(checks, 1),
+            'hits': round(hits, 1),
+            'hit_rate': round(hits / checks, 4) if checks else 0.0,
+            'pending': len(_pending_zips),
+        }